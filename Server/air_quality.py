@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+#######################################################
+### Air quality index from the UBA CSV, numeric       #
+### Used by: get_uba_airquality.py                    #
+###                                                   #
+### The CSV of a station is parsed into one float     #
+### array per pollutant (NaN where the UBA writes     #
+### "-"). Any number of stations are combined per     #
+### hour with the maximum, each pollutant is then     #
+### classified against the index thresholds (see      #
+### get_uba_airquality.py) with one searchsorted, the #
+### worst class is the index of the hour. Without     #
+### NumPy the same is done value by value (bisect).   #
+#######################################################
+
+import bisect
+from datetime import datetime, timedelta
+try:
+	import numpy # optional: without NumPy the values are classified one by one
+except ImportError:
+	numpy = None
+
+POLLUTANTS = ["PM10", "O3", "NO2"]
+# Upper bounds in µg/m³ of the classes sehr gut (5), gut (4), mäßig (3), schlecht (2), above: sehr schlecht (1)
+THRESHOLDS = {"PM10": [20, 35, 50, 100],
+			"O3": [60, 120, 180, 240],
+			"NO2": [20, 40, 100, 200]}
+LABELS = {1: 'sehr schlecht',
+	2: 'schlecht',
+	3: 'mäßig',
+	4: 'gut',
+	5: 'sehr gut',
+	99: 'k.A.'}
+MISSING = 99		# index if no pollutant was measured
+INDEX = dict((label, idx) for idx, label in LABELS.items())	# reported label -> index
+HEADERS = {"PM10": "PM", "O3": "O₃", "NO2": "NO₂", "LQI": "Luftqualitätsindex"}	# part of the column name in the CSV
+COLUMNS = {"PM10": 2, "O3": 3, "NO2": 4, "LQI": 5}	# if the column names are not found
+
+NAN = float("nan")
+
+
+def number(text):
+	# "16" or "16,5" -> float, "-" or empty -> NaN
+	try:
+		return float(text.replace(",", "."))
+	except (AttributeError, ValueError):
+		return NAN
+
+
+def hour(text):
+	# "'15.09.2020 13:00'" -> "2020-09-15 13:00:00", the UBA counts the hours 1..24
+	text = text.strip("' ")
+	if text.endswith(" 24:00"):
+		return (datetime.strptime(text[:10], "%d.%m.%Y") + timedelta(days=1)).strftime("%Y-%m-%d 00:00:00")
+	return datetime.strptime(text, "%d.%m.%Y %H:%M").strftime("%Y-%m-%d %H:%M:%S")
+
+
+def columns(header):
+	result = dict(COLUMNS)
+	for key, part in HEADERS.items():
+		for i, name in enumerate(header):
+			if part in name:
+				result[key] = i
+				break
+	return result
+
+
+def parse_csv(rows):
+	# Rows of the CSV of one station (csv.reader, first row = column names) ->
+	# {"times": [...], "PM10": [...], "O3": [...], "NO2": [...], "LQI": [reported index, ...]}
+	data = dict((key, []) for key in ["times", "LQI"] + POLLUTANTS)
+	if not rows:
+		return data
+	index = columns(rows[0])
+	for row in rows[1:]:
+		if len(row) <= max(index.values()):
+			continue
+		try:
+			data["times"].append(hour(row[1]))
+		except ValueError:
+			continue
+		for key in POLLUTANTS:
+			data[key].append(number(row[index[key]]))
+		data["LQI"].append(INDEX.get(row[index["LQI"]].strip(), MISSING))
+	return data
+
+
+def classify(pollutant, values):
+	# Index class 1..5 per value, MISSING for NaN
+	bounds = THRESHOLDS[pollutant]
+	if numpy is not None:
+		values = numpy.asarray(values, dtype=numpy.float64)
+		classes = 5 - numpy.searchsorted(bounds, values, side="left")	# 20 is still "sehr gut", 20.5 not
+		classes[numpy.isnan(values)] = MISSING
+		return classes.tolist()
+	return [MISSING if value != value else 5 - bisect.bisect_left(bounds, value) for value in values]
+
+
+def combine(stations):
+	# Parsed CSVs of any number of stations -> per hour (sorted) the maximum of each pollutant over all
+	# stations (NaN if none measured it) and the index: worst class of these maxima, if no pollutant
+	# was measured the worst index reported by the UBA, else MISSING.
+	# {"times": [...], "PM10": [...], "O3": [...], "NO2": [...], "LQI": [...]}
+	times = sorted(set(time for data in stations for time in data["times"]))
+	position = dict((time, i) for i, time in enumerate(times))
+	result = {"times": times}
+	reported = [MISSING] * len(times)
+	for data in stations:
+		for time, idx in zip(data["times"], data["LQI"]):
+			reported[position[time]] = min(reported[position[time]], idx)
+	for key in POLLUTANTS:
+		if numpy is not None:
+			matrix = numpy.full((len(stations), len(times)), numpy.nan)
+			for row, data in enumerate(stations):
+				matrix[row, [position[time] for time in data["times"]]] = data[key]
+			result[key] = numpy.fmax.reduce(matrix, axis=0).tolist() if stations else []	# fmax: NaN only if all are NaN
+		else:
+			values = [NAN] * len(times)
+			for data in stations:
+				for time, value in zip(data["times"], data[key]):
+					i = position[time]
+					if value == value and not values[i] >= value:
+						values[i] = value
+			result[key] = values
+	classes = [classify(key, result[key]) for key in POLLUTANTS]
+	result["LQI"] = [min(worst) if min(worst) != MISSING else reported[i] for i, worst in enumerate(zip(*classes))]
+	return result
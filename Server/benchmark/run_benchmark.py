@@ -0,0 +1,490 @@
+#!/usr/bin/python3
+
+#######################################################
+### Offline end-to-end benchmark                      #
+### Runs: cron_kindle-weather.py (run_once)           #
+###                                                   #
+### Dark Sky, Homematic and UBA are replayed from     #
+### fixtures/ by a local HTTP server, MariaDB is      #
+### replaced by SQLite with months of synthetic       #
+### SENSOR_DATA (standins.py). Each run is a fresh    #
+### process with a fixed clock, so the frames are     #
+### the same in every run. Reported per run: time per #
+### stage, peak RSS and SHA1 of every published PNG.  #
+### --compare flags regressions between two results.  #
+### --check-backends renders the displays with the    #
+### svglib (layered) and the Pillow backend and fails #
+### if their frames differ by more than a tolerance.  #
+#######################################################
+
+# Usage:
+#   run_benchmark.py --runs 5 --out before.json        benchmark the current tree
+#   run_benchmark.py --latency 0.3 --errors 0.2        slow and unreliable upstream (retries with backoff!)
+#   run_benchmark.py --compare before.json after.json  median per stage, REGRESSION if slower by --threshold %
+#   run_benchmark.py --check-backends                  RENDERMODE "pillow" against "layered", exit code 1 if too different
+# The script needs the same libraries as cron_kindle-weather.py (pymysql, svglib, Pillow, ...), but no network,
+# no CCU and no database. Without a de_DE locale the weekdays are English (noted in the results).
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import hashlib
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import importlib.util
+from datetime import datetime, date
+from PIL import Image, ImageChops
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.dirname(HERE)
+SCRIPT = os.path.join(SERVER, "cron_kindle-weather.py")
+sys.path.insert(0, SERVER)
+sys.path.insert(0, HERE)
+
+import standins
+from stage_metrics import percentile	# nearest rank, same as metrics.json of the script
+
+NOW = "2020-09-15 15:45"	# clock of every run (fixtures are from this day), within the UBA check window of 16:00
+TZ = "Europe/Berlin"
+STAGES = ["startup", "backfill", "darksky", "homematic", "uba", "sql_write", "sql_read", "render", "total"]
+MIN_DELTA = 0.005			# seconds: smaller differences are never flagged, timer noise
+BLOCK = 8					# --check-backends: the largest difference is taken over blocks of 8x8 pixels. Per pixel
+							# it is always 255 somewhere, glyph edges of FreeType and libart never fall on the same pixel
+
+
+def per_source(text, name):
+	# "0.2" = all sources, "darksky=0.5,uba=0.1" = per source
+	result = {}
+	for item in text.split(","):
+		key, sep, value = item.partition("=")
+		if sep:
+			if key not in standins.SOURCES:
+				raise argparse.ArgumentTypeError("%s: unknown source %s, use %s" % (name, key, ", ".join(standins.SOURCES)))
+			result[key] = float(value)
+		else:
+			result.update((source, float(key)) for source in standins.SOURCES)
+	return result
+
+
+######################
+# Worker: one run in its own process
+def frozen_clock(now):
+	class FrozenDatetime(datetime):
+		@classmethod
+		def now(cls, tz=None):
+			return now
+
+		@classmethod
+		def today(cls):
+			return now
+
+	class FrozenDate(date):
+		@classmethod
+		def today(cls):
+			return now.date()
+
+	return FrozenDatetime, FrozenDate
+
+
+def timed(stages, name, func):
+	def wrapper(*args, **kwargs):
+		start = time.perf_counter()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+	return wrapper
+
+
+class Problems(logging.Handler):
+	# Warnings and errors of the run, they usually explain a slow stage (retries, missing data)
+
+	def __init__(self):
+		logging.Handler.__init__(self, logging.WARNING)
+		self.messages = []
+
+	def emit(self, record):
+		self.messages.append("%s %s" % (record.levelname, record.getMessage()))
+
+
+def worker(benchfile):
+	with open(benchfile, "r") as f:
+		bench = json.load(f)
+	started = time.perf_counter()
+	stages = {}
+	now = datetime.strptime(bench["now"], "%Y-%m-%d %H:%M")
+
+	standins.configure(bench["dbdir"])
+	import pymysql
+	pymysql.connect = standins.connect
+
+	import locale
+	setlocale = locale.setlocale
+	def fallback(category, name=None):
+		try:
+			return setlocale(category, name)
+		except locale.Error:
+			bench["locale"] = "%s not available, C.UTF-8 used" % name
+			return setlocale(category, "C.UTF-8")
+	locale.setlocale = fallback
+
+	import get_uba_airquality
+	get_uba_airquality.UBA_URL = "http://%s/api/air_data/v2" % bench["server"]
+	if bench["series"]:
+		get_uba_airquality.SERIES = "STATION_SERIES"
+
+	spec = importlib.util.spec_from_file_location("cron_kindle_weather", SCRIPT)
+	script = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(script)
+	locale.setlocale = setlocale
+	problems = Problems()
+	logging.getLogger("").addHandler(problems)
+
+	FrozenDatetime, FrozenDate = frozen_clock(now)
+	import sensor_aggregate
+	import sql_buffer
+	import timeseries
+	for module in (script, sensor_aggregate, sql_buffer, timeseries, get_uba_airquality):
+		if hasattr(module, "datetime"):
+			module.datetime = FrozenDatetime
+		if hasattr(module, "date"):
+			module.date = FrozenDate
+	stages["startup"] = time.perf_counter() - started
+
+	for name, stage in (("fetch_darksky", "darksky"), ("fetch_homematic", "homematic"), ("fetch_uba", "uba"),
+			("store_homematic", "sql_write"), ("evaluate_homematic", "sql_read"), ("render_displays", "render")):
+		setattr(script, name, timed(stages, stage, getattr(script, name)))
+	displays = {}
+	render = script.renderpool.render
+	def render_all(tasks):
+		results = render(tasks)
+		for name, seconds, error in results:
+			displays[name] = {"seconds": seconds, "error": error}
+		return results
+	script.renderpool.render = render_all
+
+	if bench["backfill"]:
+		db = script.sqlconnect()
+		try:
+			if script.series is not None:
+				timed(stages, "backfill", script.daily.backfill)(db, script.SERIES, timestamp="ts")
+			else:
+				timed(stages, "backfill", script.daily.backfill)(db, script.SQLTAB)
+		finally:
+			db.close()
+	timed(stages, "total", script.run_once)()
+
+	checksums = {}
+	for display in script.DISPLAYS:
+		try:
+			with open(display.output, "rb") as f:
+				data = f.read()
+			checksums[display.name] = "%s %d" % (hashlib.sha1(data).hexdigest(), len(data))
+		except OSError:
+			checksums[display.name] = None
+	result = {"stages": stages,
+			"displays": displays,
+			"rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			"rss_children_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+			"checksums": checksums,
+			"problems": problems.messages[:50],
+			"locale": bench.get("locale", "de_DE.UTF-8")}
+	with open(bench["result"], "w") as f:
+		json.dump(result, f, indent=1)
+
+
+######################
+# Benchmark: prepare, run the workers, summarize
+def prepare(args, workdir, server):
+	# Folder layout of a NAS installation in workdir, config for KINDLE_WEATHER_CONFIG, database template
+	path = os.path.join(workdir, "kindleweatherdisplay")
+	os.makedirs(os.path.join(path, "log"), exist_ok=True)
+	with open(os.path.join(SERVER, "displays.example.json"), "r") as f:
+		registry = json.load(f)
+	for entry in registry["displays"]:
+		entry["template"] = os.path.join(SERVER, entry["template"])
+		entry.pop("output", None)
+		if args.depth:
+			entry["depth"] = args.depth
+	with open(os.path.join(path, "displays.json"), "w") as f:
+		json.dump(registry, f, indent=1)
+
+	config = {"WEATHER_URL": "http://%s/forecast" % server.address,
+			"WEATHER_KEY": "benchmark",
+			"CITY": "Musterhausen",
+			"LATITUDE": "50.9",
+			"LONGTITUDE": "6.4",
+			"PATH": path,
+			"REGISTRY": os.path.join(path, "displays.json"),
+			"CACHEDIR": os.path.join(path, "cache"),
+			"SPOOLDIR": os.path.join(path, "spool"),
+			"SCHEDULE": os.path.join(path, "schedule.json"),
+			"SNAPSHOTS": os.path.join(path, "snapshots.json"),
+			"RENDERMODE": args.mode,
+			"RENDER_PROCESSES": args.processes,
+			"HOMEMATICIP": server.address,
+			"RUNMODE": "once",
+			"METRICS": os.path.join(workdir, "metrics") if args.metrics else None,
+			"SERIES": "SENSOR_SERIES" if args.series else None}
+	with open(os.path.join(workdir, "config.json"), "w") as f:
+		json.dump(config, f, indent=1)
+
+	# Datapoints of the fixture: outdoor device (see displays.example.json) outdoor, all others indoor
+	from homematic_state import iter_datapoints
+	kinds = ("ACTUAL_TEMPERATURE", "HUMIDITY", "RAIN_COUNTER", "WIND_DIR", "WIND_SPEED")
+	datapoints = [(datapointid, name.rsplit(".", 1)[-1], device != str(registry.get("outdoor")), value)
+		for device, name, datapointid, value in iter_datapoints(os.path.join(standins.FIXTURES, "state.xml"), kinds)]
+
+	start = time.perf_counter()
+	template = os.path.join(workdir, "db-template")
+	now = datetime.strptime(args.now, "%Y-%m-%d %H:%M")
+	rows = standins.preload(template, datapoints, now, args.days)
+	from sensor_aggregate import DailyAggregate
+	db = standins.connect(db="homematic_data")
+	try:
+		DailyAggregate("SENSOR_DAILY").backfill(db, "SENSOR_DATA")
+	finally:
+		db.close()
+	print("Database template: %d rows of %d datapoints over %d days in %.1f sec" % (rows, len(datapoints), args.days, time.perf_counter() - start))
+	if args.series:	# same as --migrate-series, without the pause between the batches
+		from timeseries import TimeSeries
+		start = time.perf_counter()
+		for name, source, table, columns in (("homematic_data", "SENSOR_DATA", "SENSOR_SERIES", ("sensor", "value", "datetime")),
+				("uba_data", "STATION_DATA", "STATION_SERIES", ("schadstoff", "messwert", "datetime"))):
+			db = standins.connect(db=name)
+			try:
+				TimeSeries(table).migrate(db, source, columns, pause=0)
+			finally:
+				db.close()
+		print("Migrated to SENSOR_SERIES/STATION_SERIES in %.1f sec" % (time.perf_counter() - start))
+	return path, template
+
+
+def run(args, workdir, path, template, server, n):
+	# One worker process on a fresh copy of the database
+	dbdir = os.path.join(workdir, "db")
+	shutil.rmtree(dbdir, ignore_errors=True)
+	shutil.copytree(template, dbdir)
+	cachedir = os.path.join(path, "cache")
+	if args.cold:
+		shutil.rmtree(cachedir, ignore_errors=True)	# templates, static layers, icon atlas
+	else:
+		shutil.rmtree(os.path.join(cachedir, "http"), ignore_errors=True)	# every run asks the stand-ins
+	if not args.keep_frames:
+		for entry in glob.glob(os.path.join(path, "weatherdata-*")):
+			os.unlink(entry)	# otherwise unchanged frames are not rendered again
+	shutil.rmtree(os.path.join(path, "spool"), ignore_errors=True)
+
+	bench = {"now": args.now, "dbdir": dbdir, "server": server.address, "backfill": args.backfill, "series": args.series,
+			"result": os.path.join(workdir, "result-%d.json" % n)}
+	benchfile = os.path.join(workdir, "bench.json")
+	with open(benchfile, "w") as f:
+		json.dump(bench, f)
+	env = dict(os.environ, KINDLE_WEATHER_CONFIG=os.path.join(workdir, "config.json"), TZ=TZ)
+	server.reset()
+	start = time.perf_counter()
+	process = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", benchfile], env=env)
+	wall = time.perf_counter() - start
+	if process.returncode != 0 or not os.path.exists(bench["result"]):
+		raise RuntimeError("run %d failed (exit code %d), see %s/log" % (n, process.returncode, path))
+	with open(bench["result"], "r") as f:
+		result = json.load(f)
+	result["wall"] = wall
+	result["http"] = server.reset()
+	return result
+
+
+def summarize(runs):
+	summary = {}
+	names = [stage for stage in STAGES if any(stage in result["stages"] for result in runs)]
+	names += sorted(set("render:%s" % name for result in runs for name in result["displays"]))
+	for name in names:
+		if name.startswith("render:"):
+			values = [result["displays"].get(name[7:], {}).get("seconds") for result in runs]
+		else:
+			values = [result["stages"].get(name) for result in runs]
+		values = [value for value in values if value is not None]
+		if values:
+			summary[name] = {"median": percentile(values, 50), "p95": percentile(values, 95), "min": min(values), "max": max(values)}
+	rss = [max(result["rss_kb"], result["rss_children_kb"]) for result in runs]
+	summary["rss_kb"] = {"median": percentile(rss, 50), "p95": percentile(rss, 95), "min": min(rss), "max": max(rss)}
+	return summary
+
+
+def checksums(runs):
+	# Per display: the checksum if it was the same in every run, else "unstable"
+	result = {}
+	for name in sorted(set(name for run in runs for name in run["checksums"])):
+		sums = set(run["checksums"].get(name) for run in runs)
+		result[name] = sums.pop() if len(sums) == 1 else "unstable"
+	return result
+
+
+def report(results):
+	print("\n%-22s %10s %10s %10s %10s" % ("stage", "median", "p95", "min", "max"))
+	for name, stats in results["summary"].items():
+		if name == "rss_kb":
+			print("%-22s %9.0fM %9.0fM %9.0fM %9.0fM" % ("peak RSS", stats["median"] / 1024.0, stats["p95"] / 1024.0, stats["min"] / 1024.0, stats["max"] / 1024.0))
+		else:
+			print("%-22s %9.1fms %9.1fms %9.1fms %9.1fms" % (name, stats["median"] * 1000, stats["p95"] * 1000, stats["min"] * 1000, stats["max"] * 1000))
+	print("")
+	for name, checksum in results["checksums"].items():
+		print("frame %-16s %s" % (name, checksum))
+	problems = sorted(set(message for run in results["runs"] for message in run["problems"]))
+	for message in problems[:20]:
+		print("log   %s" % message)
+
+
+def benchmark(args):
+	workdir = args.workdir or tempfile.mkdtemp(prefix="kindle-benchmark-")
+	server = standins.ReplayServer(latency=args.latency, errors=args.errors).start()
+	try:
+		path, template = prepare(args, workdir, server)
+		runs = []
+		for n in range(args.warmup + args.runs):
+			result = run(args, workdir, path, template, server, n)
+			label = "warmup" if n < args.warmup else "run %d" % (n - args.warmup + 1)
+			print("%-8s %6.0f ms total, %6.0f ms process" % (label, result["stages"]["total"] * 1000, result["wall"] * 1000))
+			if n >= args.warmup:
+				runs.append(result)
+	finally:
+		server.stop()
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	results = {"created": datetime.now().isoformat(timespec="seconds"),
+			"host": platform.node(),
+			"python": platform.python_version(),
+			"options": dict((key, value) for key, value in vars(args).items() if key not in ("compare", "worker", "out", "workdir", "threshold")),
+			"summary": summarize(runs),
+			"checksums": checksums(runs),
+			"locale": runs[0]["locale"] if runs else None,
+			"runs": runs}
+	report(results)
+	if args.out:
+		with open(args.out, "w") as f:
+			json.dump(results, f, indent=1)
+		print("\nResults written to %s" % args.out)
+
+
+######################
+# Compare two results
+def compare(old, new, threshold):
+	# Returns the number of regressions
+	with open(old, "r") as f:
+		before = json.load(f)
+	with open(new, "r") as f:
+		after = json.load(f)
+	regressions = 0
+	print("%-22s %10s %10s %8s" % ("median", os.path.basename(old)[:10], os.path.basename(new)[:10], "change"))
+	for name in before["summary"]:
+		if name not in after["summary"]:
+			continue
+		a = before["summary"][name]["median"]
+		b = after["summary"][name]["median"]
+		change = (b - a) * 100.0 / a if a else 0.0
+		slower = b > a * (1 + threshold / 100.0) and (name == "rss_kb" or b - a > MIN_DELTA)
+		regressions += slower
+		if name == "rss_kb":
+			print("%-22s %9.0fM %9.0fM %+7.1f%%%s" % ("peak RSS", a / 1024.0, b / 1024.0, change, "  REGRESSION" if slower else ""))
+		else:
+			print("%-22s %8.1fms %8.1fms %+7.1f%%%s" % (name, a * 1000, b * 1000, change, "  REGRESSION" if slower else ""))
+	for name in sorted(set(before["checksums"]) | set(after["checksums"])):
+		if before["checksums"].get(name) != after["checksums"].get(name):
+			print("frame %s changed: %s -> %s" % (name, before["checksums"].get(name), after["checksums"].get(name)))
+	if before.get("options") != after.get("options"):
+		print("note: different options, %s -> %s" % (before.get("options"), after.get("options")))
+	return regressions
+
+
+######################
+# Pillow against svglib
+def frame_difference(a, b):
+	# (mean, max over BLOCK x BLOCK blocks) of the absolute difference of two frames, in gray levels
+	a = Image.open(a).convert("L")
+	b = Image.open(b).convert("L")
+	if a.size != b.size:
+		return (255.0, 255)
+	diff = ImageChops.difference(a, b)
+	histogram = diff.histogram()
+	mean = sum(level * count for level, count in enumerate(histogram)) / float(sum(histogram))
+	return (mean, diff.reduce(BLOCK).getextrema()[1])
+
+def check_backends(args):
+	# Same fixtures, same clock: every display rendered with RENDERMODE "layered" and "pillow" (8 bit, as
+	# dithering would spread the differences). Returns the number of displays over --mean-tolerance/--block-tolerance
+	workdir = args.workdir or tempfile.mkdtemp(prefix="kindle-backends-")
+	frames = {}
+	server = standins.ReplayServer().start()
+	try:
+		for mode in ("layered", "pillow"):
+			options = argparse.Namespace(**dict(vars(args), mode=mode, depth=8, keep_frames=False, cold=False))
+			path, template = prepare(options, os.path.join(workdir, mode), server)
+			run(options, os.path.join(workdir, mode), path, template, server, 0)
+			with open(os.path.join(path, "displays.json"), "r") as f:
+				names = [entry["name"] for entry in json.load(f)["displays"]]
+			frames[mode] = dict((name, os.path.join(path, "weatherdata-%s.png" % name)) for name in names
+				if os.path.exists(os.path.join(path, "weatherdata-%s.png" % name)))	# default output, see prepare()
+		failures = 0
+		print("%-16s %10s %10s" % ("display", "mean", "max %dx%d" % (BLOCK, BLOCK)))
+		for name in sorted(frames["layered"]):
+			if name not in frames["pillow"]:
+				print("%-16s not rendered with pillow  FAIL" % name)
+				failures += 1
+				continue
+			mean, block = frame_difference(frames["layered"][name], frames["pillow"][name])
+			fail = mean > args.mean_tolerance or block > args.block_tolerance
+			failures += fail
+			print("%-16s %10.2f %10d%s" % (name, mean, block, "  FAIL" if fail else ""))
+		print("\ntolerance: mean %.2f, max %d gray levels" % (args.mean_tolerance, args.block_tolerance))
+	finally:
+		server.stop()
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+	return failures
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Offline benchmark of cron_kindle-weather.py with recorded fixtures and local stand-ins")
+	parser.add_argument("--runs", type=int, default=5, help="measured runs (default 5)")
+	parser.add_argument("--warmup", type=int, default=1, help="runs before, not measured, fill the render caches (default 1)")
+	parser.add_argument("--cold", action="store_true", help="empty CACHEDIR before every run (templates, static layers, icons)")
+	parser.add_argument("--keep-frames", action="store_true", help="keep the published frames, unchanged displays are then skipped")
+	parser.add_argument("--latency", type=lambda text: per_source(text, "--latency"), default={}, help="seconds per request, e.g. 0.2 or darksky=0.5,uba=0.1")
+	parser.add_argument("--errors", type=lambda text: per_source(text, "--errors"), default={}, help="share of requests failing with HTTP 500, e.g. 0.1 or uba=0.5")
+	parser.add_argument("--days", type=int, default=90, help="days of synthetic SENSOR_DATA (default 90)")
+	parser.add_argument("--backfill", action="store_true", help="also time --backfill-aggregates over the whole history")
+	parser.add_argument("--series", action="store_true", help="typed storage (SERIES) instead of SENSOR_DATA/STATION_DATA, migrated in the template")
+	parser.add_argument("--mode", default="full", choices=["full", "layered", "pillow"], help="RENDERMODE (default full)")
+	parser.add_argument("--processes", type=int, default=1, help="RENDER_PROCESSES (default 1)")
+	parser.add_argument("--depth", type=int, choices=[4, 8], help="DEPTH of all displays (default: as in displays.json)")
+	parser.add_argument("--metrics", action="store_true", help="enable METRICS of the script (e.g. to measure its overhead), kept in WORKDIR/metrics")
+	parser.add_argument("--now", default=NOW, help="clock of the runs, YYYY-mm-dd HH:MM (default %s)" % NOW)
+	parser.add_argument("--workdir", help="keep the installation, database and results here (default: temporary)")
+	parser.add_argument("--out", help="write results as JSON")
+	parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results")
+	parser.add_argument("--threshold", type=float, default=10, help="--compare: percent slower that counts as regression (default 10)")
+	parser.add_argument("--check-backends", action="store_true", help="render with RENDERMODE layered and pillow and compare the frames")
+	parser.add_argument("--mean-tolerance", type=float, default=5.0, help="--check-backends: mean difference in gray levels (default 5)")
+	parser.add_argument("--block-tolerance", type=int, default=128, help="--check-backends: largest difference of a %dx%d block (default 128)" % (BLOCK, BLOCK))
+	parser.add_argument("--worker", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.worker:
+		worker(args.worker)
+	elif args.compare:
+		sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+	elif args.check_backends:
+		sys.exit(1 if check_backends(args) else 0)
+	else:
+		benchmark(args)
+
+if __name__ == "__main__":
+	main()
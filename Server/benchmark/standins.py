@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+
+#######################################################
+### Local stand-ins for the benchmark                 #
+### Used by: benchmark/run_benchmark.py               #
+###                                                   #
+### ReplayServer answers the Dark Sky, Homematic and  #
+### UBA requests with the recorded fixtures, with an  #
+### adjustable latency and error rate per source.     #
+### connect() replaces pymysql.connect(): the MySQL   #
+### statements of the scripts are translated to       #
+### SQLite, one file per database, rows as dicts like #
+### pymysql's DictCursor. preload() fills it with     #
+### months of synthetic SENSOR_DATA.                  #
+#######################################################
+
+import os
+import re
+import math
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+import urllib.parse
+from datetime import datetime, date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SOURCES = ("darksky", "homematic", "uba")
+
+# MySQL -> SQLite, applied in this order
+DIALECT = [(re.compile(r'\bINSERT\s+IGNORE\s+INTO\b', re.I), "INSERT OR IGNORE INTO"),
+		(re.compile(r'\bON\s+DUPLICATE\s+KEY\s+UPDATE\b', re.I), "ON CONFLICT DO UPDATE SET"),
+		(re.compile(r'\bVALUES\((\w+)\)', re.I), r"excluded.\1"),
+		(re.compile(r'\bGREATEST\(', re.I), "MAX("),
+		(re.compile(r'\bLEAST\(', re.I), "MIN("),
+		(re.compile(r'\bIF\(', re.I), "IIF(")]
+
+SENSOR_TABLE = """CREATE TABLE IF NOT EXISTS %s (
+	sensor VARCHAR(32) NOT NULL,
+	value VARCHAR(32),
+	datetime DATETIME NOT NULL
+)"""
+
+STATION_TABLE = """CREATE TABLE IF NOT EXISTS %s (
+	schadstoff VARCHAR(16) NOT NULL,
+	messwert VARCHAR(16),
+	datetime DATETIME NOT NULL
+)"""
+
+# MySQL returns DATETIME and DATE columns as Python objects, so does the stand-in
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode("ascii")))
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode("ascii")))
+
+_folder = None	# database files, see configure()
+
+
+#################
+# HTTP replay
+def source_of(path):
+	# Request path -> (source, fixture file) or (None, None)
+	url = urllib.parse.urlsplit(path)
+	if url.path.startswith("/forecast/"):
+		return ("darksky", "darksky.json")
+	if url.path == "/addons/xmlapi/state.cgi":
+		return ("homematic", "state.xml")
+	if url.path.endswith("/airquality/csv"):
+		station = urllib.parse.parse_qs(url.query).get("station", [""])[0]
+		return ("uba", "uba-%s.csv" % re.sub(r'[^0-9A-Za-z]', "", station))
+	return (None, None)
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"
+	types = {".json": "application/json", ".xml": "text/xml", ".csv": "text/csv; charset=utf-8"}
+
+	def do_GET(self):
+		server = self.server
+		source, fixture = source_of(self.path)
+		path = os.path.join(server.fixtures, fixture) if fixture else None
+		if path is None or not os.path.exists(path):
+			return self.answer(source, 404, b"not found")
+		time.sleep(server.latency.get(source, 0))
+		if server.failing(source):
+			return self.answer(source, 500, b"stand-in error")
+		with open(path, "rb") as f:
+			body = f.read()
+		etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+		if self.headers.get("If-None-Match") == etag:
+			return self.answer(source, 304, b"", {"ETag": etag})
+		self.answer(source, 200, body, {"ETag": etag, "Content-Type": self.types.get(os.path.splitext(path)[1], "application/octet-stream")})
+
+	def answer(self, source, status, body, headers=None):
+		self.send_response(status)
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if status != 304:
+			self.wfile.write(body)
+		self.server.count(source or "other", status, len(body))
+
+	def log_message(self, format, *args):
+		pass	# quiet, counted instead
+
+
+class ReplayServer(ThreadingHTTPServer):
+	# Replays the fixtures on 127.0.0.1, port 0 = any free port
+
+	daemon_threads = True
+
+	def __init__(self, port=0, latency=None, errors=None, fixtures=FIXTURES, seed=1):
+		ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), ReplayHandler)
+		self.fixtures = fixtures
+		self.latency = dict(latency or {})	# source -> seconds per request
+		self.errors = dict(errors or {})	# source -> share of requests answered with HTTP 500 (0..1)
+		self.random = random.Random(seed)	# same error sequence in every benchmark
+		self.lock = threading.Lock()
+		self.thread = None
+		self.reset()
+
+	@property
+	def address(self):
+		return "127.0.0.1:%d" % self.server_address[1]
+
+	def failing(self, source):
+		with self.lock:
+			return self.random.random() < self.errors.get(source, 0)
+
+	def count(self, source, status, size):
+		with self.lock:
+			stats = self.stats.setdefault(source, {"requests": 0, "errors": 0, "not_modified": 0, "bytes": 0})
+			stats["requests"] += 1
+			stats["bytes"] += size
+			if status >= 400:
+				stats["errors"] += 1
+			elif status == 304:
+				stats["not_modified"] += 1
+
+	def reset(self):
+		# Returns the counters since the last reset
+		with self.lock:
+			stats, self.stats = getattr(self, "stats", {}), {}
+		return stats
+
+	def start(self):
+		self.thread = threading.Thread(target=self.serve_forever, name="replay", daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+
+#################
+# SQL stand-in
+def configure(folder):
+	global _folder
+	_folder = folder
+	os.makedirs(folder, exist_ok=True)
+
+
+def translate(sql, params=True):
+	for pattern, replacement in DIALECT:
+		sql = pattern.sub(replacement, sql)
+	if params:
+		sql = sql.replace("%s", "?")	# pymysql paramstyle "format" -> sqlite "qmark"
+	return sql
+
+
+class Cursor:
+	# pymysql cursor interface, every cursor class returns dicts (DictCursor, SSDictCursor)
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.cursor = connection.sqlite.cursor()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _row(self, row):
+		return None if row is None else dict(zip([column[0] for column in self.cursor.description], row))
+
+	def execute(self, query, args=None):
+		if args is None:
+			self.cursor.execute(translate(query, False))
+		else:
+			self.cursor.execute(translate(query), tuple(args) if isinstance(args, (list, tuple)) else (args,))
+		return self.cursor.rowcount
+
+	def executemany(self, query, args):
+		self.cursor.executemany(translate(query), [tuple(row) for row in args])
+		return self.cursor.rowcount
+
+	def fetchone(self):
+		return self._row(self.cursor.fetchone())
+
+	def fetchmany(self, size=None):
+		return [self._row(row) for row in self.cursor.fetchmany(size or self.cursor.arraysize)]
+
+	def fetchall(self):
+		return [self._row(row) for row in self.cursor.fetchall()]
+
+	def __iter__(self):
+		for row in self.cursor:
+			yield self._row(row)
+
+	@property
+	def rowcount(self):
+		return self.cursor.rowcount
+
+	@property
+	def lastrowid(self):
+		return self.cursor.lastrowid
+
+	def close(self):
+		self.cursor.close()
+
+
+class Connection:
+
+	def __init__(self, path):
+		# Used by the fetch threads and the main thread (UbaClient), never at the same time
+		self.sqlite = sqlite3.connect(path, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+	def cursor(self, cursor=None):
+		return Cursor(self)
+
+	def commit(self):
+		self.sqlite.commit()
+
+	def rollback(self):
+		self.sqlite.rollback()
+
+	def ping(self, reconnect=True):
+		return True
+
+	def close(self):
+		self.sqlite.close()
+
+
+def connect(host=None, port=None, user=None, password=None, db=None, charset=None, cursorclass=None, **kwargs):
+	# Same arguments as pymysql.connect(), only db matters: one SQLite file per database in the configured folder
+	if _folder is None:
+		raise RuntimeError("SQL stand-in not configured, call standins.configure(folder) first")
+	return Connection(os.path.join(_folder, "%s.sqlite" % db))
+
+
+#################
+# Synthetic history
+def reading(kind, indoor, when, state, rnd):
+	# One plausible value of a datapoint type at a given time, state keeps counters between calls
+	hour = when.hour + when.minute / 60.0
+	season = math.cos((when.timetuple().tm_yday - 200) / 365.0 * 2 * math.pi)	# 1 in July, -1 in January
+	if kind == "ACTUAL_TEMPERATURE":
+		if indoor:
+			return "%.1f" % (21 + 1.5 * math.sin((hour - 14) / 24.0 * 2 * math.pi) + rnd.uniform(-0.3, 0.3))
+		return "%.1f" % (10 + 8 * season + 6 * math.sin((hour - 9) / 24.0 * 2 * math.pi) + rnd.uniform(-1, 1))
+	if kind == "HUMIDITY":
+		if indoor:
+			return "%d" % max(30, min(70, 48 + rnd.uniform(-4, 4)))
+		return "%d" % max(20, min(99, 60 - 15 * math.sin((hour - 9) / 24.0 * 2 * math.pi) + rnd.uniform(-5, 5)))
+	if kind == "RAIN_COUNTER":
+		return "%.1f" % next(state["counter"])
+	if kind == "WIND_DIR":
+		state["dir"] = (state.get("dir", 240) + rnd.uniform(-20, 20)) % 360
+		return "%d" % state["dir"]
+	if kind == "WIND_SPEED":
+		return "%.1f" % max(0, rnd.gauss(9, 5))
+	return "%.1f" % rnd.random()
+
+
+def preload(folder, datapoints, now, days=90, interval=300, sensortab="SENSOR_DATA", stationtab="STATION_DATA",
+		sensordb="homematic_data", stationdb="uba_data", seed=1):
+	# datapoints: [(datapoint ise_id, type like "ACTUAL_TEMPERATURE", indoor, current value), ...]
+	# Fills SENSOR_DATA with one reading per datapoint every "interval" seconds for "days" days before "now",
+	# STATION_DATA with a value per pollutant every 3 hours. Returns the number of sensor rows.
+	configure(folder)
+	rnd = random.Random(seed)
+	start = now - timedelta(days=days)
+	steps = int((now - start).total_seconds() // interval)
+	db = connect(db=sensordb)
+	count = 0
+	try:
+		cursor = db.cursor()
+		cursor.execute(SENSOR_TABLE % sensortab)
+		states = dict((datapoint, {}) for datapoint, kind, indoor, current in datapoints)
+		for datapoint, kind, indoor, current in datapoints:
+			if kind == "RAIN_COUNTER":	# rain showers, counted back from the current value of the fixture
+				steps_mm = [rnd.choice([0.3, 0.3, 0.6, 1.2]) if rnd.random() < 0.01 else 0.0 for n in range(steps)]
+				counter = float(current)
+				series = []
+				for mm in reversed(steps_mm):
+					series.append(counter)
+					counter = max(0.0, counter - mm)	# 0 = counter was reset (battery change)
+				states[datapoint]["counter"] = iter(reversed(series))
+		batch = []
+		for n in range(steps):
+			when = start + timedelta(seconds=n * interval)
+			stamp = when.strftime("%Y-%m-%d %H:%M:%S")
+			for datapoint, kind, indoor, current in datapoints:
+				batch.append((str(datapoint), reading(kind, indoor, when, states[datapoint], rnd), stamp))
+			if len(batch) >= 20000:
+				cursor.executemany("INSERT INTO %s (sensor, value, datetime) VALUES (%%s, %%s, %%s)" % sensortab, batch)
+				count += len(batch)
+				batch = []
+		if batch:
+			cursor.executemany("INSERT INTO %s (sensor, value, datetime) VALUES (%%s, %%s, %%s)" % sensortab, batch)
+			count += len(batch)
+		db.commit()
+	finally:
+		db.close()
+
+	db = connect(db=stationdb)
+	try:
+		cursor = db.cursor()
+		cursor.execute(STATION_TABLE % stationtab)
+		rows = []
+		for n in range(days * 8):
+			stamp = (start + timedelta(hours=3 * n)).strftime("%Y-%m-%d %H:%M:%S")
+			rows.extend([("PM10", "%d" % rnd.uniform(5, 45), stamp), ("O3", "%d" % rnd.uniform(20, 140), stamp),
+				("NO2", "%d" % rnd.uniform(5, 60), stamp), ("LQI", "%d" % rnd.choice([3, 4, 4, 5, 5]), stamp)])
+		cursor.executemany("INSERT INTO %s (schadstoff, messwert, datetime) VALUES (%%s, %%s, %%s)" % stationtab, rows)
+		db.commit()
+	finally:
+		db.close()
+	return count
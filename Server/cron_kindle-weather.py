@@ -6,40 +6,70 @@
 ### Improvements:									  #
 ### - adapted for Synology NAS with pyMySQL, Python3  #
 ### - modified to use SvgLib+ReportLab to create PNG  #
-### - split and simplification of SQL data table      # 
-### - further paramterisation of script               # 
+### - split and simplification of SQL data table      #
+### - further paramterisation of script               #
 ### - bugfix for undefined variable "timestamp"       #
 ### - compatible with Kindle PaperWhite 2 (758 x 1024)#
-###   and Kindle Touch (600 x 800)                    #
+###   and Kindle Touch (600 x 800), one SVG scaled    #
 ### - added Germany UBA air quality station data      #
 ### - Changed SVG Font to Helvetica                   #
+### - resident daemon mode (--daemon), see RUNMODE    #
+### - any number of displays (displays.json), which   #
+###   are rendered in parallel, see REGISTRY          #
+### - timings per stage as Prometheus textfile and    #
+###   p50/p95 in metrics.json, see METRICS            #
+### - typed time series with rollups, see SERIES      #
+### - sync service for the Kindles, see SYNC_PORT     #
+### - wakeup interval advised by the server, see      #
+###   SCHEDULE                                        #
+### - frames rendered ahead of the Kindle wakeups,    #
+###   see PRERENDER                                   #
+### - last good data of each source, rendered without #
+###   waiting for the network, see SNAPSHOTS          #
 ###													  #
-### ToDo: hardcoded for 3 devices only +no air quality#
-###       hardcoded humidity value for device WHZ     #
+### ToDo: no air quality (AQ/QL/QH hardcoded)         #
 #######################################################
 
 # Weather Underground API Changes, see:
 # https://apicommunity.wunderground.com/weatherapi/topics/weather-underground-api-changes
 
+# Usage:
+#   cron_kindle-weather.py            one run (fetch, render, exit) or resident daemon, depending on RUNMODE
+#   cron_kindle-weather.py --once     one run, e.g. for the existing crontab entry
+#   cron_kindle-weather.py --daemon   resident daemon: libraries, templates and DB connection stay warm,
+#                                     each source is fetched on its own interval, displays are only re-rendered
+#                                     when one of the inputs has changed
+#   cron_kindle-weather.py --render   render the displays from the last good data (SNAPSHOTS) only, no network
+#   cron_kindle-weather.py --serve    only the sync service for the Kindles (SYNC_PORT), next to the cron runs
+#   cron_kindle-weather.py --migrate-series   copy SQLTAB (and the UBA STATION_DATA) into the typed SERIES
+#                                     tables, in batches while cron keeps running, can be repeated
+
 ##########################
 # Load necessary libraries
 import os
+import time
+import random
 import logging
-#import time
-#import datetime
-from datetime import datetime, date, time
+import argparse
+from datetime import datetime, timedelta
+from datetime import time as daytime
 import locale
-import codecs
-import urllib.request
 import json
-import untangle # this library needs to be installed separately on Synology NAS
 import pymysql # this library needs to be installed separately on Synology NAS: via SSH with 'pip3 install pymysql'
-from svglib.svglib import svg2rlg # this library needs to be installed separately on Synology NAS: via SSH with 'pip3 install svglib' 
-from reportlab.graphics import renderPM # this library is automatically installed when installing svglib
-from PIL import Image # this library is automatically installed when installing svglib 
-# To use DejaVuSans Font specified in SVG, install .TTF file in: /volume1/@appstore/py3k/usr/local/lib/python3.8/site-packages/reportlab/fonts/ via SSH. Also chmod 644 DejaVuSans.ttf
-# As the folder font couldn't be found anymore after DS update, switched to use Helvetica font instead in SVG file
-from get_uba_airquality import get_uba_airquality # Include Air Quality code
+from get_uba_airquality import UbaClient # Include Air Quality code
+from render_pool import RenderTask, RenderPool # Displays rendered in parallel: compiled SVG templates, in-memory SVG -> PNG, atomic publish
+from fetch_pool import Deadline, retry, fetch_all, urlopen # Concurrent fetching, exponential backoff, overall deadline
+from http_cache import HttpCache # On-disk HTTP response cache with TTL, revalidation and stale fallback
+from sql_buffer import WriteBuffer # Batched SQL inserts in one transaction, spool file if DB is not available
+from sensor_aggregate import DailyAggregate # Daily Min/Max per sensor, updated on insert
+from homematic_state import state_url, iter_datapoints # One request for all Homematic devices, streamed XML
+from display_registry import load_registry, legacy_registry, registry_devices # Displays with template, resolution and indoor sensors
+from stage_metrics import metrics # Timings and counters per stage (fetch, SQL, fill, rasterize, encode, publish)
+from timeseries import TimeSeries # Typed sensor values with 5-min/hourly/daily rollups and retention
+from sync_server import SyncServer # Frame, script version, actions and log upload of a Kindle in one request
+from wake_schedule import HORIZON, WakeSchedule, WakeAdvisor, run_grid, repeat # Next source updates and render times -> wakeup interval per Kindle
+from render_ahead import RenderAhead # Daemon: frames of the next Kindle wakeups rendered ahead, kept in memory
+from snapshot_store import SnapshotStore # Last good data of each source with its fetch time, the displays are rendered from it
 
 ####################
 # German time format
@@ -57,15 +87,52 @@ LONGTITUDE = "..."
 
 PATH = "/volume1/web/kindleweatherdisplay" # Path to all files necessary for the script, placed in new folder "kindleweatherdisplay"
 LOG = "log/cron_kindle-weather.log"	# Create empty file in sub-directoy on server with this name
-SVG_FILE = "%s/cron_kindle_PW2-weather_preprocess.svg" % PATH  # using SVG for Kindle Paper White2 Screen size
-SVG_FILE2 = "%s/cron_kindle_touch-weather_preprocess.svg" % PATH # using SVG for Kindle Touch Screen size
-SVG_OUTPUT = "%s/cron_kindle-weather_output.svg" % PATH
-TMP_OUTPUT = "%s/cron_kindle-weather_tmp.png" % PATH
+REGISTRY = "%s/displays.json" % PATH	# Displays with template, resolution, indoor sensors and output PNG, see displays.example.json
+										# If this file does not exist, DEVICES, ROOMS, SCREENS and SVG_FILE below are used
+SVG_FILE = "%s/cron_kindle_PW2-weather_preprocess.svg" % PATH  # using SVG for Kindle Paper White2 Screen size, scaled for other Kindles
+RENDERMODE = "full"			# "full" = render complete SVG every run, "layered" = static layer of the SVG is rasterized only once and cached in CACHEDIR
+							# "pillow" = like "layered", but texts and icons are drawn directly with Pillow (fastest, needs Pillow 10.1 or newer)
+PILLOW_FONTS = None			# RENDERMODE "pillow": None = Helvetica of reportlab (same as svglib), or own TrueType fonts, e.g.
+							# {"normal": "%s/fonts/DejaVuSans.ttf" % PATH, "bold": "%s/fonts/DejaVuSans-Bold.ttf" % PATH}
+CACHEDIR = "%s/cache" % PATH	# Cache folder, is created automatically
+RENDER_PROCESSES = 0		# Displays are rendered in parallel: 0 = one process per CPU core, 1 = one after the other
+PARTIAL_TILES = 6			# Changed regions are also published as up to 6 tiles for a partial update on the Kindle, 0 = off (needs NumPy)
+DEPTH = 8					# 8 = 8-bit PNG with 256 gray levels, 4 = quantized to the 16 levels of the Kindle panel, 4-bit PNG (needs NumPy)
+DITHER = "none"				# DEPTH 4: "none", "ordered" (4x4 pattern) or "floyd-steinberg" (error diffusion, smoother gradients)
+PNG_COMPRESS = "size"		# "size" = smallest PNG, "speed" = fastest encoding. DEPTH, DITHER and PNG_COMPRESS can be set per display in REGISTRY
+SYNC_PORT = None			# Sync service for SYNCMODE="server" in weatherscript.sh, e.g. 8081: frame (or 304), script version,
+							# pending actions and log upload in one keep-alive request. Runs in the daemon or with --serve, None = off
+SYNC_ACTIONS = "%s/actions" % PATH	# Pending actions per Kindle: file named like the Kindle hostname, one action per line
+									# (flash, reboot, debug), delivered with the next wakeup and then deleted
+SCHEDULE = "%s/schedule.json" % PATH	# Next updates of each source and render times, written each run. The sync service
+									# sends the Kindle its next wakeup (X-Suspend): just after the newest frame within
+									# the allowed age below, instead of the fixed F5INTWORKDAY/F5INTWEEKEND of weatherscript.sh
+RUN_INTERVAL = 600			# Seconds between the cron runs (*/10 in the crontab), not used by the daemon
+WAKE_WORKDAY = [([6, 7, 8, 14, 15, 16, 17, 18], 900),	# Allowed age of the shown data per hour (same as F5INTWORKDAY)
+			([9, 10, 11, 12, 13, 19, 20], 1800),
+			([21, 22, 23], 3600),
+			([0, 1, 2, 3, 4, 5], 21600)]
+WAKE_WEEKEND = [([7, 8, 9, 15, 16, 17, 18, 19], 900),	# Same as F5INTWEEKEND
+			([5, 6, 10, 11, 12, 13, 14, 20, 21], 1800),
+			([22, 23, 0, 1, 2, 3, 4], 3600)]
+QUIET_HOURS = {"workday": (0, 6), "weekend": None}	# No wakeup from - to (hour), e.g. WLAN off in the router
+WAKE_MIN = 120				# Shortest advised wakeup interval in seconds
+WAKE_MARGIN = 30			# Seconds after the expected publish time of a frame
+PRERENDER = 4				# Daemon with SYNC_PORT and SCHEDULE: frames rendered ahead of the advised Kindle wakeups, as of the
+							# wakeup time (TIME, hourly forecast from that hour on), at most this many kept in memory, 0 = off
+PRERENDER_AHEAD = 60		# Seconds before the wakeup
+PRERENDER_LATE = 120		# Seconds after the wakeup a frame rendered ahead is still served, later the published one
+SNAPSHOTS = "%s/snapshots.json" % PATH	# Last good data of each source (forecast, each Homematic device, air quality) with its
+									# fetch time. A source that fails keeps its last values instead of empty fields. None = in memory only
+STALE_AFTER = {"darksky": 7200,	# Seconds after which the data of a source are marked as old: "*" after the current value
+			"homematic": 1800,	# (TEXT, CT, BT, IDX) and the time of the oldest data in the footer ($AGE)
+			"uba": 25200}		# UBA: since the measurement hour, which is ~2 h old when fetched every 3 h (chkhour)
 
 HOMEMATICIP = "192.168.178.X"	# IP of Homematic CCU
-DEVICES = [...,...,...]		# DeviceID for Garten (Wettersensor), Wohnzimmer (Temp), DG-Whz (Temp); Pay attention to order, Max 3!
+DEVICES = [...,...,...]		# Without REGISTRY: DeviceID for Garten (Wettersensor), Wohnzimmer (Temp), DG-Whz (Temp); Pay attention to order!
 								# See "http://{YOUR-HOMEMATICIP}/addons/xmlapi/state.cgi?device_id={DEVICE}"
-ROOMS = ["Wohnzimmer", "DG-Whz"]	# Order corresponding to device #2 and #3 (Max 2!)
+ROOMS = ["Wohnzimmer", "DG-Whz"]	# Without REGISTRY: Order corresponding to device #2 and #3, template SVG_FILE
+SCREENS = [None, (600, 800)]		# Without REGISTRY: resolution per room, None = size of SVG_FILE (PaperWhite 2), (600, 800) = Kindle Touch
 
 SQLHOST = "localhost"
 SQLPORT = 3307				# Port must be specified as number not string
@@ -74,11 +141,68 @@ SQLPW = "..."
 SQLDB = "homematic_data"	# Name of database with the following two tables
 SQLTAB = "SENSOR_DATA"		# Table with sensor data in three rows: SENSOR, VALUE, DATETIME
 SQLTAB2 = "HMIP_SENSORS"    # Optional: Table with overview of associated meta-data in rows: RAUM, ID, BEZEICHNUNG, SENSORART, SHORTFORM, EINHEIT
+SQLTAB3 = "SENSOR_DAILY"	# Daily Min/Max/First/Last per sensor, is created and updated automatically (see sensor_aggregate.py)
+SPOOLDIR = "%s/spool" % PATH	# If the database is not available, data are kept here and written with the next successful run
+SERIES = None				# Typed storage instead of SQLTAB, e.g. "SENSOR_SERIES": values as DOUBLE, key (sensor, time), plus
+							# 5-minute, hourly and daily rollups (min/max/avg/last) in SERIES_5M/_1H/_1D, see timeseries.py.
+							# Existing data: once --migrate-series. None = text values in SQLTAB as before
+RETENTION = {"raw": 90, "5m": 730, "1h": 3650, "1d": None}	# SERIES: days kept per level (None = forever), old days are removed one per run
+MIGRATE_HOURS = 24			# --migrate-series: hours of SQLTAB copied per transaction
+
+RUNMODE = "once"			# "once" = fetch, render and exit (cron), "daemon" = keep running (same as --daemon)
+INTERVALS = {"darksky": 900,	# Daemon: refresh interval per source in seconds
+			"homematic": 300,	# all devices in one request
+			"uba": 0}			# 0 = at the UBA check hours (chkhour), see below
+JITTER = 0.1				# Daemon: random +-10% on each interval, so sources do not always fire together
+TIMEOUTS = {"darksky": 20,	# Timeout in seconds for one request per source
+			"homematic": 10,
+			"uba": 20}
+MAX_TRIES = 5				# Tries per source, with exponential backoff (2, 4, 8, ... sec) in between
+DEADLINE = 60				# Overall deadline in seconds for all sources, afterwards rendering continues with what has arrived
+CACHE_TTL = {"darksky": 900,	# HTTP response cache (in CACHEDIR/http): seconds a response is used without asking the server again
+			"uba": 86400}		# UBA CSV of a given hour does not change anymore
+CACHE_GRACE = 10800			# If the server fails, a cached response up to TTL + CACHE_GRACE seconds old is used instead
 
 LogWrt=0	# Deactivate logging =0, to activate =1. Caution, file increases contineously!
+METRICS = None				# Folder for timings and counters per stage, e.g. "%s/metrics" % PATH: kindle_weather.prom for the
+							# node_exporter textfile collector and metrics.json with p50/p95 per stage. None = off (no overhead)
+METRICS_RUNS = 100			# metrics.json: p50/p95 over this many last runs, the file does not grow beyond that
 # End of UserInput
 ###################################################################################################
 
+# Optional: own values for any of the variables above in a JSON file, e.g. {"SQLPW": "...", "LogWrt": 1}
+# Used by benchmark/run_benchmark.py to point all sources to local stand-ins
+CONFIG = os.environ.get("KINDLE_WEATHER_CONFIG")
+if CONFIG:
+	with open(CONFIG, "r") as f:
+		for key, value in json.load(f).items():
+			if key not in globals():
+				raise ValueError("%s: unknown variable %s" % (CONFIG, key))
+			globals()[key] = value
+
+chkhour = [1, 4, 7, 10, 13, 16, 19, 22]	# UBA check hours, see get_uba_airquality.py
+
+httpcache = HttpCache("%s/http" % CACHEDIR, CACHE_GRACE)
+daily = DailyAggregate(SQLTAB3)
+if SERIES:
+	series = TimeSeries(SERIES, RETENTION)
+	def write_series(cursor, rows):
+		daily.update(cursor, series.write(cursor, rows))	# only new readings, a replayed one is not counted twice
+	sqlbuffer = WriteBuffer(SERIES, ["sensor", "value", "ts"], "%s/%s.jsonl" % (SPOOLDIR, SERIES), write_series, insert=False)
+else:
+	series = None
+	sqlbuffer = WriteBuffer(SQLTAB, ["sensor", "value", "datetime"], "%s/%s.jsonl" % (SPOOLDIR, SQLTAB), daily.update)
+uba = UbaClient(httpcache, CACHE_TTL["uba"], SPOOLDIR)
+snapshots = SnapshotStore(SNAPSHOTS)
+
+if os.path.exists(REGISTRY):
+	OUTDOOR, DISPLAYS = load_registry(REGISTRY, PATH)
+else:
+	OUTDOOR, DISPLAYS = legacy_registry(DEVICES, ROOMS, SVG_FILE, SCREENS, PATH)
+HM_DEVICES = registry_devices(OUTDOOR, DISPLAYS)	# outdoor sensor and all indoor sensors, each requested once
+renderpool = RenderPool(RENDER_PROCESSES)
+metrics.configure(METRICS, METRICS_RUNS)	# before the render workers are started, they inherit the setting
+
 
 #################
 # Logging
@@ -93,63 +217,69 @@ console = logging.StreamHandler()
 console.setLevel(logging.ERROR)
 logging.getLogger('').addHandler(console)
 logger = logging.getLogger(__name__)
-if LogWrt==1:
-	logging.info("SCRIPT START")
 
 
 ######################
 # Functions definition
-def _exec(cmd):
-	rc = os.system(cmd)
-	if (rc != 0):
-		print("`%s` failed with error %d" % (cmd, rc))
-		exit(rc)
-
-def asInteger(output, id, data, addi):
-	output = output.replace(id, str('%.0f%s' % (float(data), addi)))
-	return(output)
+def asInteger(values, id, data, addi):
+	values[id] = str('%.0f%s' % (float(data), addi))
 
-def asIntegerTenOrMinusTen(output, id, data, addi):
+def asIntegerTenOrMinusTen(values, id, data, addi):
 	if float(data) <= -10 or float(data) >= 10:
-		output = output.replace(id, str('%.0f%s' % (float(data), addi)))
+		values[id] = str('%.0f%s' % (float(data), addi))
 	else:
-		output = output.replace(id, str('%s%s' % (data, addi)))
-	return(output)
-
-def replace_daily(output, id, dataday, dataicon, datalow, datahigh, datawind, datarain, datarainint):
-	output = output.replace("$D" + id, str(dataday + "."))
-	output = output.replace("$I" + id, str(dataicon))
-	output = output.replace("$L" + id, str('%.0f%s' % (float(datalow), "°")))
-	output = output.replace("$H" + id, str('%.0f%s' % (float(datahigh), "°")))
-	output = output.replace("$W" + id, str('%.0f' % (float(datawind))))
-	#output = output.replace("$P" + id, str('%.2d' % (float(datarain))))
-	output = output.replace("$P" + id, str('%.0f' % (float(datarain))))
-	output = output.replace("$M" + id, str('%.1f' % (float(datarainint))))
-	return(output)
-
-def replace_hourly(output, id, datatime, dataicon, datarain, datatemp):
-	output = output.replace("$K" + id, str(datatime))
-	output = output.replace("$J" + id, str(dataicon))
-	output = output.replace("$T" + id, str('%.0f%s' % (float(datatemp), "°")))
+		values[id] = str('%s%s' % (data, addi))
+
+def replace_daily(values, id, dataday, dataicon, datalow, datahigh, datawind, datarain, datarainint):
+	values["D" + id] = str(dataday + ".")
+	values["I" + id] = str(dataicon)
+	values["L" + id] = str('%.0f%s' % (float(datalow), "°"))
+	values["H" + id] = str('%.0f%s' % (float(datahigh), "°"))
+	values["W" + id] = str('%.0f' % (float(datawind)))
+	#values["P" + id] = str('%.2d' % (float(datarain)))
+	values["P" + id] = str('%.0f' % (float(datarain)))
+	values["M" + id] = str('%.1f' % (float(datarainint)))
+
+def replace_hourly(values, id, datatime, dataicon, datarain, datatemp):
+	values["K" + id] = str(datatime)
+	values["J" + id] = str(dataicon)
+	values["T" + id] = str('%.0f%s' % (float(datatemp), "°"))
 	if datarain >= 30 or dataicon == "rain":
-		output = output.replace("$R" + id, str('%.0f%s' % (float(datarain), "%")))
+		values["R" + id] = str('%.0f%s' % (float(datarain), "%"))
 	else:
-		output = output.replace("$R" + id, str(""))
-	return(output)
-
-def sqlinsert(cursor, DEVICE, datapoint, datapointid, value):
-	#timestamp = datetime.datetime.now().strftime("%Y.%m.%d %H:%M") #Datum und Uhrzeit im Format JJJJ.MM.TT HH:MM
-	sql_query = "INSERT INTO %s (sensor, value, datetime) VALUES ('%s', '%s', CURRENT_TIMESTAMP)" % (SQLTAB, datapointid, value)
-	cursor.execute(sql_query)
-	db.commit()
-
-def sqlminmax(cursor, datapointid, sort, decimal): # Return formatted Min or Max value of a list with specified decimals 
-	sql_query = "SELECT value FROM %s WHERE sensor = %s AND DATE(datetime) = DATE(NOW()) ORDER BY value + 0 %s LIMIT 1" % (SQLTAB, datapointid, sort)
-	cursor.execute(sql_query)
-	for select in cursor.fetchall():
-		#return('%.%sf' % (float(select[0]), decimal))
-		return('%.{0}f'.format(decimal) % select["value"]) # SQL row labeled with "value" in table "sensor_data"
-		#return('{}:.{}f'.format(select["value"], decimal)) 
+		values["R" + id] = str("")
+
+def sqlconnect():
+	return pymysql.connect(
+		host=SQLHOST,
+		port=SQLPORT,
+		user=SQLUSER,
+		password=SQLPW,
+		db=SQLDB,
+		charset='utf8mb4',
+		cursorclass=pymysql.cursors.DictCursor)
+
+def sqlreconnect(db):
+	# Returns a working connection (the given one or a new one) or None if the DB is not available
+	try:
+		if db is None:
+			return sqlconnect()
+		db.ping(reconnect=True)	# Keep the connection warm, reconnect after MySQL wait_timeout
+		return db
+	except Exception as e:
+		logging.error("FAIL | no connection to database - %s" % (e))
+		return None
+
+def sqlminmax(cursor, datapointid, sort, decimal): # Return formatted Min or Max value of today with specified decimals
+	if cursor is None:
+		return None
+	select = daily.today(cursor, datapointid)	# Primary key lookup in SQLTAB3 instead of scanning SQLTAB
+	if select is None:
+		return None
+	if sort == "DESC":
+		return('%.{0}f'.format(decimal) % select["max_value"])
+	else:
+		return('%.{0}f'.format(decimal) % select["min_value"])
 
 def time_in_range(start, end, x):
     #Return true if x is in the range [start, end]
@@ -161,361 +291,716 @@ def time_in_range(start, end, x):
     else: #Over midnight
         return start <= x or x <= end
 
+def uba_write_due(nowtime):
+	# UBA data are fetched from the API (and written to the DB) only in the half hour around each check hour,
+	# otherwise the last values are read from the DB
+	for hour in chkhour:
+		if time_in_range(daytime(hour-1, 30, 0), daytime(hour, 30, 0), daytime(nowtime.hour, nowtime.minute)):
+			return True
+	return False
+
+def uba_next_slot(nowtime):
+	# Start of the next UBA check window (hour-1:30) after nowtime
+	for day in range(0, 2):
+		for hour in chkhour:
+			slot = datetime.combine(nowtime.date() + timedelta(days=day), daytime(hour-1, 30, 0))
+			if slot > nowtime:
+				return slot
+
+
 #####################
 # API-Query
 # https://api.darksky.net/forecast/...yourkey../..yourlat...,...yourlong...?&units=ca&lang=de
-tries = 0
-max_tries = 5
-while tries < max_tries:
-	try:
-		apidata = urllib.request.urlopen(
-			"%s/%s/%s,%s?&units=ca&lang=de" %
-			(WEATHER_URL, WEATHER_KEY, LATITUDE, LONGTITUDE))
-		json_apidata = apidata.read().decode('utf-8')
-		parsed_apidata = json.loads(json_apidata)
-		if LogWrt==1:
-			logging.info("OK | dark sky api quest successfully")
+def darksky_url():
+	return "%s/%s/%s,%s?&units=ca&lang=de" % (WEATHER_URL, WEATHER_KEY, LATITUDE, LONGTITUDE)
+
+@metrics.timed("darksky")
+def fetch_darksky(deadline):
+	url = darksky_url()
+	# From cache if younger than CACHE_TTL, raises after MAX_TRIES or at the deadline (if no stale response within CACHE_GRACE)
+	json_apidata = httpcache.get(url, CACHE_TTL["darksky"], TIMEOUTS["darksky"], MAX_TRIES, deadline, "dark sky api quest").decode('utf-8')
+	parsed_apidata = json.loads(json_apidata)
+	if LogWrt==1:
+		logging.info("OK | dark sky api quest successfully")
 
 
-		# Now
-		weatherdata_now_text = parsed_apidata['currently']['summary'][:20] + (parsed_apidata['currently']['summary'][20:] and '...')
-		weatherdata_now_icon = parsed_apidata['currently']['icon']
-		if LogWrt==1:
-			logging.info("- weatherdata_now | summary: %s" % (weatherdata_now_text.encode('utf-8')))
-			logging.info("- weatherdata_now | icon: %s" % (weatherdata_now_icon))
-
-
-		# Astronomie
-		astronomy_today_sunrise = datetime.fromtimestamp(int(parsed_apidata['daily']['data'][0]['sunriseTime'])).strftime("%H:%M")
-		astronomy_today_sunset = datetime.fromtimestamp(int(parsed_apidata['daily']['data'][0]['sunsetTime'])).strftime("%H:%M")
-		astronomy_today_moonphase = parsed_apidata['daily']['data'][0]['moonPhase']*100
-
-		if float(astronomy_today_moonphase) <= 2 or float(astronomy_today_moonphase) >= 98:
-			astronomy_today_moonphase_icon = "moon-0"
-		if float(astronomy_today_moonphase) >= 3 and float(astronomy_today_moonphase) <= 17:
-			astronomy_today_moonphase_icon = "moon-waxing-25"
-		if float(astronomy_today_moonphase) >= 18 and float(astronomy_today_moonphase) <= 32:
-			astronomy_today_moonphase_icon = "moon-waxing-50"
-		if float(astronomy_today_moonphase) >= 33 and float(astronomy_today_moonphase) <= 47:
-			astronomy_today_moonphase_icon = "moon-waxing-75"
-		if float(astronomy_today_moonphase) >= 48 and float(astronomy_today_moonphase) <= 52:
-			astronomy_today_moonphase_icon = "moon-100"
-		if float(astronomy_today_moonphase) >= 53 and float(astronomy_today_moonphase) <= 67:
-			astronomy_today_moonphase_icon = "moon-waning-75"
-		if float(astronomy_today_moonphase) >= 68 and float(astronomy_today_moonphase) <= 82:
-			astronomy_today_moonphase_icon = "moon-waning-50"
-		if float(astronomy_today_moonphase) >= 83 and float(astronomy_today_moonphase) <= 97:
-			astronomy_today_moonphase_icon = "moon-waning-25"
+	# Now
+	weatherdata_now_text = parsed_apidata['currently']['summary'][:20] + (parsed_apidata['currently']['summary'][20:] and '...')
+	weatherdata_now_icon = parsed_apidata['currently']['icon']
+	if LogWrt==1:
+		logging.info("- weatherdata_now | summary: %s" % (weatherdata_now_text.encode('utf-8')))
+		logging.info("- weatherdata_now | icon: %s" % (weatherdata_now_icon))
+
+
+	# Astronomie
+	astronomy_today_sunrise = datetime.fromtimestamp(int(parsed_apidata['daily']['data'][0]['sunriseTime'])).strftime("%H:%M")
+	astronomy_today_sunset = datetime.fromtimestamp(int(parsed_apidata['daily']['data'][0]['sunsetTime'])).strftime("%H:%M")
+	astronomy_today_moonphase = parsed_apidata['daily']['data'][0]['moonPhase']*100
+
+	if float(astronomy_today_moonphase) <= 2 or float(astronomy_today_moonphase) >= 98:
+		astronomy_today_moonphase_icon = "moon-0"
+	if float(astronomy_today_moonphase) >= 3 and float(astronomy_today_moonphase) <= 17:
+		astronomy_today_moonphase_icon = "moon-waxing-25"
+	if float(astronomy_today_moonphase) >= 18 and float(astronomy_today_moonphase) <= 32:
+		astronomy_today_moonphase_icon = "moon-waxing-50"
+	if float(astronomy_today_moonphase) >= 33 and float(astronomy_today_moonphase) <= 47:
+		astronomy_today_moonphase_icon = "moon-waxing-75"
+	if float(astronomy_today_moonphase) >= 48 and float(astronomy_today_moonphase) <= 52:
+		astronomy_today_moonphase_icon = "moon-100"
+	if float(astronomy_today_moonphase) >= 53 and float(astronomy_today_moonphase) <= 67:
+		astronomy_today_moonphase_icon = "moon-waning-75"
+	if float(astronomy_today_moonphase) >= 68 and float(astronomy_today_moonphase) <= 82:
+		astronomy_today_moonphase_icon = "moon-waning-50"
+	if float(astronomy_today_moonphase) >= 83 and float(astronomy_today_moonphase) <= 97:
+		astronomy_today_moonphase_icon = "moon-waning-25"
 
+	if LogWrt==1:
+		logging.info("- astronomy_today | sunrise: %s, sunset %s" % (astronomy_today_sunrise, astronomy_today_sunset))
+		logging.info("- astronomy_today | moonphase_icon: %s, moonphase: %s%%" % (astronomy_today_moonphase_icon, astronomy_today_moonphase))
+
+
+	# Forecast Daily
+	weatherdata_forecast_date = []
+	weatherdata_forecast_weekday = []
+	weatherdata_forecast_icon = []
+	weatherdata_forecast_temphigh = []
+	weatherdata_forecast_templow = []
+	weatherdata_forecast_wind = []
+	weatherdata_forecast_rain = []
+	weatherdata_forecast_rainint= []
+	for i in range(0, 3):
+		weatherdata_forecast_date.append(datetime.fromtimestamp(int(parsed_apidata['daily']['data'][i]['time'])).strftime("%d.%m."))
+		weatherdata_forecast_weekday.append(datetime.fromtimestamp(int(parsed_apidata['daily']['data'][i]['time'])).strftime("%a"))
+		weatherdata_forecast_icon.append(parsed_apidata['daily']['data'][i]['icon'])
+		weatherdata_forecast_temphigh.append(parsed_apidata['daily']['data'][i]['temperatureHigh'])
+		weatherdata_forecast_templow.append(parsed_apidata['daily']['data'][i]['temperatureLow'])
+		weatherdata_forecast_wind.append(parsed_apidata['daily']['data'][i]['windGust'])
+		weatherdata_forecast_rain.append(parsed_apidata['daily']['data'][i]['precipProbability']*100)
+		weatherdata_forecast_rainint.append(parsed_apidata['daily']['data'][i]['precipIntensityMax'])
 		if LogWrt==1:
-			logging.info("- astronomy_today | sunrise: %s, sunset %s" % (astronomy_today_sunrise, astronomy_today_sunset))
-			logging.info("- astronomy_today | moonphase_icon: %s, moonphase: %s%%" % (astronomy_today_moonphase_icon, astronomy_today_moonphase))
-
-
-		# Forecast Daily
-		weatherdata_forecast_date = []
-		weatherdata_forecast_weekday = []
-		weatherdata_forecast_icon = []
-		weatherdata_forecast_temphigh = []
-		weatherdata_forecast_templow = []
-		weatherdata_forecast_wind = []
-		weatherdata_forecast_rain = []
-		weatherdata_forecast_rainint= []
-		for i in range(0, 3):
-			weatherdata_forecast_date.append(datetime.fromtimestamp(int(parsed_apidata['daily']['data'][i]['time'])).strftime("%d.%m."))
-			weatherdata_forecast_weekday.append(datetime.fromtimestamp(int(parsed_apidata['daily']['data'][i]['time'])).strftime("%a"))
-			weatherdata_forecast_icon.append(parsed_apidata['daily']['data'][i]['icon'])
-			weatherdata_forecast_temphigh.append(parsed_apidata['daily']['data'][i]['temperatureHigh'])
-			weatherdata_forecast_templow.append(parsed_apidata['daily']['data'][i]['temperatureLow'])
-			weatherdata_forecast_wind.append(parsed_apidata['daily']['data'][i]['windGust'])
-			weatherdata_forecast_rain.append(parsed_apidata['daily']['data'][i]['precipProbability']*100)
-			weatherdata_forecast_rainint.append(parsed_apidata['daily']['data'][i]['precipIntensityMax'])
-			if LogWrt==1:
-				logging.info("- forecast_daily | today: %s, %s, icon: %s, high: %s, low: %s, wind: %s km/h, pop: %s%%, rain: %s mm" % (weatherdata_forecast_weekday[i], weatherdata_forecast_date[i], weatherdata_forecast_icon[i], weatherdata_forecast_temphigh[i], weatherdata_forecast_templow[i], weatherdata_forecast_wind[i], weatherdata_forecast_rain[i], weatherdata_forecast_rainint[i]))
-
-
-		# Forecast Hourly
-		weatherdata_hourly_time = []
-		weatherdata_hourly_icon = []
-		weatherdata_hourly_temp = []
-		weatherdata_hourly_wind = []
-		weatherdata_hourly_rain = []
-		for i in range(0, 24):
-			weatherdata_hourly_time.append(datetime.fromtimestamp(int(parsed_apidata['hourly']['data'][i]['time'])).strftime("%H"))
-			weatherdata_hourly_icon.append(parsed_apidata['hourly']['data'][i]['icon'])
-			weatherdata_hourly_temp.append(parsed_apidata['hourly']['data'][i]['temperature'])
-			weatherdata_hourly_wind.append(parsed_apidata['hourly']['data'][i]['windGust'])
-			weatherdata_hourly_rain.append(parsed_apidata['hourly']['data'][i]['precipProbability']*100)
-			if LogWrt==1:
-				logging.info("- weatherdata_hourly | hour: %s, icon: %s, temp: %s, wind: %s km/h, pop: %s%%" % (weatherdata_hourly_time[i], weatherdata_hourly_icon[i], weatherdata_hourly_temp[i], weatherdata_hourly_wind[i], weatherdata_hourly_rain[i]))
-
-	except urllib.error.HTTPError as e:
-		tries = tries + 1
-		logging.warn("WARN | dark sky api quest not successfully - error <%s> on trial no %s" % (e.code, tries))
-		time.sleep(10)
-		continue
-
-	else:
-		break
-
-else:
-	logging.error("FAIL |  dark sky api quest failed")
+			logging.info("- forecast_daily | today: %s, %s, icon: %s, high: %s, low: %s, wind: %s km/h, pop: %s%%, rain: %s mm" % (weatherdata_forecast_weekday[i], weatherdata_forecast_date[i], weatherdata_forecast_icon[i], weatherdata_forecast_temphigh[i], weatherdata_forecast_templow[i], weatherdata_forecast_wind[i], weatherdata_forecast_rain[i], weatherdata_forecast_rainint[i]))
+
+
+	# Forecast Hourly (up to 48 hours, the displays show 24 of them from the hour they are rendered for, see weather_values)
+	weatherdata_hourly_epoch = []
+	weatherdata_hourly_time = []
+	weatherdata_hourly_icon = []
+	weatherdata_hourly_temp = []
+	weatherdata_hourly_wind = []
+	weatherdata_hourly_rain = []
+	for i in range(0, min(48, len(parsed_apidata['hourly']['data']))):
+		weatherdata_hourly_epoch.append(int(parsed_apidata['hourly']['data'][i]['time']))
+		weatherdata_hourly_time.append(datetime.fromtimestamp(int(parsed_apidata['hourly']['data'][i]['time'])).strftime("%H"))
+		weatherdata_hourly_icon.append(parsed_apidata['hourly']['data'][i]['icon'])
+		weatherdata_hourly_temp.append(parsed_apidata['hourly']['data'][i]['temperature'])
+		weatherdata_hourly_wind.append(parsed_apidata['hourly']['data'][i]['windGust'])
+		weatherdata_hourly_rain.append(parsed_apidata['hourly']['data'][i]['precipProbability']*100)
+		if LogWrt==1:
+			logging.info("- weatherdata_hourly | hour: %s, icon: %s, temp: %s, wind: %s km/h, pop: %s%%" % (weatherdata_hourly_time[i], weatherdata_hourly_icon[i], weatherdata_hourly_temp[i], weatherdata_hourly_wind[i], weatherdata_hourly_rain[i]))
+
+	return {'now_text': weatherdata_now_text,
+			'now_icon': weatherdata_now_icon,
+			'sunrise': astronomy_today_sunrise,
+			'sunset': astronomy_today_sunset,
+			'moonphase': astronomy_today_moonphase,
+			'moonphase_icon': astronomy_today_moonphase_icon,
+			'forecast_date': weatherdata_forecast_date,
+			'forecast_weekday': weatherdata_forecast_weekday,
+			'forecast_icon': weatherdata_forecast_icon,
+			'forecast_temphigh': weatherdata_forecast_temphigh,
+			'forecast_templow': weatherdata_forecast_templow,
+			'forecast_wind': weatherdata_forecast_wind,
+			'forecast_rain': weatherdata_forecast_rain,
+			'forecast_rainint': weatherdata_forecast_rainint,
+			'hourly_epoch': weatherdata_hourly_epoch,
+			'hourly_time': weatherdata_hourly_time,
+			'hourly_icon': weatherdata_hourly_icon,
+			'hourly_temp': weatherdata_hourly_temp,
+			'hourly_wind': weatherdata_hourly_wind,
+			'hourly_rain': weatherdata_hourly_rain}
 
 
 ################
 # On Homematic CCU check your device IDs with:
 # http://192.168.178.XXX/addons/xmlapi/state.cgi?device_id=xxx,xxxx,xxxx
+# fetch_homematic only does the network part and runs in parallel to the other sources: one request for all
+# devices (outdoor + indoor sensors of all displays), read as a stream (see homematic_state.py). Afterwards the
+# readings of all devices are written to the DB at once and evaluated to display values per device,
+# e.g. {1234: {'t': '12.3', 'th': '15.1', ...}, ...}
+
+# Display slots per datapoint: datapoint -> (value key, format, daily max key, daily min key, decimals of max/min)
+# Format "%.1f" etc. = current value, "compass" = wind direction as N/NO/..., "rise" = rainfall of yesterday and today
+HOMEMATIC_SLOTS = {
+	"ACTUAL_TEMPERATURE": ("t", "%.1f", "th", "tl", 1),
+	"HUMIDITY": ("h", "%.0f", "hh", "hl", 0),
+	"RAIN_COUNTER": ("rr", "rise", None, None, None),
+	"WIND_DIR": ("wd", "compass", None, None, None),
+	"WIND_SPEED": ("ws", "%.1f", "wh", None, 0)}
+
+HOMEMATIC_DATAPOINTS = frozenset(HOMEMATIC_SLOTS)
+
+@metrics.timed("homematic")
+def fetch_homematic(deadline):
+	deviceurl = state_url(HOMEMATICIP, HM_DEVICES)
+	devices = dict((str(DEVICE), DEVICE) for DEVICE in HM_DEVICES)
+	def request():
+		# Datapoints of interest of all devices as list of (DEVICE, datapoint, datapointid, value)
+		with urlopen(deviceurl, TIMEOUTS["homematic"], deadline) as response:
+			return [(devices[device],) + reading[1:] for reading in iter_datapoints(metrics.reader(response), HOMEMATIC_DATAPOINTS)
+				for device in [reading[0]] if device in devices]
+	readings = retry(request, "homematic devices %s" % ",".join(devices), MAX_TRIES, deadline=deadline)
+	missing = set(HM_DEVICES).difference(reading[0] for reading in readings)
+	if missing:
+		logging.warning("WARN | homematic: no datapoints for device(s) %s" % ", ".join(str(DEVICE) for DEVICE in missing))
+	return readings
+
+def compass(degrees):
+	# Windrichtung / Wind direction
+	if 0 <= degrees <= 22.4:
+		return "N"
+	elif 22.5 <= degrees <= 67.4:
+		return "NO"
+	elif 67.5 <= degrees <= 112.4:
+		return "O"
+	elif 112.5 <= degrees <= 157.4:
+		return "SO"
+	elif 157.5 <= degrees <= 202.4:
+		return "S"
+	elif 202.5 <= degrees <= 247.4:
+		return "SW"
+	elif 247.5 <= degrees <= 292.4:
+		return "W"
+	elif 292.5 <= degrees <= 337.4:
+		return "NW"
+	elif 337.5 <= degrees <= 360:
+		return "N"
+
+@metrics.timed("sql_aggregate")
+def evaluate_homematic(cursor, readings):
+	# Display values incl. daily Min/Max from the DB, cursor None = DB not available, current values only
+	sensors = {}
+
+	for DEVICE, datapointname, datapointid, value in readings:
+		slot = HOMEMATIC_SLOTS.get(datapointname.rsplit('.', 1)[-1])
+		if slot is None:
+			continue
+		key, form, maxkey, minkey, decimal = slot
+		data = sensors.setdefault(DEVICE, {})
+
+		if form == "rise":
+			### Niederschlagsmenge / rainfall amount
+			# Bem: Ohne "Reset" wird die Niederschlagsmenge immer zum letzten Wert addiert - wächst immer weiter an, wird nicht auf 0 gesetzt.
+			# Sum of all counter steps of yesterday and today, a counter reset is not counted as negative rain
+			if cursor is not None:
+				data[key] = '%.1f' % daily.rise(cursor, datapointid, 2)
+			continue
+		elif form == "compass":
+			data[key] = compass(float('%.1f' % float(value)))
+			continue
+		data[key] = form % float(value)
+
+		# Daily Min/Max
+		for sort, minmaxkey in (("DESC", maxkey), ("ASC", minkey)):
+			if minmaxkey is not None:
+				minmax = sqlminmax(cursor, datapointid, sort, decimal)
+				if minmax is not None:
+					data[minmaxkey] = minmax
+	return sensors
+
+@metrics.timed("sql_write")
+def store_homematic(db, readings):
+	# All readings of this run in one transaction (or to the spool file if the DB is not available),
+	# before evaluate_homematic so that the daily Min/Max include the current values
+	for DEVICE, datapoint, datapointid, value in readings:
+		sqlbuffer.add(datapointid, value)
+	metrics.count("rows", sqlbuffer.flush(db))
+	if series is not None:
+		metrics.count("pruned", series.prune(db))
 
-db = pymysql.connect(
-	host=SQLHOST,
-	port=SQLPORT,
-	user=SQLUSER, 
-	password=SQLPW,
-	db=SQLDB,
-	charset='utf8mb4',
-	cursorclass=pymysql.cursors.DictCursor)
-
-cursor = db.cursor()
-
-try:
-	for DEVICE in DEVICES:
-
-		deviceurl = "http://{}/addons/xmlapi/state.cgi?device_id={}".format(HOMEMATICIP, DEVICE)
-		xmldoc = untangle.parse(deviceurl)
-		for ITEMS in xmldoc.state.device.channel:
-			if ITEMS.get_elements('datapoint'):
-				for DATA in ITEMS.datapoint:
-					datapointname = DATA['name']
-
-					### Temperatur
-					if datapointname.endswith('.ACTUAL_TEMPERATURE'):
-						datapointid = DATA['ise_id']
-						datapoint = DATA['name']
-						value = DATA['value']
-
-						sqlinsert(cursor, DEVICE, datapoint, datapointid, value)
-
-						# Whz / Room1
-						if DEVICE == DEVICES[1]:
-							wzt = '%.1f' % float(value)
-							wth = sqlminmax(cursor, datapointid, "DESC", 1)
-							wtl = sqlminmax(cursor, datapointid, "ASC", 1)
-
-						# DG-Whz / Room2
-						if DEVICE == DEVICES[2]:
-							bat = '%.1f' % float(value)
-							bth = sqlminmax(cursor, datapointid, "DESC", 1)
-							btl = sqlminmax(cursor, datapointid, "ASC", 1)
-
-						# Garten / Garden
-						if DEVICE == DEVICES[0]:
-							gtt = '%.1f' % float(value)
-							gth = sqlminmax(cursor, datapointid, "DESC", 1)
-							gtl = sqlminmax(cursor, datapointid, "ASC", 1)
-
-					### Luftfeuchtigkeit / Humidity
-					if datapointname.endswith('.HUMIDITY'):
-						datapointid = DATA['ise_id']
-						datapoint = DATA['name']
-						value = DATA['value']
-
-						sqlinsert(cursor, DEVICE, datapoint, datapointid, value)
-
-						# Whz / Room1
-						if DEVICE == DEVICES[1]:
-							wzh = '%.0f' % float(value)
-							whh = sqlminmax(cursor, datapointid, "DESC", 0)
-							whl = sqlminmax(cursor, datapointid, "ASC", 0)
-
-						# DG-Whz / Room2
-						if DEVICE == DEVICES[2]:
-							bah = '%.0f' % float(value)
-							bhh = sqlminmax(cursor, datapointid, "DESC", 0)
-							bhl = sqlminmax(cursor, datapointid, "ASC", 0)
-
-						# Garten / Garden
-						if DEVICE == DEVICES[0]:
-							gah = '%.0f' % float(value)
-							ghh = sqlminmax(cursor, datapointid, "DESC", 0)
-							ghl = sqlminmax(cursor, datapointid, "ASC", 0)
-
-					### Niederschlagsmenge / rainfall amount 
-					# Bem: Ohne "Reset" wird die Niederschlagsmenge immer zum letzten Wert addiert - wächst immer weiter an, wird nicht auf 0 gesetzt.
-					if datapointname.endswith('.RAIN_COUNTER'):
-						datapointid = DATA['ise_id']
-						datapoint = DATA['name']
-						value = DATA['value']
-
-						sqlinsert(cursor, DEVICE, datapoint, datapointid, value)
-
-						# Garten - Differenzwert zwischen jetzt und Tagesanfang ermitteln
-						if DEVICE == DEVICES[0]:
-							cursor.execute(
-								"SELECT maxi-mini FROM (SELECT MIN(value) mini, MAX(value) maxi FROM (SELECT value FROM %s WHERE sensor = %s AND DATE(datetime) >= DATE(NOW()) - INTERVAL 1 DAY ) mm1) mm2" % (SQLTAB, datapointid))
-							for select in cursor.fetchall():
-								grr = '%.1f' % float(select["maxi-mini"])
-								#grr = '{}:.1f'.format(select["maxi-mini"])
-
-					### Windrichtung / Wind direction
-					if datapointname.endswith('.WIND_DIR'):
-						datapointid = DATA['ise_id']
-						datapoint = DATA['name']
-						value = DATA['value']
-
-						sqlinsert(cursor, DEVICE, datapoint, datapointid, value)
-
-						# Garten / Garden
-						if DEVICE == DEVICES[0]:
-							gwdtemp = '%.1f' % float(value)
-
-							if 0 <= float(gwdtemp) <= 22.4:
-								gwd = "N"
-							elif 22.5 <= float(gwdtemp) <= 67.4:
-								gwd = "NO"
-							elif 67.5 <= float(gwdtemp) <= 112.4:
-								gwd = "O"
-							elif 112.5 <= float(gwdtemp) <= 157.4:
-								gwd = "SO"
-							elif 157.5 <= float(gwdtemp) <= 202.4:
-								gwd = "S"
-							elif 202.5 <= float(gwdtemp) <= 247.4:
-								gwd = "SW"
-							elif 247.5 <= float(gwdtemp) <= 292.4:
-								gwd = "W"
-							elif 292.5 <= float(gwdtemp) <= 337.4:
-								gwd = "NW"
-							elif 337.5 <= float(gwdtemp) <= 360:
-								gwd = "N"
-
-					### Windgeschwindigkeit / Wind speed
-					if datapointname.endswith('.WIND_SPEED'):
-						datapointid = DATA['ise_id']
-						datapoint = DATA['name']
-						value = DATA['value']
-
-						sqlinsert(cursor, DEVICE, datapoint, datapointid, value)
-
-						# Garten / Garden
-						if DEVICE == DEVICES[0]:
-							gws = '%.1f' % float(value)
-							cursor.execute(
-								"SELECT value FROM %s WHERE sensor = %s AND DATE(datetime) = DATE(NOW()) ORDER BY value + 0 DESC LIMIT 1" %
-								(SQLTAB, datapointid))
-							for select in cursor.fetchall():
-								gwh = '%.0f' % float(select["value"])
-								#gwh = '{}:.0f'.format(select["value"])
-finally:
-	db.close()
 
 ############################################################
 # Read air quality data for Germany for given UBA stations
 # See get_uba_airquality.py script for more information and parameter settings
-# Only call function every 6 hours is sufficient for reliable floating average values
+# Only call function every 3 hours (chkhour) is sufficient for reliable floating average values
+# The client keeps its DB connection and the last result, all displays and daemon runs reuse it
 
-chkhour = [1, 4, 7, 10, 13, 16, 19, 22]
-nowtime = datetime.today()
-for hour in chkhour:
-	if time_in_range(time(hour-1, 30, 0), time(hour, 30, 0), time(nowtime.hour,nowtime.minute)):
-		ubadata, ubaidx = get_uba_airquality('write')
-	else:
-		ubadata, ubaidx = get_uba_airquality('read')
+@metrics.timed("uba")
+def fetch_uba(deadline):
+	ubadata, ubaidx = uba.get(uba_write_due(datetime.today()), deadline)
 
 	if LogWrt==1:
 		logging.info("%s %s" % (ubadata, ubaidx))
-	
+	return (ubadata, ubaidx)
+
+
 ############################################################
 # Read SVG, compile output, generate SVG and convert to PNG
 # To reduce size of SVG and clean from unnecessary data, use:
 ### http://www.svgminify.com > then copy/paste "defs"
 
-for ROOM in ROOMS:
-
-	OUTPUT = "%s/weatherdata-%s.png" % (PATH, ROOM.lower())
-	ROOM1 = "Innen (%s)" % (ROOM)
-	
-	if (ROOM == ROOMS[0]):   #"Wohnzimmer":
-		output = codecs.open(SVG_FILE, "r", encoding="utf-8").read()
-	elif (ROOM == ROOMS[1]):   #"DG-Whz":
-		output = codecs.open(SVG_FILE2, "r", encoding="utf-8").read()
-	else: 
-		logging.error("FAIL | Room not defined, no SVG defined")
-
-	output = output.replace("$TEXT", str(weatherdata_now_text))
-	output = output.replace("$I0", str(weatherdata_now_icon))
-	output = asInteger(output, "$CT", gtt, "°")
-	output = output.replace("$CHH", str(gth + "°"))
-	output = output.replace("$CHL", str(gtl + "°"))
-	output = output.replace("$CL", str(gah + ""))
-	output = output.replace("$CAH", str(ghh + ""))
-	output = output.replace("$CAL", str(ghl + ""))
-	output = asInteger(output, "$CW", gws, "")
-	output = output.replace("$CD", str(gwd))
-	output = output.replace("$CHW", str(gwh))
-	output = output.replace("$CR", str(grr))
-	output = output.replace("$sunrise", str(astronomy_today_sunrise))
-	output = output.replace("$sunset", str(astronomy_today_sunset))
-	output = output.replace("$MO", str('%.2d' % (float(astronomy_today_moonphase))))
-	output = output.replace("$MI", str(astronomy_today_moonphase_icon))
-
-	output = output.replace("$AQ", str("000"))		# Hardcoded for the moment (air quality = Luftqualität)
-	output = output.replace("$QL", str("000"))		# Hardcoded for the moment
-	output = output.replace("$QH", str("000"))		# Hardcoded for the moment
-
-	output = output.replace("$IDX", str(ubaidx))		# Air quality index
-	output = output.replace("$PM", str(ubadata['PM10']))	# PM10 
-	output = output.replace("$O3", str(ubadata['O3']))		# O3
-	output = output.replace("$NO", str(ubadata['NO2']))		# NO2
-	output = output.replace("$SO", str("00"))				# SO2 - Hard coded, as not available for current location
-
-	#output = output.replace("$TIME", datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
-	output = output.replace("$TIME", datetime.today().strftime("%Y-%m-%d %H:%M"))
-	output = output.replace("$LOC", str(CITY))
+# Each group of placeholders is filled from the last good snapshot of its source (see snapshot_store.py).
+# If a source has never delivered, only its group stays empty and is shown as "-", all other data are still
+# rendered. Data older than STALE_AFTER get STALE_MARK after the current value and their time in $AGE.
+
+STALE_MARK = "*"
+
+def weather_values(values, weather, when):
+	values["TEXT"] = str(weather['now_text'])
+	values["I0"] = str(weather['now_icon'])
+	values["sunrise"] = str(weather['sunrise'])
+	values["sunset"] = str(weather['sunset'])
+	values["MO"] = str('%.2d' % (float(weather['moonphase'])))
+	values["MI"] = str(weather['moonphase_icon'])
 
 	for i in range(0, 3):
-		output = replace_daily(output, str(i+1), weatherdata_forecast_weekday[i], weatherdata_forecast_icon[i], weatherdata_forecast_templow[i], weatherdata_forecast_temphigh[i], weatherdata_forecast_wind[i], weatherdata_forecast_rain[i], weatherdata_forecast_rainint[i])
-
-	for i in range(0, 24):
-		output = replace_hourly(output, str(i+1).zfill(2), weatherdata_hourly_time[i], weatherdata_hourly_icon[i], weatherdata_hourly_rain[i], weatherdata_hourly_temp[i])
-	
-	if (ROOM == ROOMS[0]):		#"Wohnzimmer":
-		#ROOM2 = " "
-		output = output.replace("$ROOM1", str(ROOM1))
-		#output = output.replace("$ROOM2", str(ROOM2))
-		output = output.replace("$BT", str(wzt + "°"))
-		output = output.replace("$BSL", str(wtl + "°"))
-		output = output.replace("$BSH", str(wth + "°"))
-		#output = asIntegerTenOrMinusTen(output, "$BSL", wtl, "°")
-		#output = asIntegerTenOrMinusTen(output, "$BSH", wth, "°")
-		wzh = "0" #hard coded as zero for the moment, as no sensor.
-		whh = "0"
-		whl = "0"
-		output = output.replace("$BH", str(wzh + "")) 
-		output = output.replace("$BBH", str(whh + ""))
-		output = output.replace("$BBL", str(whl + ""))
-		
-	elif (ROOM == ROOMS[1]):		#"DG-Whz":
-		#ROOM2 = " "
-		output = output.replace("$ROOM1", str(ROOM1))
-		#output = output.replace("$ROOM2", str(ROOM2))
-		output = output.replace("$BT", str(bat + "°"))
-		output = output.replace("$BSL", str(btl + "°"))
-		output = output.replace("$BSH", str(bth + "°"))
-		#output = asIntegerTenOrMinusTen(output, "$BSL", btl, "°")
-		#output = asIntegerTenOrMinusTen(output, "$BSH", bth, "°")
-		output = output.replace("$BH", str(bah + ""))
-		output = output.replace("$BBH", str(bhh + ""))
-		output = output.replace("$BBL", str(bhl + ""))
-	
+		replace_daily(values, str(i+1), weather['forecast_weekday'][i], weather['forecast_icon'][i], weather['forecast_templow'][i], weather['forecast_temphigh'][i], weather['forecast_wind'][i], weather['forecast_rain'][i], weather['forecast_rainint'][i])
+
+	# 24 hours from the hour of "when" on, also if the forecast is older (cache, rendered ahead)
+	hour = when.replace(minute=0, second=0, microsecond=0).timestamp()
+	first = max(0, min(sum(1 for epoch in weather['hourly_epoch'] if epoch < hour), len(weather['hourly_epoch']) - 24))
+	for i in range(first, first + 24):
+		replace_hourly(values, str(i-first+1).zfill(2), weather['hourly_time'][i], weather['hourly_icon'][i], weather['hourly_rain'][i], weather['hourly_temp'][i])
+
+def outdoor_values(values, outdoor):
+	# Each value on its own: one that is missing (e.g. a min/max of the day from the DB) is shown as "-",
+	# the other values of the snapshot are still filled
+	missing = []
+	for key, name, unit, integer in (("CT", "t", "°", True), ("CHH", "th", "°", False), ("CHL", "tl", "°", False),
+			("CL", "h", "", False), ("CAH", "hh", "", False), ("CAL", "hl", "", False),
+			("CW", "ws", "", True), ("CD", "wd", "", False), ("CHW", "wh", "", False), ("CR", "rr", "", False)):
+		try:
+			if integer:
+				asInteger(values, key, outdoor[name], unit)
+			else:
+				values[key] = str(outdoor[name]) + unit
+		except (KeyError, TypeError, ValueError):
+			missing.append(name)
+	if missing:
+		logging.warning("WARN | no outdoor sensor data for %s, shown as '-'" % ", ".join(missing))
+
+def uba_values(values, uba):
+	ubadata, ubaidx = uba
+	values["IDX"] = str(ubaidx)			# Air quality index
+	values["PM"] = str(ubadata['PM10'])	# PM10
+	values["O3"] = str(ubadata['O3'])	# O3
+	values["NO"] = str(ubadata['NO2'])	# NO2
+
+def room_values(values, display, indoor):
+	ROOM1 = "Innen (%s)" % (display.room)
+	#ROOM2 = " "
+	values["ROOM1"] = str(ROOM1)
+	#values["ROOM2"] = str(ROOM2)
+	if 'h' in indoor:	# Rooms without humidity sensor show "-"
+		values["BH"] = str(indoor['h'] + "")
+		values["BBH"] = str(indoor['hh'] + "")
+		values["BBL"] = str(indoor['hl'] + "")
+	values["BT"] = str(indoor['t'] + "°")
+	values["BSL"] = str(indoor['tl'] + "°")
+	values["BSH"] = str(indoor['th'] + "°")
+	#asIntegerTenOrMinusTen(values, "BSL", indoor['tl'], "°")
+	#asIntegerTenOrMinusTen(values, "BSH", indoor['th'], "°")
+
+def indoor_sensors(sensors, display):
+	# Values of the display's indoor sensors, the first sensor listed wins
+	indoor = {}
+	for DEVICE in reversed(display.sensors):
+		indoor.update(sensors.get(DEVICE, {}))
+	return indoor
+
+def fill(values, name, func, *args):
+	try:
+		func(values, *args)
+	except (KeyError, IndexError, TypeError, ValueError) as e:
+		logging.warning("WARN | no %s data, shown as '-' (%s)" % (name, e))
+
+def store_snapshots(delivered, now):
+	# Sources that delivered in this run: {"darksky": ..., "homematic": {DEVICE: values}, "uba": ...}.
+	# The others (and Homematic devices without datapoints) keep their last snapshot
+	if delivered.get("darksky") is not None:
+		snapshots.put("darksky", "forecast", delivered["darksky"], httpcache.fetched(darksky_url()) or now)	# from the cache: time of the response
+	for DEVICE, values in (delivered.get("homematic") or {}).items():
+		snapshots.put("homematic/%s" % DEVICE, "sensor", values, now)
+	# UBA: time of the measurement. Values read from the DB (API failed, not a check hour) or kept from an
+	# earlier run are stored only if they are newer, "-" without any measurement never replaces a snapshot
+	if delivered.get("uba") is not None and uba.measured is not None:
+		previous = snapshots.get("uba", "airquality")
+		if previous is None or uba.measured > previous.fetched:
+			snapshots.put("uba", "airquality", delivered["uba"], uba.measured)
+	try:
+		snapshots.save()
+	except Exception as e:
+		logging.warning("WARN | snapshots not written - %s" % e)
+
+def load_sources():
+	# Newest snapshot of each source without any network access: (weather, sensors, uba, fetched),
+	# fetched: source -> epoch seconds of its data
+	fetched = {}
+	def newest(name, kind):
+		snapshot = snapshots.get(name, kind)
+		if snapshot is None:
+			return None
+		fetched[name] = snapshot.fetched
+		return snapshot.values
+	weather = newest("darksky", "forecast")
+	sensors = {}
+	for DEVICE in HM_DEVICES:
+		values = newest("homematic/%s" % DEVICE, "sensor")
+		if values is not None:
+			sensors[DEVICE] = values
+	uba = newest("uba", "airquality")
+	return (weather, sensors, uba, fetched)
+
+def stale_sources(fetched, when):
+	# Sources whose data are older than STALE_AFTER at when (epoch seconds)
+	return set(name for name, t in fetched.items() if when - t > STALE_AFTER[name.split("/")[0]])
+
+def mark_stale(values, key, name, stale):
+	if name in stale and key in values:
+		values[key] += STALE_MARK
+
+def data_age(fetched, names, when):
+	# $AGE: time of the oldest of these sources, with the date if not of the same day, "" if none is old
+	if not names:
+		return ""
+	oldest = datetime.fromtimestamp(min(fetched[name] for name in names))
+	return "%s %s" % (STALE_MARK, oldest.strftime("%H:%M" if oldest.date() == when.date() else "%d.%m. %H:%M"))
+
+def display_tasks(sources, when=None, names=None):
+	# Shared values (forecast, outdoor sensor, air quality) are filled once, then each display (all or those
+	# in names) gets its indoor values. sources: see load_sources(). when: time the frames are for (TIME,
+	# hourly forecast, old data), default now
+	weather, sensors, uba, fetched = sources
+	when = when or datetime.today()
+	stale = stale_sources(fetched, when.timestamp())
+	outdoor = "homematic/%s" % OUTDOOR
+	with metrics.stage("fill"):
+		common = {}
+		fill(common, "weather", weather_values, weather, when)
+		fill(common, "outdoor sensor", outdoor_values, sensors.get(OUTDOOR, {}))
+		fill(common, "air quality", uba_values, uba)
+		mark_stale(common, "TEXT", "darksky", stale)
+		mark_stale(common, "CT", outdoor, stale)
+		mark_stale(common, "IDX", "uba", stale)
+
+		common["AQ"] = str("000")		# Hardcoded for the moment (air quality = Luftqualität)
+		common["QL"] = str("000")		# Hardcoded for the moment
+		common["QH"] = str("000")		# Hardcoded for the moment
+		common["SO"] = str("00")		# SO2 - Hard coded, as not available for current location
+
+		common["TIME"] = when.strftime("%Y-%m-%d %H:%M")
+		common["LOC"] = str(CITY)
+
+		tasks = []
+		for display in DISPLAYS:
+			if names is not None and display.name not in names:
+				continue
+			values = dict(common)
+			fill(values, "room sensor", room_values, display, indoor_sensors(sensors, display))
+			room = next(("homematic/%s" % DEVICE for DEVICE in display.sensors if DEVICE in sensors), None)	# the sensor shown
+			mark_stale(values, "BT", room, stale)
+			values["AGE"] = data_age(fetched, stale.intersection(["darksky", outdoor, "uba", room]), when)
+			tasks.append(RenderTask(display.name, display.template, values, display.output, display.resolution, RENDERMODE, CACHEDIR, PARTIAL_TILES, PILLOW_FONTS,
+				display.depth or DEPTH, display.dither or DITHER, display.compress or PNG_COMPRESS))
+	return tasks
+
+def render_displays(sources):
+	# All displays are rendered in parallel (see render_pool.py). A display whose values are the same
+	# as in its last published frame (see .manifest) is not rendered again, only TIME would differ.
+	for name, seconds, error in renderpool.render(display_tasks(sources)):
+		if error:
+			logging.error("FAIL | display %s not rendered - %s" % (name, error))
+		elif LogWrt==1 and seconds is None:
+			logging.info("OK | display %s unchanged, not rendered" % (name))
+		elif LogWrt==1:
+			logging.info("OK | display %s rendered in %.1f sec" % (name, seconds))
+
+
+######################
+# One run (cron)
+def run_once():
+	if LogWrt==1:
+		logging.info("SCRIPT START")
+	started = time.time()
+	metrics.begin()
+	renderpool.start()	# before the fetch threads
+
+	# All sources in parallel, each with its own timeout and retries, together at most DEADLINE seconds
+	deadline = Deadline(DEADLINE)
+	tasks = {"darksky": lambda: fetch_darksky(deadline),
+			"homematic": lambda: fetch_homematic(deadline),
+			"uba": lambda: fetch_uba(deadline)}
+	results = fetch_all(tasks, deadline)
+
+	readings = results.get("homematic", [])
+
+	db = sqlreconnect(None)
+	try:
+		store_homematic(db, readings)
+		results["homematic"] = evaluate_homematic(db.cursor() if db else None, readings)
+	finally:
+		if db:
+			db.close()
+
+	# Rendered from the snapshots: a source that failed in this run is shown with its last good data
+	store_snapshots(results, started)
+	render_displays(load_sources())
+	save_schedule(cron_updates(started), started)
+	renderpool.close()
+	uba.close()
+
+	stats = httpcache.save_stats(max(CACHE_TTL.values()) + CACHE_GRACE)
+	metrics.save()
+	if LogWrt==1:
+		logging.info("http cache | %s" % (", ".join("%s: %s" % (counter, stats[counter]) for counter in stats)))
+		logging.info("SCRIPT END\n")
+
+def run_render():
+	# Displays from the stored snapshots only (no network, no DB), e.g. after a reboot or in its own crontab entry
+	metrics.begin()
+	renderpool.start()
+	try:
+		render_displays(load_sources())
+	finally:
+		renderpool.close()
+	metrics.save()
+
+
+######################
+# Resident daemon
+# Each source is a job with its own interval (+- JITTER). The results are kept in memory, the displays are
+# re-rendered only if a job returned something different from its last result.
+class Job:
+
+	def __init__(self, name, func, interval):
+		self.name = name
+		self.func = func	# network part, called with the deadline, runs in parallel to the other due jobs
+		self.interval = interval
+		self.next_run = 0	# due immediately at start
+		self.result = None
+
+	def schedule(self, now):
+		if self.interval > 0:
+			self.next_run = now + self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+		else:	# UBA: next check window plus a few minutes jitter within the window
+			slot = uba_next_slot(datetime.fromtimestamp(now))
+			self.next_run = slot.timestamp() + random.uniform(0, 1800 * JITTER)
+
+	def retry(self, now):
+		# Failed job: try again after a tenth of the interval (min 60 sec), do not wait for the next regular run
+		self.next_run = now + max(60, self.interval / 10)
+
+	def update(self, result, now):
+		# Store new result and schedule next run, returns True if the result has changed
+		self.schedule(now)
+		if result != self.result:
+			self.result = result
+			return True
+		return False
+
+######################
+# Wakeup schedule (see wake_schedule.py)
+def cron_updates(now):
+	# Next updates of each source if the script runs every RUN_INTERVAL seconds: Homematic each run,
+	# the forecast once the cached response is older than CACHE_TTL, UBA in the first run of each check window
+	runs = run_grid(now, RUN_INTERVAL, now + HORIZON)
+	darksky = []
+	last = httpcache.fetched(darksky_url()) or now
+	for run in runs:
+		if run - last >= CACHE_TTL["darksky"]:
+			darksky.append(run)
+			last = run
+	ubaruns = []
+	for run in runs:
+		if uba_write_due(datetime.fromtimestamp(run)) and (not ubaruns or run - ubaruns[-1] > 3600):
+			ubaruns.append(run)
+	return {"homematic": runs, "darksky": darksky, "uba": ubaruns}
+
+def daemon_updates(jobs, now):
+	# Next runs of the daemon jobs (without jitter)
+	updates = {}
+	for job in jobs:
+		if job.interval > 0:
+			updates[job.name] = repeat(job.next_run, job.interval, now + HORIZON)
+		else:
+			slot = datetime.fromtimestamp(job.next_run)
+			updates[job.name] = [job.next_run]
+			while updates[job.name][-1] <= now + HORIZON:
+				slot = uba_next_slot(slot)
+				updates[job.name].append(slot.timestamp())
+	return updates
+
+def save_schedule(updates, started, rendered=True):
+	# rendered: how long after the start of a run the frames are published (end of render_displays)
+	if not SCHEDULE:
+		return
+	try:
+		schedule = WakeSchedule(SCHEDULE)
+		try:
+			with open(SCHEDULE, "r") as f:
+				schedule.data["displays"] = json.load(f).get("displays", {})	# last render times, if not rendered this run
+		except (OSError, ValueError):
+			pass
+		for name, times in updates.items():
+			schedule.source(name, times)
+		if rendered:
+			schedule.rendered([display.name for display in DISPLAYS], started, time.time())
+		schedule.save()
+	except Exception as e:
+		logging.warning("WARN | wakeup schedule not written - %s" % e)
+
+def sync_server(ahead=None):
+	# Same files as before: weatherscript.sh in PATH, the Kindle logs in PATH/log (formerly uploaded via ssh)
+	advisor = WakeAdvisor(SCHEDULE, WAKE_WORKDAY, WAKE_WEEKEND, QUIET_HOURS, WAKE_MIN, WAKE_MARGIN) if SCHEDULE else None
+	return SyncServer(SYNC_PORT, DISPLAYS, "%s/weatherscript.sh" % PATH, "%s/log" % PATH, SYNC_ACTIONS, advisor, ahead)
+
+def render_ahead(ahead, now):
+	# Frames of the Kindles waking up within PRERENDER_AHEAD, from the snapshots (no fetch).
+	# Kindles waking up in the same minute show the same TIME, so a room's displays are prepared once (render_pool.group_key)
+	due = ahead.due(now)
+	if not due:
+		return
+	sources = load_sources()
+	minutes = {}
+	for display, wake, version in due:
+		minutes.setdefault(int(wake // 60), []).append((display, wake, version))
+	for minute, waking in sorted(minutes.items()):
+		when = datetime.fromtimestamp(min(wake for display, wake, version in waking))
+		tasks = display_tasks(sources, when, [display for display, wake, version in waking])
+		wakes = dict((display, (wake, version)) for display, wake, version in waking)
+		for name, seconds, error, frame in renderpool.prerender(tasks):
+			wake, version = wakes[name]
+			if error:
+				logging.error("FAIL | display %s not rendered ahead - %s" % (name, error))
+				ahead.put(name, wake, version, None)	# the published frame is served, no new try for this wakeup
+			elif ahead.put(name, wake, version, frame):
+				metrics.count("prerendered", stage="render")
+				if LogWrt==1:
+					logging.info("OK | display %s rendered ahead for %s in %.1f sec" % (name, datetime.fromtimestamp(wake).strftime("%H:%M:%S"), seconds))
+
+def run_daemon():
+	logging.info("DAEMON START")
+	renderpool.start()	# one pool for the lifetime of the daemon, workers keep their templates
+	db = None
+	ahead = RenderAhead(PRERENDER, PRERENDER_AHEAD, PRERENDER_LATE) if SYNC_PORT and SCHEDULE and PRERENDER > 0 else None
+	syncserver = sync_server(ahead) if SYNC_PORT else None
+	if syncserver:
+		syncserver.start()
+
+	jobs = [Job("darksky", fetch_darksky, INTERVALS["darksky"]),
+			Job("homematic", fetch_homematic, INTERVALS["homematic"]),
+			Job("uba", fetch_uba, INTERVALS["uba"])]
+	stale = stale_sources(load_sources()[3], time.time())
+
+	try:
+		while True:
+			now = time.time()
+			changed = False
+			metrics.begin()
+			due = [job for job in jobs if job.next_run <= now]
+			deadline = Deadline(DEADLINE)
+			results = fetch_all(dict((job.name, (lambda job=job: job.func(deadline))) for job in due), deadline)
+
+			delivered = {}
+			for job in due:
+				if job.name not in results:	# failed or too late, already logged by fetch_all
+					job.retry(now)
+				elif job.name == "homematic":	# all devices in one DB transaction, then evaluated to display values
+					try:
+						db = sqlreconnect(db)
+						store_homematic(db, results[job.name])
+						delivered[job.name] = evaluate_homematic(db.cursor() if db else None, results[job.name])
+						changed = job.update(delivered[job.name], now) or changed
+					except Exception:
+						logging.exception("FAIL | daemon job %s failed" % job.name)
+						job.retry(now)
+				else:
+					delivered[job.name] = results[job.name]
+					changed = job.update(results[job.name], now) or changed
+			if delivered:
+				store_snapshots(delivered, now)
+
+			sources = load_sources()
+			previous, stale = stale, stale_sources(sources[3], now)
+			changed = changed or stale != previous	# data of a failing source just became old: mark them
+
+			if changed:
+				if ahead:
+					ahead.invalidate()
+				try:
+					render_displays(sources)
+				except Exception:
+					logging.exception("FAIL | render failed")
+
+			if ahead:
+				try:
+					render_ahead(ahead, time.time())
+				except Exception:
+					logging.exception("FAIL | render ahead failed")
+
+			if due:
+				save_schedule(daemon_updates(jobs, now), now, changed)
+				httpcache.save_stats(max(CACHE_TTL.values()) + CACHE_GRACE)
+				metrics.save()
+
+			wakeup = min(job.next_run for job in jobs)
+			if ahead:	# also for the next frame to render ahead, or earlier if the sync service learns of a new wakeup
+				wakeup = min(wakeup, ahead.next_due(time.time()) or wakeup)
+				ahead.wait(max(1, wakeup - time.time()))
+			else:
+				time.sleep(max(1, wakeup - time.time()))
+	finally:
+		if syncserver:
+			syncserver.stop()
+		if db:
+			db.close()
+		uba.close()
+		renderpool.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Kindle weather display: fetch weather, sensor and air quality data and render PNGs")
+	mode = parser.add_mutually_exclusive_group()
+	mode.add_argument("--once", action="store_true", help="fetch, render and exit (cron)")
+	mode.add_argument("--daemon", action="store_true", help="keep running and refresh each source on its own interval")
+	mode.add_argument("--backfill-aggregates", action="store_true", help="rebuild the daily aggregates (%s) from %s and exit" % (SQLTAB3, SERIES or SQLTAB))
+	mode.add_argument("--render", action="store_true", help="render the displays from the last good data (%s) only, no network" % SNAPSHOTS)
+	mode.add_argument("--serve", action="store_true", help="run only the sync service for the Kindles (SYNC_PORT)")
+	mode.add_argument("--migrate-series", action="store_true", help="copy %s into the typed SERIES tables and exit" % SQLTAB)
+	args = parser.parse_args()
+
+	if args.backfill_aggregates:
+		db = sqlconnect()
+		try:
+			if series is not None:
+				daily.backfill(db, SERIES, timestamp="ts")
+			else:
+				daily.backfill(db, SQLTAB)
+		finally:
+			db.close()
+	elif args.render:
+		run_render()
+	elif args.serve:
+		if not SYNC_PORT:
+			parser.error("SYNC_PORT is not set")
+		server = sync_server()
+		logging.info("OK | sync server on port %s" % SYNC_PORT)
+		try:
+			server.serve_forever()
+		finally:
+			server.server_close()
+	elif args.migrate_series:
+		if series is None:
+			parser.error("SERIES is not set")
+		db = sqlconnect()
+		try:
+			series.migrate(db, SQLTAB, hours=MIGRATE_HOURS)
+		finally:
+			db.close()
+		uba.migrate(MIGRATE_HOURS)
+	elif args.daemon or (RUNMODE == "daemon" and not args.once):
+		run_daemon()
 	else:
-		logging.warn("WARN | Room not defined, no specific data replaced")
-
-	codecs.open(SVG_OUTPUT, "w", encoding="utf-8").write(output)
-	drawing = svg2rlg(SVG_OUTPUT)	# Convert SVG to regular expression
-	renderPM.drawToFile(drawing, TMP_OUTPUT, fmt="PNG")	# Convert SVG to PNG
-	png_8bit = Image.open(TMP_OUTPUT).convert(mode='L') # Kindle needs true 8-bit grayscale PNG, otherwise it is distorted
-	png_8bit.save(TMP_OUTPUT, optimize=True)	# Compress PNG
-	_exec("mv -f '%s' '%s'" % (TMP_OUTPUT, OUTPUT)) # Change filename
-	_exec("rm -f '%s'" % SVG_OUTPUT)	# Remove temporary files
-
-if LogWrt==1:
-	logging.info("SCRIPT END\n")
+		run_once()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+#######################################################
+### Display registry                                  #
+### Used by: cron_kindle-weather.py                   #
+###                                                   #
+### Which Kindle shows what: one entry per display    #
+### with template, resolution, indoor sensor(s),      #
+### output PNG and its format (gray depth, dithering, #
+### compression). Outdoor sensor, forecast and air    #
+### quality are shared by all displays.               #
+### Example: displays.example.json (copy it to        #
+### displays.json, it is not loaded as it is)         #
+#######################################################
+
+import os
+import json
+from eink_output import DITHER, COMPRESS
+
+
+class Display:
+
+	def __init__(self, name, room, template, resolution=None, sensors=(), output=None, depth=None, dither=None, compress=None):
+		self.name = name				# used in the default output name, same as ROOM in Kindle/weather.conf
+		self.room = room				# shown as "Innen (<room>)"
+		self.template = template		# SVG template with placeholders
+		self.resolution = tuple(resolution) if resolution else None	# (width, height) of the Kindle screen
+		self.sensors = list(sensors)	# Homematic device IDs of the indoor sensors, the first one with a value wins
+		self.output = output
+		self.depth = depth				# 8 = 256 gray levels, 4 = 16 levels as 4-bit PNG, None = DEPTH of the script
+		self.dither = dither			# 16 levels: "none", "ordered" or "floyd-steinberg", None = DITHER of the script
+		self.compress = compress		# "size" or "speed" (PNG encoding), None = PNG_COMPRESS of the script
+
+	def __repr__(self):
+		return "Display(%s)" % self.name
+
+
+def _path(basedir, path):
+	return path if os.path.isabs(path) else os.path.join(basedir, path)
+
+
+def load_registry(path, basedir):
+	# Returns (outdoor device ID, [Display, ...]), relative paths in the file are relative to basedir
+	with open(path, "r") as f:
+		registry = json.load(f)
+	displays = []
+	for entry in registry["displays"]:
+		name = entry.get("name") or entry["room"].lower()
+		output = entry.get("output") or "weatherdata-%s.png" % name
+		display = Display(name, entry.get("room", name), _path(basedir, entry["template"]),
+			entry.get("resolution"), entry.get("sensors", []), _path(basedir, output),
+			entry.get("depth"), entry.get("dither"), entry.get("compress"))
+		if display.depth not in (None, 4, 8):
+			raise ValueError("%s: display %s: depth must be 8 or 4, not %s" % (path, name, display.depth))
+		if display.dither not in (None,) + DITHER:
+			raise ValueError("%s: display %s: dither must be one of %s, not %s" % (path, name, ", ".join(DITHER), display.dither))
+		if display.compress not in (None,) + tuple(COMPRESS):
+			raise ValueError("%s: display %s: compress must be one of %s, not %s" % (path, name, ", ".join(sorted(COMPRESS)), display.compress))
+		displays.append(display)
+	names = [display.name for display in displays]
+	duplicates = set(name for name in names if names.count(name) > 1)
+	if duplicates:
+		raise ValueError("%s: display names used more than once: %s" % (path, ", ".join(sorted(duplicates))))
+	return (registry.get("outdoor"), displays)
+
+
+def legacy_registry(devices, rooms, template, resolutions, basedir):
+	# Former configuration: devices = [outdoor, room 1, room 2, ...], one template scaled to the resolution
+	# of each room (None = size of the template)
+	displays = []
+	for n, room in enumerate(rooms):
+		displays.append(Display(room.lower(), room, template, resolutions[n] if n < len(resolutions) else None, devices[n + 1:n + 2],
+			os.path.join(basedir, "weatherdata-%s.png" % room.lower())))
+	return (devices[0] if devices else None, displays)
+
+
+def registry_devices(outdoor, displays):
+	# All Homematic devices to request, each only once
+	devices = [outdoor] if outdoor is not None else []
+	for display in displays:
+		for device in display.sensors:
+			if device not in devices:
+				devices.append(device)
+	return devices
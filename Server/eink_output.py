@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+#######################################################
+### E-ink output stage: 16 gray levels, 4-bit PNG     #
+### Used by: render_pipeline.py, render_pool.py       #
+###                                                   #
+### The Kindle panels show 16 gray levels, so the     #
+### frame is quantized to these levels on the server  #
+### (plain, ordered or Floyd-Steinberg dithering) and #
+### written as 4-bit grayscale PNG (color type 0, no  #
+### palette: eips distorts palette PNGs). Half the    #
+### pixel data of an 8-bit PNG, less to compress and  #
+### less to download on every wake.                   #
+#######################################################
+
+import zlib
+import struct
+from PIL import Image
+try:
+	import numpy # optional: without NumPy no ordered dithering and no 4-bit PNG (8-bit is written instead)
+except ImportError:
+	numpy = None
+
+LEVELS = 16			# gray levels of the Kindle panels
+DITHER = ("none", "ordered", "floyd-steinberg")
+COMPRESS = {"speed": 1, "size": 9}	# zlib level per choice
+BAYER = [[0, 8, 2, 10],		# 4x4 ordered dither matrix
+		[12, 4, 14, 6],
+		[3, 11, 1, 9],
+		[15, 7, 13, 5]]
+
+
+def quantize(image, levels=LEVELS, dither="none"):
+	# image: PIL image mode 'L', returns mode 'L' with only the values 0, 255/(levels-1), ..., 255
+	if dither not in DITHER:
+		raise ValueError("unknown dither '%s', use one of %s" % (dither, ", ".join(DITHER)))
+	step = 255.0 / (levels - 1)
+	if dither == "floyd-steinberg":
+		# Error diffusion is sequential per pixel, Pillow's C implementation is far faster than any Python loop
+		palette = Image.new("P", (1, 1))
+		grays = [int(round(n * step)) for n in range(levels)]
+		palette.putpalette([g for g in grays for _ in range(3)] + [grays[-1]] * 3 * (256 - levels))
+		return image.convert("RGB").quantize(palette=palette, dither=Image.Dither.FLOYDSTEINBERG).convert("L")
+	if dither == "ordered" and numpy is not None:
+		a = numpy.asarray(image, dtype=numpy.float32) / step
+		height, width = a.shape
+		threshold = (numpy.array(BAYER, dtype=numpy.float32) + 0.5) / 16 - 0.5	# -0.47 .. +0.47 of one level
+		a += numpy.tile(threshold, (-(-height // 4), -(-width // 4)))[:height, :width]
+		q = numpy.clip(numpy.rint(a), 0, levels - 1)
+		return Image.fromarray((q * step + 0.5).astype(numpy.uint8), "L")
+	return image.point([int(round(round(v / step) * step)) for v in range(256)])	# plain rounding, lookup table
+
+
+def _chunk(tag, data):
+	return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+
+def encode_png4(image, compress="size"):
+	# image: mode 'L' quantized to 16 levels, returns a 4-bit grayscale PNG
+	q = (numpy.asarray(image, dtype=numpy.uint16) * 15 + 127) // 255	# 0..15
+	height, width = q.shape
+	if width % 2:
+		q = numpy.hstack([q, numpy.zeros((height, 1), dtype=numpy.uint16)])
+	packed = ((q[:, 0::2] << 4) | q[:, 1::2]).astype(numpy.uint8)	# two pixels per byte, left one in the high nibble
+	# Filter type 0 (None) per row: with 16 flat levels the Sub/Up filters only made the frames larger
+	rows = numpy.hstack([numpy.zeros((height, 1), dtype=numpy.uint8), packed])
+	data = zlib.compress(rows.tobytes(), COMPRESS[compress])
+	header = struct.pack(">IIBBBBB", width, height, 4, 0, 0, 0, 0)	# bit depth 4, color type 0 (grayscale)
+	return b"\x89PNG\r\n\x1a\n" + _chunk(b"IHDR", header) + _chunk(b"IDAT", data) + _chunk(b"IEND", b"")
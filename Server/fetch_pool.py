@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+#######################################################
+### Concurrent fetching with per-source deadlines     #
+### Used by: cron_kindle-weather.py,                  #
+###          get_uba_airquality.py                    #
+###                                                   #
+### All sources (Dark Sky, Homematic devices, UBA     #
+### stations) run in their own thread. Retries use    #
+### exponential backoff inside that thread, so a slow #
+### source never blocks the others. After the overall #
+### deadline the caller continues with the results    #
+### that have arrived. Requests opened with urlopen() #
+### here are cut off at the deadline, so late         #
+### threads end with it and do not hold up the exit   #
+### of a cron run.                                    #
+#######################################################
+
+import time
+import socket
+import random
+import logging
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+from stage_metrics import metrics
+
+
+class Deadline:
+
+	def __init__(self, seconds):
+		self.end = time.monotonic() + seconds
+
+	def remaining(self):
+		return max(0, self.end - time.monotonic())
+
+	def expired(self):
+		return self.remaining() <= 0
+
+	def timeout(self, seconds):
+		# Socket timeout for one request: per-source timeout, but never beyond the overall deadline
+		return max(0.1, min(seconds, self.remaining()))
+
+
+class DeadlineResponse:
+	# HTTP response cut off at the deadline: a timer shuts the socket down, so a read blocked in a slow
+	# response returns at once and raises instead of handing back a truncated body
+
+	def __init__(self, response, deadline):
+		self.response = response
+		self.expired = False
+		self.sock = getattr(getattr(response.fp, "raw", None), "_sock", None)	# http.client keeps no public handle
+		self.timer = threading.Timer(deadline.remaining(), self._expire)
+		self.timer.daemon = True
+		self.timer.start()
+
+	def _expire(self):
+		self.expired = True
+		if self.sock is not None:
+			try:
+				self.sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+	def _read(self, func, *args):
+		try:
+			data = func(*args)
+		except Exception:
+			if self.expired:
+				raise socket.timeout("deadline passed while reading the response")
+			raise
+		if self.expired:
+			raise socket.timeout("deadline passed while reading the response")
+		return data
+
+	def read(self, *args):
+		return self._read(self.response.read, *args)
+
+	def readline(self, *args):
+		return self._read(self.response.readline, *args)
+
+	def __iter__(self):
+		while True:
+			line = self.readline()
+			if not line:
+				return
+			yield line
+
+	def __getattr__(self, name):
+		return getattr(self.response, name)	# status, headers, ...
+
+	def close(self):
+		self.timer.cancel()
+		self.response.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def urlopen(request, timeout, deadline=None):
+	# urllib.request.urlopen, with a deadline neither the connect nor reading the response goes beyond it
+	response = urllib.request.urlopen(request, timeout=deadline.timeout(timeout) if deadline else timeout)
+	return DeadlineResponse(response, deadline) if deadline is not None else response
+
+
+def retry(func, name, tries=3, delay=2, factor=2, deadline=None):
+	# Call func() up to "tries" times, waiting delay, delay*factor, delay*factor^2, ... (+-20% jitter) in between.
+	# Gives up early if the next wait would pass the deadline. The last exception is raised to the caller.
+	attempt = 0
+	while True:
+		attempt = attempt + 1
+		try:
+			return func()
+		except Exception as e:
+			logging.warning("WARN | %s not successful - error <%s> on trial no %s" % (name, e, attempt))
+			pause = delay * factor ** (attempt - 1) * random.uniform(0.8, 1.2)
+			if attempt >= tries or (deadline is not None and pause >= deadline.remaining()):
+				raise
+			metrics.count("retries")
+			time.sleep(pause)
+
+
+def fetch_all(tasks, deadline):
+	# tasks: dict name -> callable without arguments. Returns dict name -> result for all tasks that
+	# finished successfully before the deadline. Failed or late tasks are logged and left out.
+	results = {}
+	if not tasks:
+		return results
+	pool = ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="fetch")
+	futures = {pool.submit(metrics.within(func)): name for name, func in tasks.items()}	# counters of the threads go to the caller's stage
+	done, pending = wait(futures, timeout=deadline.remaining())
+	for future in done:
+		name = futures[future]
+		try:
+			results[name] = future.result()
+		except Exception as e:
+			logging.error("FAIL | %s failed - %s" % (name, e))
+	for future in pending:
+		logging.error("FAIL | %s: no result before deadline" % (futures[future]))
+		future.cancel()
+	pool.shutdown(wait=False)	# late threads end at the deadline as well (urlopen), the interpreter joins them at exit
+	return results
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+#######################################################
+### Dirty regions between two frames                  #
+### Used by: render_pool.py                           #
+###                                                   #
+### The new frame is compared with the last published #
+### one (NumPy, whole image at once). Changed pixels  #
+### are collected on a grid of TILE x TILE cells and  #
+### merged into a few rectangles, which the Kindle    #
+### can draw with "eips -g tile.png -x X -y Y" instead#
+### of the whole image. The changed area (per mille   #
+### of the screen) drives the full refresh (flash).   #
+#######################################################
+
+try:
+	import numpy # optional: without NumPy no tiles are produced, the Kindle loads the whole image
+except ImportError:
+	numpy = None
+
+TILE = 32			# grid in pixels, tiles start and end on this grid (eips is fastest with aligned regions)
+THRESHOLD = 8		# gray value difference below which a pixel counts as unchanged (anti-aliasing noise)
+
+
+def _runs(row):
+	# Column ranges [start, end) of True cells in one grid row
+	runs = []
+	start = None
+	for c, changed in enumerate(row):
+		if changed and start is None:
+			start = c
+		elif not changed and start is not None:
+			runs.append((start, c))
+			start = None
+	if start is not None:
+		runs.append((start, len(row)))
+	return runs
+
+
+def _union(a, b):
+	return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _area(box):
+	return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def merge_boxes(boxes, max_boxes, slack=2):
+	# Merge the pair whose bounding box adds the least unchanged area until at most max_boxes are left
+	# and no pair can be merged by adding up to "slack" unchanged cells (one eips call less)
+	boxes = list(boxes)
+	if len(boxes) > 4 * max_boxes:	# scattered changes everywhere: one box is good enough
+		union = boxes[0]
+		for box in boxes[1:]:
+			union = _union(union, box)
+		return [union]
+	while len(boxes) > 1:
+		best = None
+		for i in range(len(boxes)):
+			for j in range(i + 1, len(boxes)):
+				union = _union(boxes[i], boxes[j])
+				cost = _area(union) - _area(boxes[i]) - _area(boxes[j])
+				if best is None or cost < best[0]:
+					best = (cost, i, j, union)
+		cost, i, j, union = best
+		if len(boxes) <= max_boxes and cost > slack:
+			break
+		boxes = [box for n, box in enumerate(boxes) if n not in (i, j)] + [union]
+	return boxes
+
+
+def changed_boxes(old, new, max_boxes=6, tile=TILE, threshold=THRESHOLD):
+	# old, new: PIL images mode 'L' of the same size
+	# Returns [(left, upper, right, lower), ...] in pixels (PIL crop box), [] if nothing changed, None without NumPy
+	if numpy is None:
+		return None
+	a = numpy.asarray(old, dtype=numpy.int16)
+	b = numpy.asarray(new, dtype=numpy.int16)
+	if a.shape != b.shape:
+		raise ValueError("frames differ in size: %s, %s" % (a.shape, b.shape))
+	height, width = a.shape
+	rows = -(-height // tile)
+	cols = -(-width // tile)
+	changed = numpy.zeros((rows * tile, cols * tile), dtype=bool)
+	changed[:height, :width] = numpy.abs(a - b) > threshold
+	grid = changed.reshape(rows, tile, cols, tile).any(axis=(1, 3))	# one flag per cell
+
+	# Runs of changed cells per row, equal runs in consecutive rows are joined to one rectangle
+	boxes = []
+	open_boxes = {}	# (c0, c1) -> [c0, r0, c1, r1] in cells
+	for r in range(rows):
+		current = {}
+		for run in _runs(grid[r]):
+			box = open_boxes.get(run)
+			if box is not None:
+				box[3] = r + 1
+			else:
+				box = [run[0], r, run[1], r + 1]
+			current[run] = box
+		for run, box in open_boxes.items():
+			if run not in current:
+				boxes.append(tuple(box))
+		open_boxes = current
+	boxes.extend(tuple(box) for box in open_boxes.values())
+
+	boxes = merge_boxes(boxes, max_boxes) if boxes else []
+	return [(c0 * tile, r0 * tile, min(c1 * tile, width), min(r1 * tile, height)) for c0, r0, c1, r1 in boxes]
+
+
+def changed_area(boxes, size):
+	# Changed part of the screen in per mille (1000 = everything)
+	return min(1000, int(round(1000.0 * sum(_area(box) for box in boxes) / (size[0] * size[1]))))
@@ -1,199 +1,381 @@
 #!/usr/bin/python3
 
-def get_uba_airquality(state):
-	#############################################################################
-	# Skript zum Auslesen der UBA Luftqualitätsdaten                            #
-	# Autor: Philippe Renault                                                   #
-	# Datum: 28.05.2020                                                         #
-	# Kommentare: Werte brauchen nur alle 6h ab Mitternacht abgefragt zu werden #
-	# Anzupassen je nach Standort ist/sind die Stationsnummer(n),               #
-	# ebenfalls das Login für die Datenbank (siehe "XXX" als Platzhalter)       #
-	#############################################################################
-
-	# Beispiel CSV vom UBA für zwei Stationen in der Nähe von Musterhausen
-	#---------------------------------------------------------------------
-	# Stationscode	Datum	Feinstaub (PM₁₀) stündlich gleitendes Tagesmittel in µg/m³	Ozon (O₃) Ein-Stunden-Mittelwert in µg/m³	Stickstoffdioxid (NO₂) Ein-Stunden-Mittelwert in µg/m³	Luftqualitätsindex
-	# DENW074	'01.01.2020 01:00'	29	52	-	gut
-	# DENW329	'01.01.2020 01:00'	16	-	9	sehr gut
-	#
-	# Einheiten: µg/m³
-	# Grenzwerte: PM10 = 50, NO2 = 200, O3 = 120
-	#
-	# Quelle: Umweltbundesamt, https://www.umweltbundesamt.de/daten/luft/luftdaten/luftqualitaet. Alle Uhrzeiten sind in der jeweils zum Messzeitpunkt gültigen Zeit (MEZ bzw. MESZ) angegeben.
-
-	# Luftqualitätsindex (Quelle: https://www.umweltbundesamt.de/berechnungsgrundlagen-luftqualitaetsindex)
-	#-------------------
-	# Der Index basiert auf der gesundheitlichen Bewertung von Ozon- und NO2- Stundenmittelwerten und stündlich gleitenden PM10-Tagesmittelwerten. Zur Indexberechnung muss mindestens einer dieser drei Schadstoffe an der Station gemessen werden.
-	# Anhand der aktuellsten, stündlichen Werte einer Station werden die gemessenen Schadstoffe mit folgenden Schwellwerten kategorisiert. Der Schadstoff, der die schlechteste Luftqualität aufweist, bestimmt die Indexfarbe.
-	# Farbe, Index,	Stundenmittel NO2 in μg/m³,	stündlich gleitendes Tagesmittel PM10 in μg/m³,	Stundenmittel O3 in μg/m³
-	# Dunkelrot, sehr schlecht,	> 200,	> 100,	> 240
-	# Rot, schlecht,	101-200,	51-100,	181-240
-	# Gelb, mäßig,	41-100,	36-50,	121-180
-	# Grün, gut,	21-40,	21-35,	61-120
-	# Türkis, sehr gut,	0-20,	0-20,	0-60
-
-	# Verhaltensempfehlungen:
-	# sehr schlecht:	Negative gesundheitliche Auswirkungen können auftreten. Wer empfindlich ist oder vorgeschädigte Atemwege hat, sollte körperliche Anstrengungen im Freien vermeiden.
-	# schlecht:	Bei empfindlichen Menschen können nachteilige gesundheitliche Wirkungen auftreten. Diese sollten körperlich anstrengende Tätigkeiten im Freien vermeiden. In Kombination mit weiteren Luftschadstoffen können auch weniger empfindliche Menschen auf die Luftbelastung reagieren.
-	# mäßig:	Kurzfristige nachteilige Auswirkungen auf die Gesundheit sind unwahrscheinlich. Allerdings können Effekte durch Luftschadstoffkombinationen und bei langfristiger Einwirkung des Einzelstoffes nicht ausgeschlossen werden. Zusätzliche Reize, z.B. ausgelöst durch Pollenflug, können die Wirkung der Luftschadstoffe verstärken, so dass Effekte bei empfindlichen Personengruppen (z.B. Asthmatikern) wahrscheinlicher werden.
-	# gut:	Genießen Sie Ihre Aktivitäten im Freien, gesundheitlich nachteilige Wirkungen sind nicht zu erwarten.
-	# sehr gut:	Beste Voraussetzungen, um sich ausgiebig im Freien aufzuhalten.
-
-
-	##############
-	# Libraries
-	import csv
-	import codecs
-	import io
-	import urllib.request
-	from datetime import datetime, time, timedelta
-	import pymysql
-	#import pprint
-
-	###########
-	# Variables
-	stations = ['1372','1129'] # Jackerath, Niederzier as example
-
-	minus2st = timedelta(hours=-2) # Data are updated only once the full hour, so go back to previous hour for request
-	stunde = datetime.now() + minus2st
-	stunde = stunde.strftime('%H')
-	if datetime.now().strftime('%H') != '00': # Handle previous day due to -2 hours
-		datum = datetime.now().strftime('%Y-%m-%d')
-	else:
-		datum = datetime.now() + timedelta(days=-1)
-		datum = datum.strftime('%Y-%m-%d')
+#############################################################################
+# Skript zum Auslesen der UBA Luftqualitätsdaten                            #
+# Autor: Philippe Renault                                                   #
+# Datum: 28.05.2020                                                         #
+# Kommentare: Werte brauchen nur alle 6h ab Mitternacht abgefragt zu werden #
+# Lücken nachträglich füllen (alle Stationen, stündlich):                   #
+#   get_uba_airquality.py --backfill 2020-09-01 2020-09-15                  #
+# Anzupassen je nach Standort ist/sind die Stationsnummer(n),               #
+# ebenfalls das Login für die Datenbank (siehe "XXX" als Platzhalter)       #
+#############################################################################
+
+# Beispiel CSV vom UBA für zwei Stationen in der Nähe von Musterhausen
+#---------------------------------------------------------------------
+# Stationscode	Datum	Feinstaub (PM₁₀) stündlich gleitendes Tagesmittel in µg/m³	Ozon (O₃) Ein-Stunden-Mittelwert in µg/m³	Stickstoffdioxid (NO₂) Ein-Stunden-Mittelwert in µg/m³	Luftqualitätsindex
+# DENW074	'01.01.2020 01:00'	29	52	-	gut
+# DENW329	'01.01.2020 01:00'	16	-	9	sehr gut
+#
+# Einheiten: µg/m³
+# Grenzwerte: PM10 = 50, NO2 = 200, O3 = 120
+#
+# Quelle: Umweltbundesamt, https://www.umweltbundesamt.de/daten/luft/luftdaten/luftqualitaet. Alle Uhrzeiten sind in der jeweils zum Messzeitpunkt gültigen Zeit (MEZ bzw. MESZ) angegeben.
+
+# Luftqualitätsindex (Quelle: https://www.umweltbundesamt.de/berechnungsgrundlagen-luftqualitaetsindex)
+#-------------------
+# Der Index basiert auf der gesundheitlichen Bewertung von Ozon- und NO2- Stundenmittelwerten und stündlich gleitenden PM10-Tagesmittelwerten. Zur Indexberechnung muss mindestens einer dieser drei Schadstoffe an der Station gemessen werden.
+# Anhand der aktuellsten, stündlichen Werte einer Station werden die gemessenen Schadstoffe mit folgenden Schwellwerten kategorisiert. Der Schadstoff, der die schlechteste Luftqualität aufweist, bestimmt die Indexfarbe.
+# Farbe, Index,	Stundenmittel NO2 in μg/m³,	stündlich gleitendes Tagesmittel PM10 in μg/m³,	Stundenmittel O3 in μg/m³
+# Dunkelrot, sehr schlecht,	> 200,	> 100,	> 240
+# Rot, schlecht,	101-200,	51-100,	181-240
+# Gelb, mäßig,	41-100,	36-50,	121-180
+# Grün, gut,	21-40,	21-35,	61-120
+# Türkis, sehr gut,	0-20,	0-20,	0-60
+
+# Verhaltensempfehlungen:
+# sehr schlecht:	Negative gesundheitliche Auswirkungen können auftreten. Wer empfindlich ist oder vorgeschädigte Atemwege hat, sollte körperliche Anstrengungen im Freien vermeiden.
+# schlecht:	Bei empfindlichen Menschen können nachteilige gesundheitliche Wirkungen auftreten. Diese sollten körperlich anstrengende Tätigkeiten im Freien vermeiden. In Kombination mit weiteren Luftschadstoffen können auch weniger empfindliche Menschen auf die Luftbelastung reagieren.
+# mäßig:	Kurzfristige nachteilige Auswirkungen auf die Gesundheit sind unwahrscheinlich. Allerdings können Effekte durch Luftschadstoffkombinationen und bei langfristiger Einwirkung des Einzelstoffes nicht ausgeschlossen werden. Zusätzliche Reize, z.B. ausgelöst durch Pollenflug, können die Wirkung der Luftschadstoffe verstärken, so dass Effekte bei empfindlichen Personengruppen (z.B. Asthmatikern) wahrscheinlicher werden.
+# gut:	Genießen Sie Ihre Aktivitäten im Freien, gesundheitlich nachteilige Wirkungen sind nicht zu erwarten.
+# sehr gut:	Beste Voraussetzungen, um sich ausgiebig im Freien aufzuhalten.
+
+##############
+# Libraries
+import csv
+import codecs
+import io
+import argparse
+from datetime import datetime, timedelta
+import pymysql
+import logging
+from fetch_pool import Deadline, retry, fetch_all, urlopen
+from sql_buffer import WriteBuffer
+from stage_metrics import metrics
+from timeseries import TimeSeries
+from air_quality import LABELS, POLLUTANTS, MISSING, parse_csv, combine, number
+#import pprint
+
+###########
+# Variables
+stations = ['1372','1129'] # Jackerath, Niederzier as example
+UBA_URL = "https://www.umweltbundesamt.de/api/air_data/v2"	# UBA Air Data API
+
+#SQL Database connection credentials
+SQLHOST = "localhost"
+SQLPORT = 3307				# Port must be specified as number not string	
+SQLUSER = "root"
+SQLPW = "XXX"
+SQLDB = "uba_data"			# Name of database with the following two tables
+SQLTAB = "STATION_DATA"		# Table with final station data in three rows: SCHADSTOFF, MESSWERT, DATETIME
+SQLTAB2 = "airqualityindex" # Table for lookup of description based on airqualityindex (LQI)
+SQLTAB3 = "STATION_LATEST"	# Latest value per SCHADSTOFF, kept up to date with each write (created automatically)
+SERIES = None				# Typed storage instead of SQLTAB, e.g. "STATION_SERIES" (DOUBLE, rollups, see timeseries.py)
+							# Existing data: cron_kindle-weather.py --migrate-series. None = SQLTAB as before
+RETENTION = {"raw": 730, "5m": 730, "1h": 3650, "1d": None}	# SERIES: days kept per level, None = forever
+
+TIMEOUT = 20				# Timeout in seconds for one CSV request
+MAX_TRIES = 3				# Tries per station, with exponential backoff in between
+DEADLINE = 60				# Overall deadline for all stations (if not given by caller)
+BACKFILL_DAYS = 31			# --backfill: days per request and station
+BACKFILL_BATCH = 500		# --backfill: rows per transaction
+
+CREATE_LATEST = """CREATE TABLE IF NOT EXISTS %s (
+	schadstoff VARCHAR(16) NOT NULL,
+	messwert DOUBLE,
+	datetime DATETIME NOT NULL,
+	PRIMARY KEY (schadstoff)
+)"""
+
+lqi_list = LABELS	# 1 = sehr schlecht ... 5 = sehr gut, 99 = k.A., thresholds see air_quality.py
+
+
+############
+# Functions
+def uba_hour(now=None):
+	# Data are updated only once the full hour, so go back two hours for the request
+	now = now or datetime.now()
+	stunde = (now + timedelta(hours=-2)).strftime('%H')
+	if now.strftime('%H') != '00':
+		datum = now.strftime('%Y-%m-%d')
+	else: # Handle previous day due to -2 hours
+		datum = (now + timedelta(days=-1)).strftime('%Y-%m-%d')
 		stunde = '21'
-		
-	#SQL Database connection credentials
-	SQLHOST = "localhost"
-	SQLPORT = 3307				# Port must be specified as number not string	
-	SQLUSER = "root"
-	SQLPW = "XXX"
-	SQLDB = "uba_data"			# Name of database with the following two tables
-	SQLTAB = "STATION_DATA"		# Table with final station data in three rows: SCHADSTOFF, MESSWERT, DATETIME
-	SQLTAB2 = "airqualityindex" # Table for lookup of description based on airqualityindex (LQI)
-
-
-	############
-	# Functions
-	def sqlinsert(cursor, datapointid, value):
-		sql_query = "INSERT INTO %s (schadstoff, messwert, datetime) VALUES ('%s', '%s', CURRENT_TIMESTAMP)" % (SQLTAB, datapointid, value)
-		cursor.execute(sql_query)
-		db.commit()
-		
-	def sqlseluba(cursor, datapointid): # Return last value of a list 
-		sql_query = "SELECT `Messwert` FROM %s WHERE `Schadstoff` = '%s' AND DATE(`DateTime`) = DATE(NOW()) ORDER BY `DateTime` +0 DESC LIMIT 1" % (SQLTAB, datapointid)
-		cursor.execute(sql_query)
-		for select in cursor.fetchall():
-			return('%d' % select["Messwert"])
-
-	#####################
-	db = pymysql.connect(
-		host=SQLHOST,
-		port=SQLPORT,
-		user=SQLUSER, 
-		password=SQLPW,
-		db=SQLDB,
-		charset='utf8mb4',
-		cursorclass=pymysql.cursors.DictCursor)
-
-	cursor = db.cursor()
-
-	# Initalize data array
-	DATA = {'PM10': 0, 
-			'O3': 0,
-			'NO2': 0,
+	return (datum, stunde)
+
+def hour_values(hours, i):
+	# Hour i of air_quality.combine() -> {'PM10': float, 'O3': ..., 'NO2': ..., 'LQI': int}, None = not measured
+	DATA = {}
+	for key in POLLUTANTS:
+		value = hours[key][i]
+		DATA[key] = value if value == value else None
+	DATA['LQI'] = hours['LQI'][i] if hours['LQI'][i] != MISSING else None
+	return DATA
+
+def epoch(value):
+	# DATETIME from the DB or "YYYY-mm-dd HH:MM:SS" of air_quality.combine() -> epoch seconds (local time)
+	return datetime.strptime(str(value)[:19], "%Y-%m-%d %H:%M:%S").timestamp()
+
+def empty_data():
+	# Initalize data array, pollutants without a value are shown as "-" (same as refresh)
+	return {'PM10': '-',
+			'O3': '-',
+			'NO2': '-',
 			'LQI': 0}
 
-	lqi_list = {1: 'sehr schlecht',
-		2: 'schlecht',
-		3: 'mäßig',
-		4: 'gut',
-		5: 'sehr gut',
-		99: 'k.A.'}
-		
-	#####################
-	if state == 'write':
-		# CSV-request
-		dict_list = []
+
+class UbaClient:
+	# One client per process: one DB connection for all calls, the result is kept in memory and
+	# returned again until the next refresh, so several rooms or daemon runs do not query again.
+
+	def __init__(self, cache=None, ttl=86400, spooldir=None):
+		self.cache = cache		# optional http_cache.HttpCache for the CSV requests
+		self.ttl = ttl
+		self.db = None
+		self.created = False
+		self.result = None		# (DATA, LQI text) of the last refresh or read
+		self.written = None		# (datum, stunde) of the last refresh
+		self.measured = None	# epoch seconds of the newest measurement in result, None if it has no values
+		# All values of a refresh in one transaction, spooled to a file if the DB is not available
+		self.series = TimeSeries(SERIES, RETENTION) if SERIES else None
+		table = SERIES or SQLTAB
+		self.sqlbuffer = WriteBuffer(table, ["schadstoff", "messwert", "datetime"],
+			"%s/%s.jsonl" % (spooldir, table) if spooldir else None, self.write, insert=self.series is None)
+
+	def connect(self):
+		# Keep the connection open, reconnect only if it was lost
+		try:
+			if self.db is None:
+				self.db = pymysql.connect(
+					host=SQLHOST,
+					port=SQLPORT,
+					user=SQLUSER,
+					password=SQLPW,
+					db=SQLDB,
+					charset='utf8mb4',
+					cursorclass=pymysql.cursors.DictCursor)
+			else:
+				self.db.ping(reconnect=True)
+		except Exception as e:
+			logging.error("FAIL | no connection to UBA database - %s" % (e))
+			self.close()
+		return self.db
+
+	def close(self):
+		if self.db is not None:
+			try:
+				self.db.close()
+			except Exception:
+				pass
+			self.db = None
+
+	def create(self, cursor):
+		if not self.created:
+			cursor.execute(CREATE_LATEST % SQLTAB3)
+			self.created = True
+
+	def write(self, cursor, rows):
+		# on_flush of the WriteBuffer: typed series (if SERIES is set) and SQLTAB3 in the same transaction
+		if self.series is not None:
+			self.series.write(cursor, rows)
+		self.update_latest(cursor, rows)
+
+	def present(self, cursor, first, last):
+		# (schadstoff, "YYYY-mm-dd HH:MM:SS") already in SQLTAB or SERIES from the hour first to last (inclusive)
+		if self.series is not None:
+			self.series.create(cursor)
+			table, sensor, stamp = SERIES, "sensor", "ts"
+		else:
+			table, sensor, stamp = SQLTAB, "schadstoff", "datetime"
+		cursor.execute("SELECT %s AS schadstoff, %s AS datetime FROM %s WHERE %s >= %%s AND %s <= %%s" % (sensor, stamp, table, stamp, stamp),
+			(first, last))
+		return set((row["schadstoff"], str(row["datetime"])[:19]) for row in cursor.fetchall())
+
+	def update_latest(self, cursor, rows):
+		# Same transaction as the insert into SQLTAB or SERIES.
+		# Replayed (older) rows never overwrite a newer value.
+		self.create(cursor)
+		cursor.executemany("INSERT INTO %s (schadstoff, messwert, datetime) VALUES (%%s, %%s, %%s) "
+			"ON DUPLICATE KEY UPDATE messwert = IF(VALUES(datetime) >= datetime, VALUES(messwert), messwert), "
+			"datetime = GREATEST(datetime, VALUES(datetime))" % SQLTAB3, [tuple(row) for row in rows])
+
+	def fetch_stations(self, datum, stunde, deadline, datum_to=None, stunde_to=None):
+		# CSV-request, all stations in parallel, from datum/stunde to datum_to/stunde_to (default: one hour).
+		# Returns the parsed CSV (see air_quality.parse_csv) of each station that answered, in order of stations
+		datum_to = datum_to or datum
+		stunde_to = stunde_to or stunde
+		def request(url):
+			# Open URL and get content from csv file
+			with urlopen(url, TIMEOUT, deadline) as url_open:
+				return list(csv.reader(codecs.iterdecode(metrics.reader(url_open), 'utf-8'), delimiter=';', dialect='unix'))
+
+		def request_cached(url, station):
+			# Same via HTTP response cache (see http_cache.py), CSV of a past hour is served from disk
+			body = self.cache.get(url, self.ttl, TIMEOUT, MAX_TRIES, deadline, "UBA api request station %s" % station)
+			return list(csv.reader(io.StringIO(body.decode('utf-8')), delimiter=';', dialect='unix'))
+
+		tasks = {}
 		for station in stations:
-			url = 'https://www.umweltbundesamt.de/api/air_data/v2/airquality/csv?date_from=' + datum + '&time_from=' + stunde + '&date_to=' + datum + '&time_to=' + stunde + '&station=' + station + '&lang=de'
+			url = UBA_URL + '/airquality/csv?date_from=' + datum + '&time_from=' + stunde + '&date_to=' + datum_to + '&time_to=' + stunde_to + '&station=' + station + '&lang=de'
 			#url = 'https://www.umweltbundesamt.de/api/air_data/v2/measures/csv?date_from=' + datum + '&time_from=' + stunde + '&date_to=' + datum + '&time_to=' + stunde + '&' + station + '&lang=de'
 			#print(url)
+			if self.cache is not None:
+				tasks[station] = (lambda url=url, station=station: request_cached(url, station))
+			else:
+				tasks[station] = (lambda url=url, station=station: retry(lambda: request(url), "UBA api request station %s" % station, MAX_TRIES, deadline=deadline))
+		results = fetch_all(tasks, deadline)
 
-			tries = 0
-			max_tries = 3
-			while tries < max_tries:
-				try:
-					# Open URL and get content from csv file
-					url_open = urllib.request.urlopen(url)
-					csv_reader = csv.reader(codecs.iterdecode(url_open, 'utf-8'), delimiter=';', dialect='unix')
-
-					line_count = 0
-					
-					for row in csv_reader:
-						if line_count == 0:
-							#print(f'Column names are: {", ".join(row)}')
-							line_count += 1
-						elif line_count == 1:
-							dict_list.append(row)
-							line_count += 1
-						else:
-							#print(f'\t Station:{row[Stationscode]}, Feinstaub (PM10) stündlich gleitendes Tagesmittel in µg/m³:{row[Feinstaub (PM10) stündlich gleitendes Tagesmittel in µg/m³]}, Ozon (O3) Ein-Stunden-Mittelwert in µg/m³:{row[Ozon (O3) Ein-Stunden-Mittelwert in µg/m³]}, Luftqualitätsindex: {row[Luftqualitätsindex]}.')
-							#print(f'\t Station:{row[Stationscode]}, Schadstoff:{row[Schadstoff]}, Messwert:{row[Messwert]} {row[Einheit]}.')
-							line_count += 1
-					#print(f'Processed {line_count} lines.')
-					#pprint.pprint(dict_list)
-
-				except urllib.error.HTTPError as e:
-					tries = tries + 1
-					print("WARNING | UBA api request not successful - error <%s> on trial no %s" % (e.code, tries))
-					time.sleep(10)
-					continue
-				else:
-					break
+		return [parse_csv(results[station]) for station in stations if station in results]	# keep order of stations
+
+	def refresh(self, deadline):
+		# Fetch the current hour from the UBA API and write it to the DB
+		datum, stunde = uba_hour()
+		hours = combine(self.fetch_stations(datum, stunde, deadline))
+		if not hours['times']:
+			logging.warning("WARN | no UBA data for %s %s:00, last values from the DB are shown" % (datum, stunde))
+			return self.read()
 
 		#####################
-		# Evaluation air-quality index (LQI)
+		# Evaluation air-quality index (LQI), see air_quality.py
 		# Max value of all considered stations is retained to set the value and air quality
-
-		PM10 = max(dict_list[0][2],dict_list[1][2])
-		O3 = max(dict_list[0][3],dict_list[1][3])
-		NO2 = max(dict_list[0][4],dict_list[1][4])
-		LQI = [dict_list[0][5],dict_list[1][5]]
-		idx = 99
-		for val in LQI:
-			keys = [key for key, value in lqi_list.items() if value == val]
-			idx = min(idx,keys[0])
+		DATA = hour_values(hours, -1)
+		time = hours['times'][-1]	# hour of the measurement, same key as written by backfill
+		idx = DATA['LQI'] or MISSING
 		#print(f'Luftqualität: {lqi_list[idx]}')
 
-		DATA = {'PM10': PM10, 
-				'O3': O3,
-				'NO2': NO2,
-				'LQI': idx}
-
 		#####################
-		# Write data to SQL database
-		try:
-			for key in DATA:
-				datapointid = key
-				value = DATA[key]
-				sqlinsert(cursor, datapointid, value)
-		finally:
-			db.close()
-
-	elif state == 'read':
-		#####################
-		# Read last data from SQL database
-		try:
-			for key in DATA:
-				datapointid = key
-				DATA[key] = sqlseluba(cursor, str(datapointid))
-				if DATA['LQI'] is None:
-					idx = 99
+		# Write data to SQL database (and SQLTAB3 in the same transaction), not measured values are left out
+		# Values of this hour already written (by an earlier run in the same UBA check window or a backfill) are skipped
+		db = self.connect()
+		present = set()
+		if db is not None:
+			try:
+				with db.cursor() as cursor:
+					present = self.present(cursor, time, time)
+				db.commit()
+			except Exception as e:
+				logging.warning("WARN | UBA values of %s not checked in the DB - %s" % (time, e))
+		for key in DATA:
+			if DATA[key] is not None and (key, time) not in present:
+				self.sqlbuffer.add(key, DATA[key], ts=time)
+		self.sqlbuffer.flush(db)
+		if self.series is not None:
+			self.series.prune(self.db)
+		self.written = (datum, stunde)
+		self.measured = epoch(time)
+		for key in POLLUTANTS:
+			DATA[key] = '%d' % DATA[key] if DATA[key] is not None else '-'
+		DATA['LQI'] = idx
+		return (DATA, lqi_list[idx])
+
+	def backfill(self, first, last):
+		# Hourly values of all stations from the date first to last (inclusive) into the DB: one request per
+		# station for BACKFILL_DAYS days, BACKFILL_BATCH rows per transaction. Hours already in the DB are skipped,
+		# the timestamp is the hour of the measurement (as with a refresh).
+		db = self.connect()
+		if db is None:
+			return 0
+		written = 0
+		day = first
+		while day <= last:
+			end = min(day + timedelta(days=BACKFILL_DAYS - 1), last)
+			hours = combine(self.fetch_stations(day.isoformat(), '1', Deadline(DEADLINE), end.isoformat(), '24'))
+			rows = []
+			if hours['times']:
+				with db.cursor() as cursor:
+					present = self.present(cursor, hours['times'][0], hours['times'][-1])
+				db.commit()
+				for i, time in enumerate(hours['times']):
+					for key, value in hour_values(hours, i).items():
+						if value is not None and (key, time) not in present:
+							rows.append([key, value, time])
+			for i in range(0, len(rows), BACKFILL_BATCH):
+				with db.cursor() as cursor:
+					self.sqlbuffer.write(cursor, rows[i:i + BACKFILL_BATCH])
+				db.commit()
+			logging.info("OK | UBA %s - %s: %s hours of %s stations, %s values written" % (day, end, len(hours['times']), len(stations), len(rows)))
+			written += len(rows)
+			day = end + timedelta(days=1)
+		return written
+
+	def read(self):
+		# Read last data from SQL database, one query for all pollutants
+		DATA = empty_data()
+		idx = 99
+		self.measured = None
+		db = self.connect()
+		if db is None:
+			return (DATA, lqi_list[idx])
+		self.sqlbuffer.flush(db)	# replay spooled values, if any
+		with db.cursor() as cursor:
+			self.create(cursor)
+			cursor.execute("SELECT schadstoff, messwert, datetime FROM %s" % SQLTAB3)
+			rows = cursor.fetchall()
+			if not rows:	# first run after the upgrade: fill SQLTAB3 from the latest measured rows of SQLTAB (or SERIES)
+				if self.series is not None:
+					self.series.create(cursor)
+					newest = "SELECT value AS messwert, ts AS datetime FROM %s WHERE sensor = %%s ORDER BY ts DESC LIMIT 48" % SERIES
 				else:
-					idx = int(DATA['LQI'])
-		finally:
-			db.close()
+					newest = "SELECT messwert, datetime FROM %s WHERE schadstoff = %%s ORDER BY datetime DESC LIMIT 48" % SQLTAB
+				latest = []
+				for key in POLLUTANTS + ["LQI"]:
+					cursor.execute(newest, (key,))
+					for select in cursor.fetchall():
+						value = number(str(select["messwert"]))
+						if value == value:	# "-" or NULL (not measured) must not become 0 = "sehr gut", as in parse_csv
+							latest.append((key, value, select["datetime"]))
+							break
+				if latest:
+					self.update_latest(cursor, latest)
+				db.commit()
+				cursor.execute("SELECT schadstoff, messwert, datetime FROM %s" % SQLTAB3)
+				rows = cursor.fetchall()
+		for select in rows:
+			if select["schadstoff"] in DATA and select["messwert"] is not None:
+				DATA[select["schadstoff"]] = '%d' % select["messwert"]
+				self.measured = max(self.measured or 0, epoch(select["datetime"]))
+		if DATA['LQI'] != 0 and int(DATA['LQI']) in lqi_list:
+			idx = int(DATA['LQI'])
+		return (DATA, lqi_list[idx])
+
+	def migrate(self, hours=24):
+		# Copy SQLTAB into SERIES, see TimeSeries.migrate
+		if self.series is None:
+			logging.info("OK | SERIES not set in get_uba_airquality.py, %s is not migrated" % SQLTAB)
+			return 0
+		db = self.connect()
+		if db is None:
+			return 0
+		return self.series.migrate(db, SQLTAB, ("schadstoff", "messwert", "datetime"), hours)
+
+	def get(self, refresh, deadline=None):
+		# refresh: decided once per run by the caller (UBA check hours), the API is asked at most once per UBA hour
+		if deadline is None:
+			deadline = Deadline(DEADLINE)
+		if refresh and self.written != uba_hour():
+			self.result = self.refresh(deadline)
+		elif self.result is None:
+			self.result = self.read()
+		return self.result
+
+
+def get_uba_airquality(state, deadline=None, cache=None, ttl=86400, spooldir=None):
+	# Former interface: one call = one connection, state 'write' (API -> DB) or 'read' (DB)
+	client = UbaClient(cache, ttl, spooldir)
+	try:
+		return client.get(state == 'write', deadline)
+	finally:
+		client.close()
+
 
-	return(DATA,lqi_list[idx])
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="UBA air quality: fill gaps in the DB with the hourly values of all stations")
+	parser.add_argument("--backfill", nargs=2, metavar=("FROM", "TO"), required=True, help="dates YYYY-mm-dd, both inclusive")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+	first, last = (datetime.strptime(text, "%Y-%m-%d").date() for text in args.backfill)
+	client = UbaClient()
+	try:
+		client.backfill(first, last)
+	finally:
+		client.close()
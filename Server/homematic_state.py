@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+#######################################################
+### Streaming reader for the Homematic XML-API        #
+### Used by: cron_kindle-weather.py                   #
+###                                                   #
+### state.cgi?device_id=a,b,c returns all devices in  #
+### one document. Instead of building an object tree  #
+### of every channel and datapoint (untangle), the    #
+### response is read incrementally with iterparse and #
+### only the subscribed datapoints are kept. Finished #
+### elements are cleared, so memory does not grow     #
+### with the number of devices.                       #
+#######################################################
+
+import xml.etree.ElementTree as ET
+
+
+def state_url(host, devices):
+	# One request for all devices
+	return "http://{}/addons/xmlapi/state.cgi?device_id={}".format(host, ",".join(str(device) for device in devices))
+
+
+def iter_datapoints(source, suffixes):
+	# source: file name or binary file object (e.g. the HTTP response), suffixes: datapoint types like "ACTUAL_TEMPERATURE"
+	# Yields (device ise_id, datapoint name, datapoint ise_id, value) for datapoints whose name ends with ".<suffix>"
+	root = None
+	device = None
+	for event, elem in ET.iterparse(source, events=("start", "end")):
+		if event == "start":
+			if root is None:
+				root = elem
+			elif elem.tag == "device":
+				device = elem.get("ise_id")
+			continue
+		if elem.tag == "datapoint":
+			name = elem.get("name", "")
+			if name.rsplit(".", 1)[-1] in suffixes:
+				yield (device, name, elem.get("ise_id"), elem.get("value"))
+		elif elem.tag == "device":
+			device = None
+			root.clear()	# drop the finished device incl. all its channels
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+#######################################################
+### On-disk HTTP response cache                       #
+### Used by: cron_kindle-weather.py (Dark Sky),       #
+###          get_uba_airquality.py (UBA CSV)          #
+###                                                   #
+### Raw responses are stored on disk with a TTL per   #
+### endpoint. Expired entries are revalidated with    #
+### ETag / Last-Modified (304 = keep body). If the    #
+### upstream fails, a stale entry is served within    #
+### the grace window. Hit/miss/stale counters are     #
+### summed up in stats.json to tune the TTLs.         #
+#######################################################
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import urllib.request
+import urllib.error
+from fetch_pool import retry, urlopen
+from stage_metrics import metrics
+from render_pipeline import publish
+
+COUNTERS = ["hit", "miss", "revalidated", "stale", "error"]
+
+
+class HttpCache:
+
+	def __init__(self, cachedir, grace=0):
+		self.cachedir = cachedir
+		self.grace = grace	# seconds after TTL in which a stale entry may still be served if the upstream fails
+		self.stats = dict((counter, 0) for counter in COUNTERS)
+		self.lock = threading.Lock()
+
+	def _paths(self, url):
+		key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+		return (os.path.join(self.cachedir, key + ".body"), os.path.join(self.cachedir, key + ".json"))
+
+	def _count(self, counter):
+		with self.lock:
+			self.stats[counter] += 1
+		metrics.count("cache_" + counter)
+
+	def _load(self, url):
+		bodypath, metapath = self._paths(url)
+		try:
+			with open(metapath, "r") as f:
+				meta = json.load(f)
+			with open(bodypath, "rb") as f:
+				return meta, f.read()
+		except (OSError, ValueError):
+			return None, None
+
+	def _store(self, url, meta, body):
+		bodypath, metapath = self._paths(url)
+		os.makedirs(self.cachedir, exist_ok=True)
+		if body is not None:
+			publish(bodypath, body)
+		publish(metapath, json.dumps(meta).encode("utf-8"))
+
+	def fetched(self, url):
+		# Time (epoch seconds) of the last response from the server for url, None if not cached
+		try:
+			with open(self._paths(url)[1], "r") as f:
+				return json.load(f).get("fetched")
+		except (OSError, ValueError):
+			return None
+
+	def get(self, url, ttl, timeout=20, tries=1, deadline=None, name=None):
+		# Returns the response body (bytes) of url, from cache if younger than ttl seconds
+		name = name or url
+		meta, body = self._load(url)
+		age = time.time() - meta["fetched"] if meta else None
+		if meta and age < ttl:
+			self._count("hit")
+			return body
+
+		headers = {}
+		if meta and meta.get("etag"):
+			headers["If-None-Match"] = meta["etag"]
+		if meta and meta.get("last_modified"):
+			headers["If-Modified-Since"] = meta["last_modified"]
+
+		def request():
+			req = urllib.request.Request(url, headers=headers)
+			try:
+				with urlopen(req, timeout, deadline) as response:
+					return (response.status, response.read(), response.headers)
+			except urllib.error.HTTPError as e:
+				if e.code == 304 and meta:	# Not modified
+					return (304, None, e.headers)
+				raise
+
+		try:
+			status, data, rheaders = retry(request, name, tries, deadline=deadline)
+		except Exception:
+			if meta and age < ttl + self.grace:
+				self._count("stale")
+				logging.warning("WARN | %s failed, using cached response from %.0f min ago" % (name, age / 60))
+				return body
+			self._count("error")
+			raise
+
+		if status == 304:
+			self._count("revalidated")
+			meta["fetched"] = time.time()
+			self._store(url, meta, None)
+			try:
+				os.utime(self._paths(url)[0])	# body is still current, keep it from being pruned
+			except OSError:
+				pass
+			return body
+
+		self._count("miss")
+		metrics.count("bytes", len(data))
+		meta = {"url": url,
+				"fetched": time.time(),
+				"etag": rheaders.get("ETag"),
+				"last_modified": rheaders.get("Last-Modified")}
+		self._store(url, meta, data)
+		return data
+
+	def save_stats(self, max_age=None):
+		# Add the counters of this run to stats.json and optionally remove entries older than max_age seconds
+		path = os.path.join(self.cachedir, "stats.json")
+		with self.lock:
+			run, self.stats = self.stats, dict((counter, 0) for counter in COUNTERS)
+		try:
+			with open(path, "r") as f:
+				total = json.load(f)
+		except (OSError, ValueError):
+			total = {}
+		for counter in COUNTERS:
+			total[counter] = total.get(counter, 0) + run[counter]
+		os.makedirs(self.cachedir, exist_ok=True)
+		publish(path, json.dumps(total, indent=1).encode("utf-8"))
+
+		if max_age is not None:
+			now = time.time()
+			for entry in os.listdir(self.cachedir):
+				if entry.endswith(".body") or (entry.endswith(".json") and entry != "stats.json"):
+					entry = os.path.join(self.cachedir, entry)
+					try:
+						if now - os.stat(entry).st_mtime > max_age:
+							os.unlink(entry)
+					except OSError:
+						pass
+		return run
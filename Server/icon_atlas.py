@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+#######################################################
+### Icon atlas: pre-rasterized <defs> icons on disk   #
+### Used by: layer_cache.py, pillow_render.py         #
+###                                                   #
+### Weather and moon icons ($I0, $J01..$J24, $I1..$I3)#
+### are vector paths in the <defs> of the template.   #
+### Each icon is rasterized once per size and 1/4     #
+### pixel position and kept as a raw 8-bit bitmap     #
+### in CACHEDIR/icons-<hash of defs>/. Later runs map #
+### these files into memory (mmap) and only multiply  #
+### them onto the frame. Changed <defs> (or canvas)   #
+### get a new folder, unused folders are removed.     #
+#######################################################
+
+import os
+import re
+import mmap
+import time
+import glob
+import shutil
+import struct
+import hashlib
+import logging
+import xml.etree.ElementTree as ET
+from PIL import Image, ImageChops
+from render_pipeline import svg_to_image, publish
+
+SVG = "{http://www.w3.org/2000/svg}"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+SUBPIXEL = 4			# icon positions are rounded to 1/4 pixel
+MARGIN = 32				# icons are rasterized this far from the canvas edge, so parts left/above the origin are kept
+KEEP_DAYS = 30			# atlas folders not used for this long are removed (old versions of the <defs>)
+HEADER = struct.Struct("<4sHHhh")	# magic, width, height, left, top (offset to the integer position of the icon)
+MAGIC = b"ICO1"
+
+MATRIX = re.compile(r'^\s*matrix\(([^)]*)\)\s*$')
+
+
+def _matrix(use):
+	# Transform of a <use> incl. its x/y as [a, b, c, d, e, f], None for other transforms than matrix()
+	transform = use.get("transform", "").strip()
+	if transform:
+		match = MATRIX.match(transform)
+		if match is None:
+			return None
+		values = [float(v) for v in re.split(r'[\s,]+', match.group(1).strip())]
+		if len(values) != 6:
+			return None
+	else:
+		values = [1.0, 0.0, 0.0, 1.0, 0.0, 0.0]
+	x = float(use.get("x", "0") or 0)
+	y = float(use.get("y", "0") or 0)
+	a, b, c, d, e, f = values
+	return [a, b, c, d, e + a * x + c * y, f + b * x + d * y]	# svglib: transform, then translate(x, y)
+
+
+class IconAtlas:
+
+	def __init__(self, defs, canvas, cachedir, dpi=72, name="<template>"):
+		# Rasters are kept with 256 gray levels, frames of 16 levels are quantized as a whole (see eink_output.quantize)
+		# defs: id -> element in <defs>, canvas: attributes of the template's <svg> element
+		self.name = name
+		self.defs = defs
+		self.canvas = dict(canvas)
+		self.dpi = dpi
+		self.scale = dpi / 72.0		# pixels per user unit
+		source = "".join(ET.tostring(defs[icon], encoding="unicode") for icon in sorted(defs))
+		source += repr(sorted(self.canvas.items())) + repr(dpi) + MAGIC.decode("ascii")	# new folder for a new file layout, the old one is left to prune()
+		self.folder = os.path.join(cachedir, "icons-%s" % hashlib.sha1(source.encode("utf-8")).hexdigest()[:16])
+		self._icons = {}		# key -> (raster, (x, y)) or None, rasters are views on mmap'ed files
+		self._missing = set()	# icon names already warned about
+		os.makedirs(self.folder, exist_ok=True)
+		os.utime(self.folder)	# in use, see prune()
+		self.prune(cachedir)
+
+	def prune(self, cachedir):
+		# Atlases of former <defs> (or of templates no longer used)
+		limit = time.time() - KEEP_DAYS * 86400
+		for folder in glob.glob(os.path.join(cachedir, "icons-*")):
+			if folder != self.folder and os.path.getmtime(folder) < limit:
+				shutil.rmtree(folder, ignore_errors=True)
+
+	def _path(self, name, key):
+		digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:12]
+		return os.path.join(self.folder, "%s-%s.icon" % (re.sub(r'[^A-Za-z0-9_-]', "_", name), digest))
+
+	def _rasterize(self, name, use, matrix, shift):
+		# Icon alone on a canvas of the template's size, returns (raster, (left, top)) relative to shift, or None if blank
+		doc = ET.Element(SVG + "svg", self.canvas)
+		ET.SubElement(doc, SVG + "defs").append(self.defs[name])
+		ref = ET.Element(use.tag, dict(use.attrib))	# own attributes, the template's <use> stays as it is
+		ref.set(XLINK_HREF, "#" + name)
+		if matrix is not None:
+			for attr in ("x", "y"):
+				ref.attrib.pop(attr, None)	# already part of matrix
+			ref.set("transform", "matrix(%r,%r,%r,%r,%r,%r)" % tuple(matrix))
+		doc.append(ref)
+		image = svg_to_image(ET.tostring(doc, encoding="unicode"), self.dpi)
+		box = ImageChops.invert(image).getbbox()
+		if box is None:
+			return None
+		return (image.crop(box), (box[0] - shift[0], box[1] - shift[1]))
+
+	def _load(self, path):
+		# Raster from the atlas file, mapped into memory instead of read
+		with open(path, "rb") as f:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, width, height, left, top = HEADER.unpack_from(data)
+		if magic != MAGIC or len(data) != HEADER.size + width * height:
+			raise ValueError("%s: not an icon raster" % path)
+		if width == 0:
+			return None
+		raster = Image.frombuffer("L", (width, height), memoryview(data)[HEADER.size:], "raw", "L", 0, 1)
+		return (raster, (left, top))
+
+	def _store(self, path, icon):
+		if icon is None:
+			data = HEADER.pack(MAGIC, 0, 0, 0, 0)
+		else:
+			raster, (left, top) = icon
+			data = HEADER.pack(MAGIC, raster.size[0], raster.size[1], left, top) + raster.tobytes()
+		publish(path, data)
+
+	def lookup(self, name, use):
+		# Returns (raster, (x, y)) for icon name placed like the <use> element, None if there is nothing to draw
+		if name not in self.defs:
+			if name not in self._missing:
+				self._missing.add(name)
+				logging.warning("WARN | %s: icon '%s' not found in <defs>" % (self.name, name))
+			return None
+		matrix = _matrix(use)
+		if matrix is not None:
+			# Same size at another position: same raster, only the 1/4 pixel phase matters
+			x, y = matrix[4] * self.scale, matrix[5] * self.scale
+			ex, fy = int(x // 1), int(y // 1)
+			px, py = int(round((x - ex) * SUBPIXEL)), int(round((y - fy) * SUBPIXEL))
+			if px == SUBPIXEL:
+				ex, px = ex + 1, 0
+			if py == SUBPIXEL:
+				fy, py = fy + 1, 0
+			key = (name, tuple(round(v, 6) for v in matrix[:4]), px, py)
+			origin = (ex, fy)
+		else:
+			key = (name, use.get("transform"), use.get("x"), use.get("y"))
+			origin = (0, 0)
+		if key not in self._icons:
+			path = self._path(name, key)
+			try:
+				icon = self._load(path)
+			except (OSError, ValueError, struct.error):	# not in the atlas yet (or damaged)
+				if matrix is not None:
+					placed = [(MARGIN + px / SUBPIXEL) / self.scale, (MARGIN + py / SUBPIXEL) / self.scale]
+					icon = self._rasterize(name, use, matrix[:4] + placed, (MARGIN, MARGIN))
+				else:
+					icon = self._rasterize(name, use, None, (0, 0))
+				self._store(path, icon)
+			self._icons[key] = icon
+		icon = self._icons[key]
+		if icon is None:
+			return None
+		return (icon[0], (origin[0] + icon[1][0], origin[1] + icon[1][1]))
+
+	def composite(self, image, name, use):
+		# Multiply the icon onto the frame (black on white, keeps what is already there)
+		icon = self.lookup(name, use)
+		if icon is None:
+			return
+		raster, (x, y) = icon
+		box = (x, y, x + raster.size[0], y + raster.size[1])
+		image.paste(ImageChops.multiply(image.crop(box), raster), box)
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+#######################################################
+### Static/dynamic layer split with cached base raster#
+### Used by: cron_kindle-weather.py (RENDERMODE)      #
+###                                                   #
+### Everything in the SVG template without a "$"      #
+### placeholder (frames, labels, grid, static icons)  #
+### is the static layer. It is rasterized once per    #
+### template and dpi and cached on disk, keyed by the #
+### SHA1 of the template. Each run only renders the   #
+### dynamic elements (texts + <use> with placeholder) #
+### and multiplies them onto the cached base. Icons   #
+### (<use> of a <defs> icon) come from the icon atlas.#
+### Other resolutions: one template per dpi, the      #
+### filled-in dynamic layer is shared (prepare()).    #
+#######################################################
+
+import os
+import glob
+import hashlib
+import logging
+import xml.etree.ElementTree as ET
+from PIL import Image, ImageChops
+from svg_template import SvgTemplate
+from render_pipeline import svg_to_image, parse_svg, rasterize, svg_size, encode_png, publish
+from icon_atlas import IconAtlas
+
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+# Keep the usual prefixes when the layers are serialized again (otherwise ElementTree writes ns0:, ns1:, ...)
+for prefix, uri in [("", SVG_NS),
+		("xlink", "http://www.w3.org/1999/xlink"),
+		("dc", "http://purl.org/dc/elements/1.1/"),
+		("cc", "http://creativecommons.org/ns#"),
+		("rdf", "http://www.w3.org/1999/02/22-rdf-syntax-ns#")]:
+	ET.register_namespace(prefix, uri)
+
+_cache = {}	# (path, cachedir, dpi) -> (mtime, LayeredTemplate)
+
+
+def split_layers(text):
+	# Returns (static SVG, dynamic SVG) as str. <defs> go to both layers, as both may contain <use> elements.
+	root = ET.fromstring(text.encode("utf-8"))
+	static = ET.Element(root.tag, root.attrib)
+	dynamic = ET.Element(root.tag, root.attrib)
+	for child in root:
+		tag = child.tag.rsplit("}", 1)[-1]
+		if tag == "metadata":
+			continue
+		elif tag == "defs":
+			static.append(child)
+			dynamic.append(child)
+		elif "$" in ET.tostring(child, encoding="unicode"):
+			dynamic.append(child)
+		else:
+			static.append(child)
+	return(ET.tostring(static, encoding="unicode"), ET.tostring(dynamic, encoding="unicode"))
+
+
+def split_icons(text):
+	# Takes the icon <use> elements (href with placeholder) out of the dynamic layer
+	# Returns (dynamic SVG without them, [(href template, <use> element), ...], {id: element in <defs>}, <svg> attributes)
+	root = ET.fromstring(text.encode("utf-8"))
+	uses = []
+	defs = {}
+	for child in list(root):
+		tag = child.tag.rsplit("}", 1)[-1]
+		if tag == "defs":
+			for elem in child:
+				if elem.get("id"):
+					defs[elem.get("id")] = elem
+		elif tag == "use" and "$" in child.get(XLINK_HREF, ""):
+			uses.append((SvgTemplate(child.get(XLINK_HREF).lstrip("#")), child))
+			root.remove(child)
+	return (ET.tostring(root, encoding="unicode"), uses, defs, dict(root.attrib))
+
+
+class LayeredTemplate:
+
+	def __init__(self, path, cachedir, dpi=72):
+		with open(path, "rb") as f:
+			source = f.read()
+		name = os.path.splitext(os.path.basename(path))[0]
+		digest = hashlib.sha1(source).hexdigest()[:16]
+		static_svg, dynamic_svg = split_layers(source.decode("utf-8"))
+		self.placeholders = SvgTemplate(dynamic_svg, os.path.basename(path))	# all placeholders incl. icons, for check()
+		dynamic_svg, self.uses, defs, canvas = split_icons(dynamic_svg)
+
+		self.dpi = dpi
+		self.size = svg_size(canvas)	# layout in user units, at 72 dpi in pixels
+		self.static_svg = static_svg
+		self.dynamic_svg = dynamic_svg
+		self.dynamic = SvgTemplate(dynamic_svg, os.path.basename(path))
+		self.atlas = IconAtlas(defs, canvas, cachedir, dpi, name=os.path.basename(path))
+		self.cachedir = cachedir
+		self.prefix = "base-%s-" % name
+		self.digest = digest
+		self.base_path = os.path.join(cachedir, "%s%s-%g.png" % (self.prefix, digest, dpi))
+		self._base = None
+
+	def base(self):
+		# Static layer: memory -> disk cache -> rasterize (and store for the next run)
+		if self._base is None:
+			if os.path.exists(self.base_path):
+				with Image.open(self.base_path) as img:
+					self._base = img.convert(mode='L')
+			else:
+				self._base = svg_to_image(self.static_svg, self.dpi)
+				os.makedirs(self.cachedir, exist_ok=True)
+				publish(self.base_path, encode_png(self._base))
+				self.prune()
+				logging.info("OK | static layer rasterized to %s" % (self.base_path))
+		return self._base
+
+	def prune(self):
+		# Remove base rasters of older versions of the same template (those of other dpi are still in use)
+		for old in glob.glob(os.path.join(self.cachedir, self.prefix + "*.png")):
+			if not os.path.basename(old).startswith(self.prefix + self.digest + "-"):
+				try:
+					os.unlink(old)
+				except OSError:
+					pass
+
+	def prepare(self, values, default=None):
+		# Independent of the dpi: dynamic layer filled in and parsed, icon names filled in
+		self.placeholders.check(values)
+		return (parse_svg(self.dynamic.fill(values, default)), [(href.fill(values, default), use) for href, use in self.uses])
+
+	def compose(self, prepared):
+		# Frame at the dpi of this template from prepare() of the same template at any dpi.
+		# Dynamic layer is black on white, multiply keeps the ink of both layers (incl. anti-aliasing)
+		drawing, icons = prepared
+		layer = rasterize(drawing, self.dpi)
+		base = self.base()
+		if layer.size != base.size:
+			raise ValueError("dynamic layer %s does not match base raster %s" % (layer.size, base.size))
+		image = ImageChops.multiply(base, layer)
+		for name, use in icons:
+			self.atlas.composite(image, name, use)
+		return image
+
+	def render(self, values, default=None):
+		return self.compose(self.prepare(values, default))
+
+
+def load_layered(path, cachedir, dpi=72):
+	# Layer split is cached per process and redone only when the template file changes
+	mtime = os.stat(path).st_mtime_ns
+	key = (path, cachedir, dpi)
+	cached = _cache.get(key)
+	if cached is not None and cached[0] == mtime:
+		return cached[1]
+	layered = LayeredTemplate(path, cachedir, dpi)
+	_cache[key] = (mtime, layered)
+	return layered
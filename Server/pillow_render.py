@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+#######################################################
+### Pillow render backend (RENDERMODE "pillow")       #
+### Used by: render_pool.py                           #
+###                                                   #
+### The dynamic layer of the template (layer_cache.py)#
+### is read once per template: position, font size,   #
+### weight and anchor of every text fragment and the  #
+### icons of the layer. Each run only fills in the    #
+### values and draws them with Pillow onto the cached #
+### static base, icons come from the icon atlas - no  #
+### SVG is built, parsed or rasterized per frame.     #
+### Layout rules are those of svglib, so the frames   #
+### match the "layered" mode apart from anti-aliasing.#
+### Texts are placed once (prepare()), other sizes    #
+### only scale positions and font sizes (draw()).     #
+#######################################################
+
+import os
+import math
+import xml.etree.ElementTree as ET
+import reportlab
+from PIL import Image, ImageDraw, ImageFont
+from svg_template import SvgTemplate
+from layer_cache import load_layered
+
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+BOLD = frozenset(["bold", "bolder", "600", "700", "800", "900"])
+DEFAULT_SIZE = 12		# font size of svglib if none is given
+METRIC_SIZE = 1000		# widths are measured at this size, at small sizes hinting rounds every glyph advance
+SUBPIXEL = 4			# glyphs are rasterized for 1/4 pixel horizontal offsets
+
+_cache = {}		# (path, cachedir, fonts) -> (mtime, PillowTemplate)
+_fonts = {}		# (font file, size) -> FreeTypeFont, loaded once per process
+_glyphs = {}	# (font file, size, char, offset) -> (mask, (left, top)) or None for blank glyphs
+
+
+def default_fonts():
+	# Helvetica outlines shipped with reportlab: the glyphs renderPM draws for font-family Helvetica
+	folder = os.path.join(os.path.dirname(reportlab.__file__), "fonts")
+	return {"normal": os.path.join(folder, "_a______.pfb"), "bold": os.path.join(folder, "_ab_____.pfb")}
+
+
+def get_font(path, size):
+	key = (path, size)
+	font = _fonts.get(key)
+	if font is None:
+		font = _fonts[key] = ImageFont.truetype(path, size, layout_engine=ImageFont.Layout.BASIC)	# FreeType: .ttf, .otf and Type1 .pfb
+	return font
+
+
+def advances(text, path, size):
+	# Advance of every character without hinting and kerning, same as reportlab's stringWidth()
+	metric = get_font(path, METRIC_SIZE)
+	return [metric.getlength(char) * size / METRIC_SIZE for char in text]
+
+
+def text_width(text, path, size):
+	return sum(advances(text, path, size))
+
+
+def glyph(path, size, char, offset):
+	# Coverage mask of one character, drawn offset/SUBPIXEL pixels right of the origin
+	key = (path, size, char, offset)
+	if key not in _glyphs:
+		font = get_font(path, size)
+		left, top, right, bottom = font.getbbox(char, anchor="ls")
+		if right > left and bottom > top:
+			mask = Image.new("L", (right - left + 2, bottom - top), 0)
+			ImageDraw.Draw(mask).text((offset / SUBPIXEL - left, -top), char, font=font, fill=255, anchor="ls")
+			_glyphs[key] = (mask, (left, top))
+		else:
+			_glyphs[key] = None
+	return _glyphs[key]
+
+
+def draw_text(image, x, y, text, path, size):
+	# Glyph by glyph at unhinted positions: hinted advances of whole strings drift from svglib by a pixel and more
+	baseline = int(round(y))	# FreeType places glyphs on whole pixels vertically
+	for char, advance in zip(text, advances(text, path, size)):
+		left = math.floor(x)
+		offset = int(round((x - left) * SUBPIXEL))
+		if offset == SUBPIXEL:
+			left, offset = left + 1, 0
+		mask = glyph(path, size, char, offset)
+		if mask is not None:
+			image.paste(0, (left + mask[1][0], baseline + mask[1][1]), mask[0])	# black ink, same blending as ImageDraw.text()
+		x += advance
+
+
+def clean_text(text, preserve, strip_start=False, strip_end=False):
+	# Whitespace handling of svglib (xml:space), applied after the values are filled in
+	text = text.replace("\r\n", " ").replace("\n", " ").replace("\t", " ")
+	if not preserve:
+		if strip_start:
+			text = text.lstrip()
+		if strip_end:
+			text = text.rstrip()
+		while "  " in text:
+			text = text.replace("  ", " ")
+	return text
+
+
+def _style(elem):
+	# Attributes of one element, declarations in its style attribute win (same as svglib)
+	attrs = dict(elem.attrib)
+	for item in elem.get("style", "").split(";"):
+		key, sep, value = item.partition(":")
+		if sep:
+			attrs[key.strip()] = value.replace("!important", "").strip()
+	return attrs
+
+
+def _find(chain, name, default=""):
+	# chain: styles of the element and its ancestors, innermost first
+	for attrs in chain:
+		value = attrs.get(name, "").strip()
+		if value and value != "inherit":
+			return value
+	return default
+
+
+def _length(value):
+	# Lengths in user units (= pixels at 72 dpi), "px" is the only unit the templates use
+	if value.endswith("px"):
+		value = value[:-2]
+	return float(value)
+
+
+class Fragment:
+
+	def __init__(self, text, strip_start, strip_end, x, y, font, size, anchor):
+		self.text = SvgTemplate(text)	# raw text incl. placeholders, whitespace is cleaned after filling in
+		self.strip_start = strip_start
+		self.strip_end = strip_end
+		self.x = x					# None: continues after the previous fragment
+		self.y = y
+		self.font = font			# font file
+		self.size = size
+		self.anchor = anchor		# "start", "middle" or "end"
+
+
+class TextItem:
+
+	def __init__(self, x, y, preserve, font, size):
+		self.x = x
+		self.y = y
+		self.preserve = preserve	# xml:space="preserve"
+		self.font = font			# font of the <text> element: svglib advances the following fragments with it
+		self.size = size
+		self.fragments = []
+
+
+class PillowTemplate:
+
+	def __init__(self, path, cachedir, fonts=None):
+		self.name = os.path.basename(path)
+		self.path = path
+		self.cachedir = cachedir
+		self.layered = load_layered(path, cachedir)
+		self.size = self.layered.size
+		self.fonts = default_fonts()
+		self.fonts.update(fonts or {})
+		self.texts = []		# TextItem per <text>
+		self.uses = list(self.layered.uses)	# (href template, <use> element) per icon
+		root = ET.fromstring(self.layered.dynamic_svg.encode("utf-8"))
+		self._walk(root, [_style(root)])
+		for text in self.texts:		# preload every font once
+			get_font(text.font, METRIC_SIZE)
+			for fragment in text.fragments:
+				get_font(fragment.font, fragment.size)
+				get_font(fragment.font, METRIC_SIZE)
+
+	def _font(self, chain):
+		weight = _find(chain, "font-weight", "normal")
+		return (self.fonts["bold" if weight in BOLD else "normal"], _length(_find(chain, "font-size", str(DEFAULT_SIZE))))
+
+	def _walk(self, parent, chain):
+		for child in parent:
+			tag = child.tag.rsplit("}", 1)[-1]
+			if tag == "defs":
+				continue
+			if tag == "use":
+				self.uses.append((SvgTemplate(child.get(XLINK_HREF, "").lstrip("#")), child))
+				continue
+			if child.get("transform"):
+				raise ValueError("%s: transform on <%s id=\"%s\"> is not supported by the pillow backend, use RENDERMODE layered" % (self.name, tag, child.get("id")))
+			styles = [_style(child)] + chain
+			if tag == "g":
+				self._walk(child, styles)
+			elif tag == "text":
+				font, size = self._font(styles)
+				text = TextItem(_length(child.get("x", "0")), _length(child.get("y", "0")), child.get(XML_SPACE) == "preserve", font, size)
+				self._fragments(text, child, styles, 0)
+				self.texts.append(text)
+			else:
+				raise ValueError("%s: dynamic <%s id=\"%s\"> is not supported by the pillow backend, use RENDERMODE layered" % (self.name, tag, child.get("id")))
+
+	def _fragments(self, text, node, chain, level):
+		# Same order and whitespace rules as svglib's iter_text_node(): text of the node, children, their tails
+		font, size = self._font(chain)
+		anchor = _find(chain, "text-anchor", "start")
+		if node.text:
+			x = _length(node.get("x")) if node.get("x", "") != "" else None
+			y = _length(node.get("y")) if node.get("y", "") != "" else None
+			text.fragments.append(Fragment(node.text, level == 0, level == 0 and len(node) == 0, x, y, font, size, anchor))
+		for n, child in enumerate(node):
+			self._fragments(text, child, [_style(child)] + chain, level + 1)
+			if child.tail:	# tail is drawn with the style of this node
+				text.fragments.append(Fragment(child.tail, False, level == 0 and n == len(node) - 1, None, None, font, size, anchor))
+
+	def prepare(self, values, default=None):
+		# Independent of the size: values filled in and placed, returns ([(x, y, text, font, size), ...], icons)
+		self.layered.placeholders.check(values)
+		placed = []
+		for text in self.texts:
+			advance = 0.0
+			for fragment in text.fragments:
+				s = clean_text(fragment.text.fill(values, default), text.preserve, fragment.strip_start, fragment.strip_end)
+				if not s:
+					continue
+				x = fragment.x if fragment.x is not None else text.x + advance
+				y = fragment.y if fragment.y is not None else text.y
+				advance += text_width(s, text.font, text.size)
+				if fragment.anchor == "end":
+					x -= text_width(s, fragment.font, fragment.size)
+				elif fragment.anchor == "middle":
+					x -= text_width(s, fragment.font, fragment.size) / 2
+				placed.append((x, y, s, fragment.font, fragment.size))
+		return (placed, [(href.fill(values, default), use) for href, use in self.uses])
+
+	def draw(self, prepared, scale=1.0):
+		# Frame of prepare() at scale (1 = size of the template), base and icons of the same dpi
+		placed, icons = prepared
+		layered = self.layered if scale == 1.0 else load_layered(self.path, self.cachedir, 72 * scale)
+		image = layered.base().copy()
+		for name, use in icons:
+			layered.atlas.composite(image, name, use)
+		for x, y, s, font, size in placed:
+			draw_text(image, x * scale, y * scale, s, font, size * scale)	# text widths are proportional to the size
+		return image
+
+	def render(self, values, default=None):
+		# Returns PIL image in mode 'L', same as LayeredTemplate.render()
+		return self.draw(self.prepare(values, default))
+
+
+def load_pillow(path, cachedir, fonts=None):
+	# Layout is extracted once per process and again only when the template file changes
+	mtime = os.stat(path).st_mtime_ns
+	key = (path, cachedir, tuple(sorted((fonts or {}).items())))
+	cached = _cache.get(key)
+	if cached is not None and cached[0] == mtime:
+		return cached[1]
+	template = PillowTemplate(path, cachedir, fonts)
+	_cache[key] = (mtime, template)
+	return template
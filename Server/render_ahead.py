@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+#######################################################
+### Frames rendered ahead of the Kindle wakeups       #
+### Used by: cron_kindle-weather.py (daemon,          #
+###          PRERENDER), sync_server.py               #
+###                                                   #
+### The sync service knows when each Kindle wakes up  #
+### next (X-Suspend, see wake_schedule.py). Shortly   #
+### before, the daemon renders the frame of its room  #
+### from the data in memory, as of the wakeup time    #
+### (TIME, hourly forecast from that hour on), and    #
+### keeps the PNG in memory. The wakeup is answered   #
+### without rendering. At most "limit" frames are     #
+### kept, all are dropped when an input changes. A    #
+### frame not fetched until "late" seconds after its  #
+### wakeup is dropped, the published one is used.     #
+#######################################################
+
+import threading
+
+
+class RenderAhead:
+
+	def __init__(self, limit=4, ahead=60, late=120):
+		self.limit = limit		# frames kept in memory
+		self.ahead = ahead		# seconds before the wakeup
+		self.late = late		# seconds after the wakeup a frame is still served (it shows the time of the wakeup)
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		self.version = 0		# counts the input changes, a frame of an older version is stale
+		self.wakes = {}			# display -> next wakeup (epoch seconds)
+		self.done = {}			# display -> (wakeup, version) already rendered ahead
+		self.frames = {}		# display -> (wakeup, version, (etag, data, manifest))
+
+	def expect(self, display, wake):
+		# Next wakeup of the Kindle showing display, called by the sync service
+		with self.lock:
+			self.wakes[display] = wake
+		self.event.set()
+
+	def invalidate(self):
+		# Inputs have changed: frames rendered ahead are stale, render again for the next wakeups
+		with self.lock:
+			self.version += 1
+			self.frames.clear()
+			self.done.clear()
+
+	def due(self, now):
+		# [(display, wakeup, version), ...] to render now, earliest wakeup first
+		with self.lock:
+			for display in [display for display, entry in self.frames.items() if now > entry[0] + self.late]:
+				del self.frames[display]	# wakeup missed (Kindle off, WLAN down), would take the place of a needed frame
+			todo = [(wake, display) for display, wake in self.wakes.items()
+				if wake - self.ahead <= now < wake and self.done.get(display) != (wake, self.version)]
+			return [(display, wake, self.version) for wake, display in sorted(todo)]
+
+	def next_due(self, now):
+		# Time of the next render ahead, None if no wakeup is pending
+		with self.lock:
+			times = [wake - self.ahead for display, wake in self.wakes.items()
+				if wake > now and self.done.get(display) != (wake, self.version)]
+		return min(times) if times else None
+
+	def put(self, display, wake, version, frame):
+		# frame: (etag, data, manifest), None if it is the same as the published one
+		with self.lock:
+			if version != self.version:
+				return False	# inputs changed meanwhile
+			self.done[display] = (wake, version)
+			if frame is None:
+				self.frames.pop(display, None)
+				return False
+			self.frames[display] = (wake, version, frame)
+			while len(self.frames) > self.limit:	# the one needed last goes first
+				del self.frames[max(self.frames, key=lambda name: self.frames[name][0])]
+			return display in self.frames
+
+	def get(self, display, now):
+		# Frame rendered ahead for the current wakeup of display, else None (the published frame is used)
+		with self.lock:
+			entry = self.frames.get(display)
+			if entry is None or entry[1] != self.version or now < entry[0] - self.ahead:
+				return None
+			if now > entry[0] + self.late:	# too late, the time and forecast of the frame are outdated
+				del self.frames[display]
+				return None
+			return entry[2]
+
+	def wait(self, seconds):
+		# Sleep of the daemon, ends early when a new wakeup is known
+		self.event.wait(max(0, seconds))
+		self.event.clear()
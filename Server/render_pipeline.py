@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+#######################################################
+### SVG -> PNG render pipeline                        #
+### Used by: cron_kindle-weather.py                   #
+###                                                   #
+### The filled-in SVG is parsed from memory, rendered #
+### to an in-memory bitmap, converted to grayscale,   #
+### encoded into a buffer and published with a single#
+### os.replace() - no temp SVG, no temp PNG, no mv/rm #
+### Next to each PNG a small manifest (hash, time,    #
+### size) tells the Kindle whether the frame changed. #
+### 16-level frames are written as 4-bit PNG, see     #
+### eink_output.py. A parsed SVG can be rasterized at #
+### any scale (vectors, not a resized bitmap).        #
+### Zero-length path segments are dropped when parsed:#
+### libart ("colinear!") may otherwise fill a dark    #
+### bar from the shape to the edge of the image.      #
+#######################################################
+
+import os
+import io
+import re
+import time
+import tempfile
+from svglib.svglib import svg2rlg # this library needs to be installed separately on Synology NAS: via SSH with 'pip3 install svglib'
+from reportlab.graphics import renderPM # this library is automatically installed when installing svglib
+from reportlab.graphics.shapes import Path, _PATH_OP_ARG_COUNT, _PATH_OP_NAMES
+from PIL import Image # this library is automatically installed when installing svglib
+import eink_output
+# To use DejaVuSans Font specified in SVG, install .TTF file in: /volume1/@appstore/py3k/usr/local/lib/python3.8/site-packages/reportlab/fonts/ via SSH. Also chmod 644 DejaVuSans.ttf
+# As the folder font couldn't be found anymore after DS update, switched to use Helvetica font instead in SVG file
+
+
+EPSILON = 0.005		# user units (of the path): shorter segments are dropped, far below a pixel at any scale
+MOVETO = _PATH_OP_NAMES.index("moveTo")
+LINETO = _PATH_OP_NAMES.index("lineTo")
+CURVETO = _PATH_OP_NAMES.index("curveTo")
+CLOSEPATH = _PATH_OP_NAMES.index("closePath")
+
+
+def clean_path(path):
+	# Drop line and curve segments that end where they start with all control points there,
+	# e.g. "c 0.001,0 0.001,0 0.001,0" in an icon of the template, and close subpaths exactly at their start
+	operators = []
+	points = []
+	current = start = None
+	n = 0
+	for op in path.operators:
+		args = path.points[n:n + _PATH_OP_ARG_COUNT[op]]
+		n += len(args)
+		if op in (LINETO, CURVETO) and current is not None and all(abs(args[i] - current[i % 2]) < EPSILON for i in range(len(args))):
+			continue
+		if op == CLOSEPATH and current is not None and start is not None and current != start \
+				and abs(current[0] - start[0]) < EPSILON and abs(current[1] - start[1]) < EPSILON:
+			points[-2:] = start	# ends just beside its start: no extra closing segment of almost zero length
+		operators.append(op)
+		points.extend(args)
+		if op == MOVETO:
+			start = args
+		if args:
+			current = args[-2:]
+	path.operators[:] = operators
+	path.points[:] = points
+
+def clean_paths(node, seen):
+	# Paths referenced several times (<use>) are cleaned once
+	for child in getattr(node, "contents", ()):
+		if id(child) in seen:
+			continue
+		seen.add(id(child))
+		if isinstance(child, Path):
+			clean_path(child)
+		else:
+			clean_paths(child, seen)
+
+def parse_svg(svg):
+	# svg: filled-in SVG document as str, returns the ReportLab drawing (not changed by rasterize)
+	drawing = svg2rlg(io.BytesIO(svg.encode("utf-8")))	# Convert SVG to ReportLab drawing
+	if drawing is None:
+		raise ValueError("SVG could not be parsed")
+	clean_paths(drawing, set())
+	return drawing
+
+def rasterize(drawing, dpi=72):
+	# 72 dpi = one pixel per user unit, other dpi scale the drawing
+	bitmap = renderPM.drawToPIL(drawing, dpi=dpi)	# Render drawing to in-memory bitmap
+	return bitmap.convert(mode='L')	# Kindle needs true 8-bit grayscale PNG, otherwise it is distorted
+
+def svg_to_image(svg, dpi=72):
+	# svg: filled-in SVG document as str, returns PIL image in mode 'L'
+	return rasterize(parse_svg(svg), dpi)
+
+def svg_size(root):
+	# (width, height) in user units of an <svg> element (attributes as dict): width/height, else the viewBox
+	try:
+		return (float(re.sub(r'px$', "", root["width"])), float(re.sub(r'px$', "", root["height"])))
+	except (KeyError, ValueError):
+		box = re.split(r'[\s,]+', root.get("viewBox", "").strip())
+		return (float(box[2]), float(box[3]))
+
+def fit_scale(size, resolution):
+	# Scale of a layout of size (width, height) to fit into resolution, 1 without resolution
+	if not resolution:
+		return 1.0
+	return min(resolution[0] / float(size[0]), resolution[1] / float(size[1]))
+
+def fit(image, resolution):
+	# Centered on a white frame of exactly resolution (the aspect ratios of the Kindle screens differ slightly)
+	if not resolution or image.size == tuple(resolution):
+		return image
+	frame = Image.new("L", tuple(resolution), 255)
+	frame.paste(image, ((resolution[0] - image.size[0]) // 2, (resolution[1] - image.size[1]) // 2))
+	return frame
+
+def encode_png(image, depth=8, compress="size"):
+	# depth 4: image is quantized to 16 levels, written as 4-bit grayscale PNG (needs NumPy, otherwise 8-bit)
+	# compress: "size" = smallest file, "speed" = fastest encoding
+	if depth == 4 and eink_output.numpy is not None:
+		return eink_output.encode_png4(image, compress)
+	buffer = io.BytesIO()
+	if compress == "speed":
+		image.save(buffer, format="PNG", compress_level=1)
+	else:
+		image.save(buffer, format="PNG", optimize=True)	# Compress PNG
+	return buffer.getvalue()
+
+def publish(path, data):
+	# Atomic publish: write into a private temp file in the target directory, then rename over the
+	# target. Webserver/Kindle never see a half written file, parallel renders never share a temp file.
+	fd, tmp = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), suffix=".tmp", dir=os.path.dirname(path) or ".")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.chmod(tmp, 0o644)	# mkstemp creates 0600, webserver needs to read the file
+		os.replace(tmp, path)
+	except BaseException:
+		try:
+			os.unlink(tmp)
+		except OSError:
+			pass
+		raise
+
+def manifest_path(path):
+	# weatherdata-<name>.png -> weatherdata-<name>.manifest
+	return os.path.splitext(path)[0] + ".manifest"
+
+def read_manifest(path):
+	# Manifest of the PNG path as dict, empty if there is none
+	manifest = {}
+	try:
+		with open(manifest_path(path), "r") as f:
+			for line in f:
+				key, sep, value = line.strip().partition("=")
+				if sep:
+					manifest[key] = value
+	except OSError:
+		pass
+	return manifest
+
+def write_manifest(path, digest, size, extra=()):
+	# Plain key=value lines, so the Kindle script can read it with grep/cut
+	# extra: further (key, value) pairs, e.g. the tiles of a partial update
+	lines = ["hash=%s" % digest, "timestamp=%d" % time.time(), "size=%d" % size]
+	lines.extend("%s=%s" % (key, value) for key, value in extra)
+	publish(manifest_path(path), ("\n".join(lines) + "\n").encode("ascii"))
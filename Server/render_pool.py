@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+
+#######################################################
+### Parallel rendering of all displays                #
+### Used by: cron_kindle-weather.py                   #
+###                                                   #
+### Each display is rendered (SVG -> PNG -> publish)  #
+### in a worker process, one per CPU core. Total time #
+### is that of the slowest display instead of the sum #
+### of all. Workers keep their compiled templates and #
+### static layers, so the daemon keeps one pool.      #
+### Displays whose values have not changed since the  #
+### last published frame are skipped completely.      #
+### Otherwise the changed regions against the last    #
+### frame are published as tiles (see frame_diff.py). #
+### Frames and tiles are quantized and encoded per    #
+### display (eink_output.py). Timings of the workers  #
+### are added to the script's metrics. prerender()    #
+### renders into memory only (see render_ahead.py).   #
+### Displays with the same template and values (same  #
+### room, other Kindle models) are filled in and      #
+### parsed once, only rasterized per resolution: the  #
+### layout is scaled as vectors to fit the screen.    #
+#######################################################
+
+import os
+import re
+import json
+import time
+import hashlib
+import multiprocessing
+from PIL import Image
+from svg_template import load_template
+from render_pipeline import parse_svg, rasterize, fit_scale, fit, encode_png, publish, read_manifest, write_manifest
+from layer_cache import load_layered
+from pillow_render import load_pillow
+from frame_diff import changed_boxes, changed_area
+from eink_output import quantize
+from stage_metrics import Recorder, metrics
+
+VOLATILE = frozenset(["TIME"])	# placeholders left out of the frame hash, otherwise every run would be a new frame
+
+
+class RenderTask:
+
+	def __init__(self, name, template, values, output, resolution=None, mode="full", cachedir=None, tiles=0, fonts=None,
+			depth=8, dither="none", compress="size"):
+		self.name = name
+		self.template = template
+		self.values = values		# all placeholders of this display, missing ones are shown as "-"
+		self.output = output
+		self.resolution = resolution	# (width, height), frames of another size are scaled to fit
+		self.mode = mode			# "full", "layered" or "pillow", see RENDERMODE
+		self.cachedir = cachedir
+		self.tiles = tiles			# max. number of tiles for a partial update, 0 = whole frame only
+		self.fonts = fonts			# font files of the pillow backend, see PILLOW_FONTS
+		self.depth = depth			# 8 or 4 (16 gray levels, 4-bit PNG)
+		self.dither = dither		# dithering for 16 levels: "none", "ordered", "floyd-steinberg"
+		self.compress = compress	# PNG encoding: "size" or "speed"
+		self.digest = None
+
+	def frame_hash(self):
+		# Everything the frame depends on: template version, values, size and render mode
+		state = {"template": self.template,
+				"version": os.stat(self.template).st_mtime_ns,
+				"values": dict((key, str(value)) for key, value in self.values.items() if key not in VOLATILE),
+				"resolution": self.resolution,
+				"mode": self.mode,
+				"fonts": self.fonts if self.mode == "pillow" else None,
+				"depth": self.depth,
+				"dither": self.dither if self.depth < 8 else None}
+		return hashlib.sha1(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()
+
+	def unchanged(self):
+		# Same hash as the published frame (and the frame is still there)
+		return os.path.exists(self.output) and read_manifest(self.output).get("hash") == self.digest
+
+
+def previous_frame(path, size):
+	# Last published frame, if there is one of the same size
+	try:
+		with Image.open(path) as img:
+			if img.size == size:
+				return img.convert(mode='L')
+	except (OSError, ValueError):
+		pass
+	return None
+
+def publish_tiles(task, image, digest):
+	# Changed regions against the last published frame as own PNGs, returns the extra manifest lines
+	base = read_manifest(task.output).get("hash")
+	previous = previous_frame(task.output, image.size) if base else None
+	boxes = changed_boxes(previous, image, task.tiles) if previous is not None else None
+	if boxes is None:	# no previous frame (or no NumPy): the Kindle loads the whole frame
+		return [("area", 1000)]
+	extra = [("base", base), ("area", changed_area(boxes, image.size))]
+	stem = os.path.splitext(task.output)[0]
+	for n, box in enumerate(boxes):
+		tilepath = "%s-%s-%d.png" % (stem, digest[:12], n)
+		publish(tilepath, encode_png(image.crop(box), task.depth, task.compress))
+		extra.append(("tile%d" % n, "%s,%d,%d" % (os.path.basename(tilepath), box[0], box[1])))
+	return extra
+
+def prune_tiles(output, digest):
+	# Tiles of older frames of this display
+	stem = os.path.basename(os.path.splitext(output)[0])
+	pattern = re.compile(re.escape(stem) + r"-([0-9a-f]{12})-\d+\.png$")
+	folder = os.path.dirname(output) or "."
+	for entry in os.listdir(folder):
+		match = pattern.match(entry)
+		if match and match.group(1) != digest[:12]:
+			try:
+				os.unlink(os.path.join(folder, entry))
+			except OSError:
+				pass
+
+def prepare(task, recorder):
+	# Everything that does not depend on the resolution: values filled in, SVG parsed, texts placed.
+	# Returns ((width, height) of the layout, function scale -> image)
+	if task.mode == "layered":
+		layered = load_layered(task.template, task.cachedir)
+		with recorder.stage("fill"):
+			prepared = layered.prepare(task.values, default="-")
+		return (layered.size, lambda scale: (layered if scale == 1.0 else load_layered(task.template, task.cachedir, 72 * scale)).compose(prepared))
+	elif task.mode == "pillow":
+		pillow = load_pillow(task.template, task.cachedir, task.fonts)
+		with recorder.stage("fill"):
+			prepared = pillow.prepare(task.values, default="-")
+		return (pillow.size, lambda scale: pillow.draw(prepared, scale))
+	with recorder.stage("fill"):
+		svg = load_template(task.template).render(task.values, default="-")
+	with recorder.stage("rasterize"):
+		drawing = parse_svg(svg)
+	return ((drawing.width, drawing.height), lambda scale: rasterize(drawing, 72 * scale))
+
+def draw(task, prepared, rasters, recorder):
+	# Frame of the task from prepare(): the layout scaled to fit its resolution,
+	# rasters: scale -> image, shared by the displays of a group
+	size, scaled = prepared
+	scale = fit_scale(size, task.resolution)
+	if scale not in rasters:
+		with recorder.stage("rasterize"):
+			rasters[scale] = scaled(scale)
+	return rasters[scale]
+
+def finish(task, image):
+	# Exactly the resolution of the display and reduced to its gray levels
+	image = fit(image, task.resolution)
+	if task.depth < 8:
+		image = quantize(image, 1 << task.depth, task.dither)	# after scaling, which brings back intermediate levels
+	return image
+
+def group_key(task):
+	# Tasks with the same key differ only in resolution and output format
+	return (task.template, task.mode, task.cachedir, json.dumps(task.fonts, sort_keys=True) if task.mode == "pillow" else None,
+		json.dumps(dict((key, str(value)) for key, value in task.values.items()), sort_keys=True))
+
+def render_group(tasks):
+	# Returns [(name, seconds, error, timings), ...] for tasks with the same group_key(), runs in the worker process
+	start = time.time()
+	recorder = Recorder(metrics.enabled)	# the pool is started after metrics.configure(), workers inherit the setting
+	try:
+		prepared = prepare(tasks[0], recorder)
+	except Exception as e:
+		error = "%s: %s" % (type(e).__name__, e)
+		return [(task.name, time.time() - start, error, recorder.take() if n == 0 else {}) for n, task in enumerate(tasks)]
+	rasters = {}
+	results = []
+	for task in tasks:
+		try:
+			image = draw(task, prepared, rasters, recorder)
+			with recorder.stage("encode"):
+				image = finish(task, image)
+				digest = task.digest or task.frame_hash()
+				data = encode_png(image, task.depth, task.compress)
+			with recorder.stage("publish"):
+				extra = publish_tiles(task, image, digest) if task.tiles > 0 else []	# before the PNG is replaced
+				publish(task.output, data)
+				write_manifest(task.output, digest, len(data), extra)	# after the PNG, so the hash never announces a missing frame
+				prune_tiles(task.output, digest)
+				recorder.count("bytes", len(data))
+				recorder.count("frames")
+		except Exception as e:
+			results.append((task.name, time.time() - start, "%s: %s" % (type(e).__name__, e), recorder.take()))
+		else:
+			results.append((task.name, time.time() - start, None, recorder.take()))
+		start = time.time()	# the first display of the group carries the preparation
+	return results
+
+def prerender_group(tasks):
+	# Like render_group, but nothing is published: returns [(name, seconds, error, timings, frame), ...],
+	# frame = (hash, PNG, manifest) as served by the sync service, with the changed area against the published frame
+	start = time.time()
+	recorder = Recorder(metrics.enabled)
+	try:
+		prepared = prepare(tasks[0], recorder)
+	except Exception as e:
+		error = "%s: %s" % (type(e).__name__, e)
+		return [(task.name, time.time() - start, error, recorder.take() if n == 0 else {}, None) for n, task in enumerate(tasks)]
+	rasters = {}
+	results = []
+	for task in tasks:
+		try:
+			image = draw(task, prepared, rasters, recorder)
+			with recorder.stage("encode"):
+				image = finish(task, image)
+				data = encode_png(image, task.depth, task.compress)
+			manifest = {"hash": task.digest, "size": str(len(data))}
+			base = read_manifest(task.output).get("hash")
+			previous = previous_frame(task.output, image.size) if base else None
+			boxes = changed_boxes(previous, image, max(1, task.tiles)) if previous is not None else None
+			if boxes is not None:
+				manifest.update(base=base, area=str(changed_area(boxes, image.size)))
+			recorder.count("frames")
+		except Exception as e:
+			results.append((task.name, time.time() - start, "%s: %s" % (type(e).__name__, e), recorder.take(), None))
+		else:
+			results.append((task.name, time.time() - start, None, recorder.take(), (task.digest, data, manifest)))
+		start = time.time()
+	return results
+
+def group_tasks(tasks):
+	# [[task, ...], ...]: tasks with the same group_key() together, in order of their first task
+	groups = {}
+	for task in tasks:
+		groups.setdefault(group_key(task), []).append(task)
+	return list(groups.values())
+
+class RenderPool:
+
+	def __init__(self, processes=0):
+		# processes: 0 = number of CPU cores, 1 = render in this process
+		self.processes = processes or os.cpu_count() or 1
+		self.pool = None
+
+	def start(self):
+		# Start the workers before any other thread exists (fetch pool), forking a threaded process is unsafe
+		if self.pool is None and self.processes > 1:
+			self.pool = multiprocessing.Pool(self.processes)
+		return self
+
+	def run(self, function, groups):
+		# function (render_group or prerender_group) per group, in the workers if there is more than one group
+		if len(groups) <= 1 or self.processes <= 1:
+			rendered = [function(group) for group in groups]
+		else:
+			self.start()
+			rendered = self.pool.map(function, groups, chunksize=1)
+		return [result for group in rendered for result in group]
+
+	def render(self, tasks):
+		# Returns [(name, seconds, error), ...] in order of tasks, seconds is None for unchanged displays
+		results = {}
+		todo = []
+		for task in tasks:
+			try:
+				task.digest = task.frame_hash()
+			except OSError as e:
+				results[task.name] = (task.name, 0, "%s: %s" % (type(e).__name__, e))
+				continue
+			if task.unchanged():
+				results[task.name] = (task.name, None, None)
+				metrics.count("unchanged", stage="publish")
+			else:
+				todo.append(task)
+		for name, seconds, error, timings in self.run(render_group, group_tasks(todo)):
+			results[name] = (name, seconds, error)
+			metrics.merge(timings)
+		return [results[task.name] for task in tasks]
+
+	def prerender(self, tasks):
+		# Returns [(name, seconds, error, frame), ...] in order of tasks, frame None if it would be the same
+		# as the published one (only TIME differs)
+		results = {}
+		todo = []
+		for task in tasks:
+			try:
+				task.digest = task.frame_hash()
+			except OSError as e:
+				results[task.name] = (task.name, 0, "%s: %s" % (type(e).__name__, e), None)
+				continue
+			if task.unchanged():
+				results[task.name] = (task.name, None, None, None)
+			else:
+				todo.append(task)
+		for name, seconds, error, timings, frame in self.run(prerender_group, group_tasks(todo)):
+			results[name] = (name, seconds, error, frame)
+			metrics.merge(timings)
+		return [results[task.name] for task in tasks]
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
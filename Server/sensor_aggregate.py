@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+#######################################################
+### Daily aggregate per sensor (Min/Max/First/Last)   #
+### Used by: cron_kindle-weather.py                   #
+###                                                   #
+### Instead of scanning SENSOR_DATA with DATE() and   #
+### "value + 0" on every run, one row per sensor and  #
+### day is updated together with each insert and read #
+### with a primary key lookup.                        #
+### "rise" is the sum of all positive steps of the    #
+### value, e.g. rainfall of a RAIN_COUNTER. If the    #
+### counter is reset (value drops), counting goes on  #
+### from 0, so a reset never gives negative rain.     #
+###                                                   #
+### Backfill from existing SENSOR_DATA:               #
+###   cron_kindle-weather.py --backfill-aggregates    #
+#######################################################
+
+import logging
+from datetime import datetime, date, timedelta
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS %s (
+	sensor VARCHAR(32) NOT NULL,
+	day DATE NOT NULL,
+	min_value DOUBLE NOT NULL,
+	max_value DOUBLE NOT NULL,
+	first_value DOUBLE NOT NULL,
+	last_value DOUBLE NOT NULL,
+	rise DOUBLE NOT NULL DEFAULT 0,
+	count INT NOT NULL DEFAULT 0,
+	PRIMARY KEY (sensor, day)
+)"""
+
+
+def step(previous, value):
+	# Increase between two readings of a counter, a drop means the counter was reset to 0
+	if previous is None:
+		return 0.0
+	if value >= previous:
+		return value - previous
+	return value
+
+
+class DailyAggregate:
+
+	def __init__(self, table):
+		self.table = table
+		self.created = False
+		self.upsert = ("INSERT INTO %s (sensor, day, min_value, max_value, first_value, last_value, rise, count) "
+			"VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s) "
+			"ON DUPLICATE KEY UPDATE min_value = LEAST(min_value, VALUES(min_value)), "
+			"max_value = GREATEST(max_value, VALUES(max_value)), "
+			"last_value = VALUES(last_value), "
+			"rise = rise + VALUES(rise), "
+			"count = count + VALUES(count)" % table)
+
+	def create(self, cursor):
+		if not self.created:
+			cursor.execute(CREATE_TABLE % self.table)
+			self.created = True
+
+	def last_values(self, cursor, sensors):
+		# Last known value per sensor (from its most recent day), needed for the rise of the first reading
+		if not sensors:
+			return {}
+		sql_query = ("SELECT d.sensor, d.last_value FROM %s d JOIN "
+			"(SELECT sensor, MAX(day) AS day FROM %s WHERE sensor IN (%s) GROUP BY sensor) m "
+			"ON d.sensor = m.sensor AND d.day = m.day" % (self.table, self.table, ", ".join(["%s"] * len(sensors))))
+		cursor.execute(sql_query, list(sensors))
+		return dict((row["sensor"], row["last_value"]) for row in cursor.fetchall())
+
+	def update(self, cursor, rows):
+		# rows: [sensor, value, "YYYY-mm-dd HH:MM:SS"] as written by sql_buffer.WriteBuffer into SENSOR_DATA
+		# Called within the same transaction as the insert of the raw rows
+		self.create(cursor)
+		readings = []
+		for sensor, value, timestamp in rows:
+			try:
+				readings.append((timestamp, str(sensor), float(value)))
+			except (TypeError, ValueError):
+				continue	# not numeric, nothing to aggregate
+		readings.sort()
+		last = self.last_values(cursor, set(reading[1] for reading in readings))
+
+		params = []
+		for timestamp, sensor, value in readings:
+			day = timestamp[:10]
+			params.append((sensor, day, value, value, value, value, step(last.get(sensor), value), 1))
+			last[sensor] = value
+		if params:
+			cursor.executemany(self.upsert, params)
+
+	def today(self, cursor, sensor):
+		# Aggregate row of today: {'min_value': ..., 'max_value': ..., 'first_value': ..., 'last_value': ..., 'rise': ..., 'count': ...}
+		cursor.execute("SELECT min_value, max_value, first_value, last_value, rise, count FROM %s WHERE sensor = %%s AND day = %%s" % self.table,
+			(str(sensor), date.today().isoformat()))
+		for select in cursor.fetchall():
+			return select
+		return None
+
+	def rise(self, cursor, sensor, days=1):
+		# Sum of rise over the last "days" days incl. today
+		first = date.today() - timedelta(days=days - 1)
+		cursor.execute("SELECT SUM(rise) AS rise FROM %s WHERE sensor = %%s AND day BETWEEN %%s AND %%s" % self.table,
+			(str(sensor), first.isoformat(), date.today().isoformat()))
+		for select in cursor.fetchall():
+			return select["rise"] or 0.0
+		return 0.0
+
+	def backfill(self, db, source, batch=5000, timestamp="datetime"):
+		# Rebuild all aggregates from the raw table "source" (sensor, value, datetime), streamed in datetime order.
+		# timestamp: name of the datetime column, "ts" for a timeseries.TimeSeries table
+		import pymysql
+		with db.cursor() as cursor:
+			self.create(cursor)
+			cursor.execute("DELETE FROM %s" % self.table)
+		db.commit()
+
+		aggregates = {}	# (sensor, day) -> [min, max, first, last, rise, count]
+		last = {}
+		count = 0
+		with db.cursor(pymysql.cursors.SSDictCursor) as stream:
+			stream.execute("SELECT sensor, value, %s AS datetime FROM %s ORDER BY %s" % (timestamp, source, timestamp))
+			for row in stream:
+				try:
+					value = float(row["value"])
+				except (TypeError, ValueError):
+					continue
+				sensor = str(row["sensor"])
+				stamp = row["datetime"]
+				day = stamp.date().isoformat() if isinstance(stamp, datetime) else str(stamp)[:10]
+				agg = aggregates.get((sensor, day))
+				if agg is None:
+					aggregates[(sensor, day)] = [value, value, value, value, step(last.get(sensor), value), 1]
+				else:
+					agg[0] = min(agg[0], value)
+					agg[1] = max(agg[1], value)
+					agg[3] = value
+					agg[4] += step(last.get(sensor), value)
+					agg[5] += 1
+				last[sensor] = value
+				count += 1
+
+		keys = sorted(aggregates)
+		with db.cursor() as cursor:
+			for i in range(0, len(keys), batch):
+				cursor.executemany(self.upsert, [key + tuple(aggregates[key]) for key in keys[i:i + batch]])
+				db.commit()
+		logging.info("OK | %s: %s days of %s sensors rebuilt from %s rows of %s" % (self.table, len(keys), len(last), count, source))
+		return len(keys)
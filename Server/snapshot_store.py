@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+#######################################################
+### Last good data of each source                     #
+### Used by: cron_kindle-weather.py (SNAPSHOTS)       #
+###                                                   #
+### Each source that delivered in a run (forecast,    #
+### each Homematic device, air quality) is written as #
+### a snapshot: its values with the fetch time, a     #
+### version counted up per source and the kind of     #
+### data. All snapshots are kept in one compact JSON  #
+### file. The displays are rendered from the newest   #
+### snapshot of each source, a failed or missing      #
+### source keeps its last values (shown as stale, see #
+### STALE_AFTER) instead of leaving its fields empty. #
+#######################################################
+
+import os
+import json
+import time
+import logging
+from render_pipeline import publish
+
+FORMAT = 1		# layout of the file, a file of another format is ignored (written again with the next run)
+
+
+class Snapshot:
+
+	def __init__(self, name, kind, version, fetched, values):
+		self.name = name			# source, e.g. "darksky" or "homematic/1234"
+		self.kind = kind			# kind of values, e.g. "forecast", a snapshot of another kind is not used
+		self.version = version		# counted up with each put() of this source
+		self.fetched = fetched		# epoch seconds of the data
+		self.values = values		# as returned by the fetch stage, JSON types only
+
+	def age(self, now=None):
+		return (now or time.time()) - self.fetched
+
+
+class SnapshotStore:
+
+	def __init__(self, path):
+		# path None: in memory only
+		self.path = path
+		self.snapshots = None	# name -> Snapshot, read on first use
+		self.key = None			# (mtime, size) of the file when it was read
+
+	def _stat(self):
+		try:
+			st = os.stat(self.path)
+			return (st.st_mtime_ns, st.st_size)
+		except OSError:
+			return None
+
+	def _load(self):
+		# Read again if another process (e.g. a cron run next to --render) has written the file
+		if self.path is None:
+			if self.snapshots is None:
+				self.snapshots = {}
+			return self.snapshots
+		key = self._stat()
+		if self.snapshots is not None and key == self.key:
+			return self.snapshots
+		self.snapshots = {}
+		self.key = key
+		if key is None:
+			return self.snapshots
+		try:
+			with open(self.path, "r") as f:
+				data = json.load(f)
+		except (OSError, ValueError) as e:
+			logging.warning("WARN | snapshots %s not readable - %s" % (self.path, e))
+			return self.snapshots
+		if data.get("format") != FORMAT:
+			logging.warning("WARN | snapshots %s have format %s, ignored" % (self.path, data.get("format")))
+			return self.snapshots
+		for name, entry in data.get("sources", {}).items():
+			self.snapshots[name] = Snapshot(name, entry["kind"], entry["version"], entry["fetched"], entry["values"])
+		return self.snapshots
+
+	def put(self, name, kind, values, fetched=None):
+		# New snapshot of a source (kept in memory until save())
+		snapshots = self._load()
+		previous = snapshots.get(name)
+		version = previous.version + 1 if previous else 1
+		snapshots[name] = Snapshot(name, kind, version, fetched or time.time(), json.loads(json.dumps(values)))
+		return snapshots[name]
+
+	def get(self, name, kind):
+		# Newest snapshot of a source, None if there is none of this kind
+		snapshot = self._load().get(name)
+		if snapshot is None or snapshot.kind != kind:
+			return None
+		return snapshot
+
+	def save(self):
+		if self.path is None or self.snapshots is None:
+			return
+		data = {"format": FORMAT,
+				"sources": dict((name, {"kind": s.kind, "version": s.version, "fetched": round(s.fetched, 1), "values": s.values})
+					for name, s in self.snapshots.items())}
+		os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+		publish(self.path, json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+		self.key = self._stat()
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+#######################################################
+### Batched, transactional SQL writes with spool file #
+### Used by: cron_kindle-weather.py (SENSOR_DATA),    #
+###          get_uba_airquality.py (STATION_DATA),    #
+###          timeseries.py via on_flush (*_SERIES)    #
+###                                                   #
+### All datapoints of a run are collected and written #
+### with one parameterized executemany() and a single #
+### commit. If the DB is not available, the rows are  #
+### appended to a local spool file (JSON lines) and   #
+### replayed with the next successful flush. A row    #
+### the DB keeps refusing (bad value, constraint)     #
+### while it accepts the others is moved to a         #
+### .rejected file after MAX_TRIES, so it does not    #
+### block the spool forever.                          #
+#######################################################
+
+import os
+import json
+import logging
+from datetime import datetime
+
+MAX_TRIES = 3	# replays of a row the DB refuses while it accepts others, then it goes to <spoolfile>.rejected
+
+
+class WriteBuffer:
+
+	def __init__(self, table, columns, spoolfile=None, on_flush=None, insert=True):
+		# columns: column names, the last one is the timestamp which is set by add()
+		# on_flush: optional function(cursor, rows), called within the same transaction (e.g. to update aggregates)
+		# insert: False = no INSERT into table, on_flush writes the rows itself (e.g. timeseries.TimeSeries.write)
+		self.table = table
+		self.columns = columns
+		self.spoolfile = spoolfile
+		self.on_flush = on_flush
+		self.insert = insert
+		self.rows = []
+		self.sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join(["%s"] * len(columns)))
+
+	def add(self, *values, ts=None):
+		# Timestamp of the reading, not of the (maybe much later) replay
+		# ts: "YYYY-mm-dd HH:MM:SS" of the measurement if the source tells it (e.g. the UBA hour), else now
+		self.rows.append(list(values) + [ts or datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
+
+	def spool(self, rows, tries=None):
+		# tries: failed writes per row (same order as rows), kept in the spool file with the row
+		if not rows:
+			return
+		if not self.spoolfile:
+			logging.error("FAIL | %s: %s rows lost, no spool file configured" % (self.table, len(rows)))
+			return
+		os.makedirs(os.path.dirname(self.spoolfile) or ".", exist_ok=True)
+		with open(self.spoolfile, "a") as f:
+			for n, row in enumerate(rows):
+				f.write(json.dumps({"row": row, "tries": tries[n]} if tries and tries[n] else row) + "\n")
+		logging.warning("WARN | %s: %s rows spooled to %s" % (self.table, len(rows), self.spoolfile))
+
+	def reject(self, rows, error):
+		# Rows the DB refused MAX_TRIES times, kept for a manual look
+		with open(self.spoolfile + ".rejected", "a") as f:
+			for row in rows:
+				f.write(json.dumps(row) + "\n")
+		logging.error("FAIL | %s: %s rows refused %s times, moved to %s.rejected - %s" % (self.table, len(rows), MAX_TRIES, self.spoolfile, error))
+
+	def _take_spool(self):
+		# Move the spool file aside, so rows spooled meanwhile by another run are not lost
+		if not self.spoolfile:
+			return []
+		replayfile = self.spoolfile + ".replay"
+		if os.path.exists(self.spoolfile):
+			taken = "%s.%d" % (self.spoolfile, os.getpid())
+			os.replace(self.spoolfile, taken)
+			with open(taken, "r") as f, open(replayfile, "a") as replay:
+				replay.write(f.read())
+			os.unlink(taken)
+		if not os.path.exists(replayfile):
+			return []
+		rows = []
+		with open(replayfile, "r") as f:
+			for line in f:
+				if line.strip():
+					entry = json.loads(line)
+					rows.append((entry["row"], entry["tries"]) if isinstance(entry, dict) else (entry, 0))
+		return rows
+
+	def write(self, cursor, rows):
+		# Insert rows (with their own timestamps) and call on_flush, the caller commits
+		if self.insert:
+			cursor.executemany(self.sql, rows)
+		if self.on_flush is not None:
+			self.on_flush(cursor, rows)
+
+	def flush(self, db):
+		# Write spooled and buffered rows in one transaction, returns the number of rows written
+		rows, self.rows = self.rows, []
+		if db is None:
+			self.spool(rows)
+			return 0
+		replay = self._take_spool()
+		if not rows and not replay:
+			return 0
+		try:
+			with db.cursor() as cursor:
+				self.write(cursor, [row for row, tries in replay] + rows)
+			db.commit()
+		except Exception as e:
+			logging.error("FAIL | %s: write of %s rows failed - %s" % (self.table, len(replay) + len(rows), e))
+			try:
+				db.rollback()
+				db.ping(reconnect=False)
+			except Exception:
+				self.spool(rows)	# DB not available: replay rows stay in the .replay file for the next try
+				return 0
+			return self._write_single(db, replay + [(row, 0) for row in rows])
+		if replay:
+			os.unlink(self.spoolfile + ".replay")
+			logging.info("OK | %s: %s spooled rows replayed" % (self.table, len(replay)))
+		return len(replay) + len(rows)
+
+	def _write_single(self, db, entries):
+		# The DB is up but refused the batch: each row in its own transaction, so one bad row does not block
+		# the others. entries: [(row, tries), ...], failed rows are spooled again or rejected after MAX_TRIES
+		written = 0
+		failed = []
+		rejected = []
+		error = None
+		for n, (row, tries) in enumerate(entries):
+			try:
+				with db.cursor() as cursor:
+					self.write(cursor, [row])
+				db.commit()
+				written += 1
+			except Exception as e:
+				error = e
+				try:
+					db.rollback()
+					db.ping(reconnect=False)
+				except Exception:	# DB gone meanwhile: not the row's fault, the rest is tried again as it is
+					failed.extend(entries[n:])
+					break
+				if tries + 1 >= MAX_TRIES and self.spoolfile:
+					rejected.append(row)
+				else:
+					failed.append((row, tries + 1))
+		if self.spoolfile and os.path.exists(self.spoolfile + ".replay"):
+			os.unlink(self.spoolfile + ".replay")
+		self.spool([row for row, tries in failed], [tries for row, tries in failed])
+		if rejected:
+			self.reject(rejected, error)
+		return written
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+#######################################################
+### Per-stage timings and counters of a run           #
+### Used by: cron_kindle-weather.py, fetch_pool.py,   #
+###          http_cache.py, render_pool.py,           #
+###          get_uba_airquality.py                    #
+###                                                   #
+### Each stage (fetch, SQL, fill, rasterize, encode,  #
+### publish) records its duration and counters like   #
+### retries, bytes and cache hits. After each run the #
+### values go to a Prometheus textfile (node_exporter #
+### textfile collector) and to metrics.json with the  #
+### p50/p95 per stage over the last N runs. Disabled, #
+### every call returns at the first check.            #
+#######################################################
+
+import os
+import json
+import time
+import logging
+import threading
+import functools
+import contextlib
+from render_pipeline import publish	# atomic and 0644, node_exporter usually runs as another user
+
+PREFIX = "kindle_weather"	# metric names in the Prometheus textfile
+
+_null = contextlib.nullcontext()
+
+
+def percentile(values, p):
+	# Nearest rank
+	values = sorted(values)
+	if not values:
+		return None
+	return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+class Recorder:
+	# Timings and counters of one run (or of one display in a render worker), thread-safe
+
+	def __init__(self, enabled=False):
+		self.enabled = enabled
+		self.lock = threading.Lock()
+		self.local = threading.local()	# stack of open stages per thread, counters go to the innermost
+		self.data = {}		# stage -> {"seconds": ..., "calls": ..., "counters": {name: value}}
+
+	def _entry(self, name):
+		entry = self.data.get(name)
+		if entry is None:
+			entry = self.data[name] = {"seconds": 0.0, "calls": 0, "counters": {}}
+		return entry
+
+	def current(self):
+		stack = getattr(self.local, "stack", None)
+		return stack[-1] if stack else None
+
+	@contextlib.contextmanager
+	def _stage(self, name, timed=True):
+		stack = getattr(self.local, "stack", None)
+		if stack is None:
+			stack = self.local.stack = []
+		stack.append(name)
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			stack.pop()
+			if timed:
+				seconds = time.perf_counter() - start
+				with self.lock:
+					entry = self._entry(name)
+					entry["seconds"] += seconds
+					entry["calls"] += 1
+
+	def stage(self, name):
+		# with metrics.stage("rasterize"): ...
+		if not self.enabled:
+			return _null
+		return self._stage(name)
+
+	def timed(self, name):
+		# Decorator: every call of the function is one call of the stage
+		def decorate(func):
+			@functools.wraps(func)
+			def wrapper(*args, **kwargs):
+				if not self.enabled:
+					return func(*args, **kwargs)
+				with self._stage(name):
+					return func(*args, **kwargs)
+			return wrapper
+		return decorate
+
+	def within(self, func):
+		# func runs in another thread but counts to the stage of the caller (not timed twice)
+		if not self.enabled:
+			return func
+		name = self.current()
+		if name is None:
+			return func
+		def wrapper():
+			with self._stage(name, timed=False):
+				return func()
+		return wrapper
+
+	def count(self, counter, value=1, stage=None):
+		# Add to a counter of the given stage, default: the innermost open stage of this thread
+		if not self.enabled:
+			return
+		stage = stage or self.current() or "other"
+		with self.lock:
+			counters = self._entry(stage)["counters"]
+			counters[counter] = counters.get(counter, 0) + value
+
+	def reader(self, source):
+		# Binary file object that counts the bytes read from source, e.g. a streamed HTTP response
+		if not self.enabled:
+			return source
+		return CountingReader(source, self)
+
+	def take(self):
+		# Data recorded so far, the recorder starts empty again
+		with self.lock:
+			data, self.data = self.data, {}
+		return data
+
+	def merge(self, data):
+		# Add data of another recorder (render worker)
+		if not self.enabled or not data:
+			return
+		with self.lock:
+			for name, other in data.items():
+				entry = self._entry(name)
+				entry["seconds"] += other["seconds"]
+				entry["calls"] += other["calls"]
+				for counter, value in other["counters"].items():
+					entry["counters"][counter] = entry["counters"].get(counter, 0) + value
+
+
+class CountingReader:
+
+	def __init__(self, source, recorder):
+		self.source = source
+		self.recorder = recorder
+		self.stage = recorder.current()
+
+	def _counted(self, data):
+		self.recorder.count("bytes", len(data), self.stage)
+		return data
+
+	def read(self, *args):
+		return self._counted(self.source.read(*args))
+
+	def readline(self, *args):
+		return self._counted(self.source.readline(*args))
+
+	def __iter__(self):
+		for line in self.source:
+			yield self._counted(line)
+
+
+class StageMetrics(Recorder):
+	# The recorder of the script: configured once, saved after every run
+
+	def __init__(self):
+		Recorder.__init__(self, False)
+		self.folder = None
+		self.runs = 100
+		self.started = time.time()
+
+	def configure(self, folder, runs=100):
+		# folder None = off
+		self.enabled = bool(folder)
+		self.folder = folder
+		self.runs = runs
+		self.started = time.time()
+		if self.enabled:
+			os.makedirs(folder, exist_ok=True)
+
+	def begin(self):
+		# Start of a run (the daemon sleeps between its runs)
+		self.started = time.time()
+
+	def save(self):
+		# End of a run: write the Prometheus textfile and add the run to metrics.json
+		if not self.enabled:
+			return
+		now = time.time()
+		data = self.take()
+		run = {"time": round(now, 1), "seconds": round(now - self.started, 4), "stages": data}
+		try:
+			history = self._history(run)
+			publish(os.path.join(self.folder, "metrics.json"), json.dumps(history, indent=1, sort_keys=True).encode("utf-8"))
+			publish(os.path.join(self.folder, "%s.prom" % PREFIX), self._textfile(run, history["summary"]).encode("utf-8"))
+		except (OSError, ValueError) as e:
+			logging.warning("WARN | metrics not written to %s - %s" % (self.folder, e))
+
+	def _history(self, run):
+		path = os.path.join(self.folder, "metrics.json")
+		try:
+			with open(path, "r") as f:
+				runs = json.load(f).get("runs", [])
+		except (OSError, ValueError):
+			runs = []
+		runs = (runs + [run])[-self.runs:]
+		summary = {}
+		for name in sorted(set(name for entry in runs for name in entry["stages"])):
+			values = [entry["stages"][name]["seconds"] for entry in runs if name in entry["stages"]]
+			summary[name] = {"p50": round(percentile(values, 50), 4), "p95": round(percentile(values, 95), 4), "runs": len(values)}
+		values = [entry["seconds"] for entry in runs]
+		summary["run"] = {"p50": round(percentile(values, 50), 4), "p95": round(percentile(values, 95), 4), "runs": len(values)}
+		return {"runs": runs, "summary": summary}
+
+	def _textfile(self, run, summary):
+		lines = ["# HELP %s_stage_seconds Duration of each stage in the last run" % PREFIX,
+				"# TYPE %s_stage_seconds gauge" % PREFIX]
+		for name, entry in sorted(run["stages"].items()):
+			lines.append('%s_stage_seconds{stage="%s"} %.6f' % (PREFIX, name, entry["seconds"]))
+		lines += ["# HELP %s_stage_calls Calls of each stage in the last run" % PREFIX,
+				"# TYPE %s_stage_calls gauge" % PREFIX]
+		for name, entry in sorted(run["stages"].items()):
+			lines.append('%s_stage_calls{stage="%s"} %d' % (PREFIX, name, entry["calls"]))
+		lines += ["# HELP %s_stage_count Counters of each stage in the last run (retries, bytes, cache hits, ...)" % PREFIX,
+				"# TYPE %s_stage_count gauge" % PREFIX]
+		for name, entry in sorted(run["stages"].items()):
+			for counter, value in sorted(entry["counters"].items()):
+				lines.append('%s_stage_count{stage="%s",counter="%s"} %s' % (PREFIX, name, counter, value))
+		lines += ["# HELP %s_stage_quantile_seconds Duration of each stage over the last runs" % PREFIX,
+				"# TYPE %s_stage_quantile_seconds gauge" % PREFIX]
+		for name, entry in sorted(summary.items()):
+			lines.append('%s_stage_quantile_seconds{stage="%s",quantile="0.5"} %.6f' % (PREFIX, name, entry["p50"]))
+			lines.append('%s_stage_quantile_seconds{stage="%s",quantile="0.95"} %.6f' % (PREFIX, name, entry["p95"]))
+		lines += ["# HELP %s_run_seconds Duration of the last run" % PREFIX,
+				"# TYPE %s_run_seconds gauge" % PREFIX,
+				"%s_run_seconds %.6f" % (PREFIX, run["seconds"]),
+				"# HELP %s_last_run_timestamp_seconds End of the last run" % PREFIX,
+				"# TYPE %s_last_run_timestamp_seconds gauge" % PREFIX,
+				"%s_last_run_timestamp_seconds %.1f" % (PREFIX, run["time"])]
+		return "\n".join(lines) + "\n"
+
+
+metrics = StageMetrics()	# one per process, see configure()
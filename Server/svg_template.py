@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+#######################################################
+### SVG placeholder template engine                   #
+### Used by: cron_kindle-weather.py                   #
+###                                                   #
+### The SVG templates contain placeholders like $CT,  #
+### $CHH or $J01. Instead of one str.replace() pass   #
+### per placeholder, each template is tokenized once  #
+### into literal chunks and named slots and rendered  #
+### with a single join.                               #
+#######################################################
+
+import os
+import re
+import codecs
+import logging
+
+# Placeholder = "$" followed by a name. The regex is greedy, so the longest name always wins
+# ($CHH is never read as $CH + "H", $I01 is never read as $I0 + "1").
+PLACEHOLDER = re.compile(r'\$([A-Za-z][A-Za-z0-9]*)')
+
+_cache = {}	# path -> (mtime, SvgTemplate)
+
+
+class SvgTemplate:
+
+	def __init__(self, text, name="<string>"):
+		self.name = name
+		self.chunks = []	# literal text, chunks[i] is followed by slots[i]
+		self.slots = []		# placeholder names without "$"
+		pos = 0
+		for match in PLACEHOLDER.finditer(text):
+			self.chunks.append(text[pos:match.start()])
+			self.slots.append(match.group(1))
+			pos = match.end()
+		self.chunks.append(text[pos:])
+		self.names = frozenset(self.slots)
+
+	def render(self, values, strict=False, default=None):
+		# values: dict placeholder name (without "$") -> replacement, converted with str()
+		# Placeholders without value are replaced by default, or kept as "$NAME" if default is None
+		# (same as the former str.replace chain)
+		self.check(values, strict)
+		return self.fill(values, default)
+
+	def check(self, values, strict=False):
+		# Log (or with strict: raise on) placeholders without value and values without placeholder
+		missing = self.names.difference(values)
+		unknown = set(values).difference(self.names)
+		if missing:
+			logging.warning("WARN | %s: placeholders never filled: %s" % (self.name, ", ".join(sorted(missing))))
+			if strict:
+				raise KeyError("unfilled placeholders in %s: %s" % (self.name, ", ".join(sorted(missing))))
+		if unknown:
+			logging.warning("WARN | %s: values for unknown placeholders: %s" % (self.name, ", ".join(sorted(unknown))))
+
+	def fill(self, values, default=None):
+		# Substitution only, without check()
+		parts = [self.chunks[0]]
+		for slot, chunk in zip(self.slots, self.chunks[1:]):
+			if slot in values:
+				parts.append(str(values[slot]))
+			elif default is not None:
+				parts.append(default)
+			else:
+				parts.append("$" + slot)
+			parts.append(chunk)
+		return "".join(parts)
+
+
+def load_template(path):
+	# Compiled template is cached per path and recompiled only when the file modification time changes
+	mtime = os.stat(path).st_mtime_ns
+	cached = _cache.get(path)
+	if cached is not None and cached[0] == mtime:
+		return cached[1]
+	template = SvgTemplate(codecs.open(path, "r", encoding="utf-8").read(), os.path.basename(path))
+	_cache[path] = (mtime, template)
+	return template
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+#######################################################
+### Sync service for the Kindles (SYNCMODE="server")  #
+### Used by: cron_kindle-weather.py (SYNC_PORT)       #
+###                                                   #
+### One request per wakeup instead of HEAD/GET for    #
+### script and image plus an ssh session for the log: #
+###   POST /sync/<display>?device=<hostname>          #
+### body: the log of the Kindle, If-None-Match: the   #
+### hash of the shown frame. Answer: the frame or 304 #
+### with X-Script-Version and X-Actions (pending      #
+### actions of this device) in the headers, HTTP/1.1  #
+### keep-alive. Frames are kept in memory and only    #
+### read again when the file has changed. X-Suspend:  #
+### seconds until the next wakeup (wake_schedule.py). #
+### Frames rendered ahead for this wakeup are served  #
+### instead of the published one (render_ahead.py).   #
+#######################################################
+
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from render_pipeline import manifest_path, read_manifest
+
+MAX_LOG = 1024 * 1024		# bytes of a log upload, more is refused
+ACTIONS = ("flash", "reboot", "debug")	# allowed in the action files, "script" is added by the server
+DEVICE = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+def _stat(path):
+	try:
+		st = os.stat(path)
+		return (st.st_mtime_ns, st.st_size)
+	except OSError:
+		return None
+
+
+class FileCache:
+	# Content of a file in memory, read again only if mtime or size have changed
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.key = None
+		self.value = None
+
+	def load(self, path):
+		with open(path, "rb") as f:
+			data = f.read()
+		return (hashlib.sha1(data).hexdigest(), data)
+
+	def get(self):
+		key = _stat(self.path)
+		with self.lock:
+			if key != self.key:
+				self.value = self.load(self.path) if key is not None else None
+				self.key = key
+			return self.value
+
+
+class FrameCache(FileCache):
+	# Frame of a display with the hash of its manifest (same hash as in SYNCMODE="manifest"), the
+	# manifest is part of the key, so frame and manifest are always of the same render
+
+	def load(self, path):
+		for attempt in range(3):
+			manifest = read_manifest(path)
+			with open(path, "rb") as f:
+				data = f.read()
+			if manifest.get("size") == str(len(data)):
+				return (manifest["hash"], data, manifest)
+		# no manifest (or published again meanwhile): hash of the bytes, no partial update information
+		return (hashlib.sha1(data).hexdigest(), data, {})
+
+	def get(self):
+		key = (_stat(self.path), _stat(manifest_path(self.path)))
+		with self.lock:
+			if key != self.key:
+				self.value = self.load(self.path) if key[0] is not None else None
+				self.key = key
+			return self.value
+
+
+class SyncHandler(BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"	# keep-alive, every answer has a Content-Length
+
+	def do_GET(self):
+		self.handle_request(None)
+
+	def do_POST(self):
+		# No Content-Length = no log. A length that is not a number leaves the rest of the stream unknown,
+		# so the connection is closed after the answer, as with an upload larger than MAX_LOG
+		try:
+			length = int(self.headers.get("Content-Length") or 0)
+		except ValueError:
+			length = -1
+		if length < 0:
+			self.close_connection = True
+			return self.reply(400)
+		if length > MAX_LOG:
+			self.close_connection = True
+			return self.reply(413)
+		self.handle_request(self.rfile.read(length))
+
+	def handle_request(self, body):
+		url = urlsplit(self.path)
+		query = parse_qs(url.query)
+		device = query.get("device", [""])[0]
+		if url.path == "/script":
+			script = self.server.script.get()
+			if script is None:
+				return self.reply(404)
+			return self.reply(200, script[1], {"X-Script-Version": script[0][:12]}, "text/x-shellscript")
+		if not url.path.startswith("/sync/"):
+			return self.reply(404)
+		if device and not DEVICE.match(device):
+			return self.reply(400)
+		display = url.path[len("/sync/"):]
+		frames = self.server.frames.get(display)
+		if frames is None:
+			return self.reply(404)
+		if body and device:
+			self.server.append_log(device, body)
+
+		headers = {}
+		actions = self.server.take_actions(device) if device else []
+		script = self.server.script.get()
+		if script is not None:
+			headers["X-Script-Version"] = script[0][:12]
+			if self.headers.get("X-Script") and self.headers.get("X-Script") != script[0][:12]:
+				actions.insert(0, "script")
+		headers["X-Actions"] = " ".join(actions)
+		suspend = self.server.advisor.advise(display) if self.server.advisor else None
+		if suspend is not None:
+			headers["X-Suspend"] = str(suspend)
+			if self.server.ahead:
+				self.server.ahead.expect(display, time.time() + suspend)
+		frame = (self.server.ahead.get(display, time.time()) if self.server.ahead else None) or frames.get()
+		if frame is None:
+			return self.reply(503, headers=headers)	# not rendered yet
+		etag, data, manifest = frame
+		headers["ETag"] = '"%s"' % etag
+		shown = (self.headers.get("If-None-Match") or "").strip('" ')
+		if shown == etag:
+			return self.reply(304, headers=headers)
+		if shown and manifest.get("base") == shown and "area" in manifest:
+			headers["X-Area"] = manifest["area"]	# changed area against the shown frame, for the flash decision
+		self.reply(200, data, headers, "image/png")
+
+	def reply(self, status, data=b"", headers=None, contenttype="text/plain"):
+		self.send_response(status)
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.send_header("Cache-Control", "no-cache")
+		if status != 304:
+			self.send_header("Content-Type", contenttype)
+			self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		if status != 304 and self.command != "HEAD":
+			self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		logging.debug("sync | %s %s" % (self.address_string(), format % args))
+
+
+class SyncServer(ThreadingHTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, port, displays, scriptfile, logdir, actiondir=None, advisor=None, ahead=None, host=""):
+		# displays: display_registry.Display, the Kindle asks for its frame by display name (ROOM in weatherscript.sh)
+		# advisor: wake_schedule.WakeAdvisor, None = the Kindle keeps its own wakeup table
+		# ahead: render_ahead.RenderAhead of the daemon, frames rendered ahead of the advised wakeups
+		ThreadingHTTPServer.__init__(self, (host, port), SyncHandler)
+		self.frames = dict((display.name, FrameCache(display.output)) for display in displays)
+		self.script = FileCache(scriptfile)
+		self.logdir = logdir
+		self.actiondir = actiondir
+		self.advisor = advisor
+		self.ahead = ahead
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def append_log(self, device, data):
+		# Same file as the former upload via ssh
+		try:
+			os.makedirs(self.logdir, exist_ok=True)
+			with self.lock, open(os.path.join(self.logdir, "weatherscript_%s.log" % device), "ab") as f:
+				f.write(data)
+		except OSError as e:
+			logging.warning("WARN | sync: log of %s not written - %s" % (device, e))
+
+	def take_actions(self, device):
+		# Pending actions of the device: one per line in <actiondir>/<device>, delivered once
+		if not self.actiondir:
+			return []
+		path = os.path.join(self.actiondir, device)
+		with self.lock:
+			try:
+				with open(path, "r") as f:
+					lines = f.read().split()
+				os.unlink(path)
+			except OSError:
+				return []
+		actions = [line for line in lines if line in ACTIONS]
+		if len(actions) != len(lines):
+			logging.warning("WARN | sync: unknown actions for %s ignored: %s" % (device, " ".join(line for line in lines if line not in ACTIONS)))
+		return actions
+
+	def start(self):
+		# Serve in a background thread (daemon mode)
+		self.thread = threading.Thread(target=self.serve_forever, name="sync", daemon=True)
+		self.thread.start()
+		logging.info("OK | sync server on port %s" % self.server_address[1])
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
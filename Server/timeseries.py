@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+
+#######################################################
+### Typed time series with retention and rollups      #
+### Used by: cron_kindle-weather.py (SENSOR_SERIES),  #
+###          get_uba_airquality.py (STATION_SERIES)   #
+###                                                   #
+### Readings are stored as DOUBLE with the primary    #
+### key (sensor, ts) instead of text in SENSOR_DATA,  #
+### no "value + 0" and no full scans. Each write also #
+### updates 5-minute, hourly and daily rollups        #
+### (min/max/avg/last). Old rows are removed per      #
+### level after RETENTION days, one day per run, so a #
+### run never does an unbounded delete.               #
+###                                                   #
+### Conversion of the existing table, day by day:     #
+###   cron_kindle-weather.py --migrate-series         #
+#######################################################
+
+import time
+import logging
+from datetime import datetime, timedelta
+
+CREATE_RAW = """CREATE TABLE IF NOT EXISTS %s (
+	sensor VARCHAR(32) NOT NULL,
+	ts DATETIME NOT NULL,
+	value DOUBLE NOT NULL,
+	PRIMARY KEY (sensor, ts)
+)"""
+
+CREATE_ROLLUP = """CREATE TABLE IF NOT EXISTS %s (
+	sensor VARCHAR(32) NOT NULL,
+	bucket DATETIME NOT NULL,
+	min_value DOUBLE NOT NULL,
+	max_value DOUBLE NOT NULL,
+	sum_value DOUBLE NOT NULL,
+	count INT NOT NULL,
+	last_value DOUBLE NOT NULL,
+	last_ts DATETIME NOT NULL,
+	PRIMARY KEY (sensor, bucket)
+)"""
+
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)"	# MariaDB 10.1.4+ and SQLite
+
+LEVELS = ["5m", "1h", "1d"]
+RETENTION = {"raw": 90, "5m": 730, "1h": 3650, "1d": None}	# days per level, None = keep forever
+
+
+def stamp(value):
+	# DATETIME from the DB (datetime) or a WriteBuffer row (str) -> "YYYY-mm-dd HH:MM:SS"
+	if isinstance(value, datetime):
+		return value.strftime("%Y-%m-%d %H:%M:%S")
+	return str(value)[:19]
+
+
+def number(value):
+	# Reading as float, None for values that are not numeric (e.g. "-" of the UBA, "true" of a switch)
+	try:
+		value = float(value)
+	except (TypeError, ValueError):
+		return None
+	return value if value == value else None	# NaN
+
+
+def bucket(level, ts):
+	# Start of the rollup interval of ts ("YYYY-mm-dd HH:MM:SS"), in local time like the readings
+	if level == "5m":
+		return "%s%02d:00" % (ts[:14], int(ts[14:16]) // 5 * 5)
+	if level == "1h":
+		return ts[:13] + ":00:00"
+	return ts[:10] + " 00:00:00"
+
+
+def rollup(readings, level):
+	# readings: [(sensor, value, ts), ...] -> {(sensor, bucket): [min, max, sum, count, last value, last ts]}
+	result = {}
+	for sensor, value, ts in readings:
+		key = (sensor, bucket(level, ts))
+		agg = result.get(key)
+		if agg is None:
+			result[key] = [value, value, value, 1, value, ts]
+			continue
+		agg[0] = min(agg[0], value)
+		agg[1] = max(agg[1], value)
+		agg[2] += value
+		agg[3] += 1
+		if ts >= agg[5]:
+			agg[4] = value
+			agg[5] = ts
+	return result
+
+
+class TimeSeries:
+
+	def __init__(self, table, retention=None):
+		self.table = table
+		self.retention = dict(RETENTION)
+		self.retention.update(retention or {})
+		self.created = False
+		self.insert = "INSERT IGNORE INTO %s (sensor, ts, value) VALUES (%%s, %%s, %%s)" % table	# a replayed reading is not an error
+		# Same update order as STATION_LATEST: last_value is compared with the old last_ts before that is moved on
+		self.upsert = dict((level, "INSERT INTO %s (sensor, bucket, min_value, max_value, sum_value, count, last_value, last_ts) "
+			"VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s) "
+			"ON DUPLICATE KEY UPDATE min_value = LEAST(min_value, VALUES(min_value)), "
+			"max_value = GREATEST(max_value, VALUES(max_value)), "
+			"sum_value = sum_value + VALUES(sum_value), "
+			"count = count + VALUES(count), "
+			"last_value = IF(VALUES(last_ts) >= last_ts, VALUES(last_value), last_value), "
+			"last_ts = GREATEST(last_ts, VALUES(last_ts))" % self.rollup_table(level)) for level in LEVELS)
+
+	def rollup_table(self, level):
+		return "%s_%s" % (self.table, level.upper())
+
+	def tables(self):
+		# (level, table, time column)
+		return [("raw", self.table, "ts")] + [(level, self.rollup_table(level), "bucket") for level in LEVELS]
+
+	def create(self, cursor):
+		if not self.created:
+			cursor.execute(CREATE_RAW % self.table)
+			for level in LEVELS:
+				cursor.execute(CREATE_ROLLUP % self.rollup_table(level))
+			for level, table, column in self.tables():	# oldest row for the retention without a scan
+				cursor.execute(CREATE_INDEX % (table, column, table, column))
+			self.created = True
+
+	def write(self, cursor, rows):
+		# rows: [sensor, value, "YYYY-mm-dd HH:MM:SS"] as collected by sql_buffer.WriteBuffer (on_flush),
+		# same transaction. Values that are not numeric are left out. Readings already in the table (a replayed
+		# spool, an hour backfilled again) are not inserted and not rolled up twice. Returns the new readings as
+		# rows [sensor, float value, ts], e.g. for sensor_aggregate.DailyAggregate.update.
+		self.create(cursor)
+		readings = {}
+		for sensor, value, ts in rows:
+			value = number(value)
+			if value is not None:
+				readings.setdefault((str(sensor), stamp(ts)), (str(sensor), value, stamp(ts)))	# like INSERT IGNORE: the first one wins
+		if not readings:
+			return []
+		sensors = sorted(set(sensor for sensor, ts in readings))
+		cursor.execute("SELECT sensor, ts FROM %s WHERE ts >= %%s AND ts <= %%s AND sensor IN (%s)"
+			% (self.table, ", ".join(["%s"] * len(sensors))),
+			[min(ts for sensor, ts in readings), max(ts for sensor, ts in readings)] + sensors)
+		present = set((row["sensor"], stamp(row["ts"])) for row in cursor.fetchall())
+		readings = [reading for key, reading in readings.items() if key not in present]
+		if not readings:
+			return []
+		cursor.executemany(self.insert, [(sensor, ts, value) for sensor, value, ts in readings])
+		self.update(cursor, readings)
+		return [list(reading) for reading in readings]
+
+	def update(self, cursor, readings):
+		# Rollups of new readings [(sensor, float value, ts), ...], one upsert per sensor and interval
+		for level in LEVELS:
+			aggregates = rollup(readings, level)
+			cursor.executemany(self.upsert[level], [key + tuple(aggregates[key]) for key in sorted(aggregates)])
+
+	def history(self, cursor, sensor, level, start, end):
+		# Rollup rows of a sensor between start and end: [{'bucket', 'min_value', 'max_value', 'avg_value', 'last_value'}, ...]
+		cursor.execute("SELECT bucket, min_value, max_value, sum_value / count AS avg_value, last_value FROM %s "
+			"WHERE sensor = %%s AND bucket >= %%s AND bucket < %%s ORDER BY bucket" % self.rollup_table(level),
+			(str(sensor), stamp(start), stamp(end)))
+		return cursor.fetchall()
+
+	def prune(self, db, now=None):
+		# Retention: per level at most one day of old rows per call, each in its own transaction
+		if db is None:
+			return 0
+		now = now or datetime.now()
+		deleted = 0
+		try:
+			with db.cursor() as cursor:
+				self.create(cursor)
+				for level, table, column in self.tables():
+					days = self.retention.get(level)
+					if days is None:
+						continue
+					cutoff = now - timedelta(days=days)
+					cursor.execute("SELECT MIN(%s) AS oldest FROM %s" % (column, table))
+					oldest = cursor.fetchall()[0]["oldest"]
+					if oldest is None or stamp(oldest) >= stamp(cutoff):
+						continue
+					end = min(datetime.strptime(stamp(oldest)[:10], "%Y-%m-%d") + timedelta(days=1), cutoff)
+					deleted += cursor.execute("DELETE FROM %s WHERE %s < %%s" % (table, column), (stamp(end),))
+					db.commit()
+		except Exception as e:
+			logging.error("FAIL | %s: retention failed - %s" % (self.table, e))
+			try:
+				db.rollback()
+			except Exception:
+				pass
+		return deleted
+
+	def migrate(self, db, source, columns=("sensor", "value", "datetime"), hours=24, pause=0.2):
+		# Copy the text table "source" (sensor, value, datetime) into the series, one window of "hours" per
+		# transaction, with a pause in between so the live inserts are not held up. Readings already in the
+		# series (live writes, an earlier interrupted migration) are skipped, so it can be run again any time.
+		sensor, value, ts = columns
+		with db.cursor() as cursor:
+			self.create(cursor)
+			# Window reads by index instead of scanning the whole table for every window (online in InnoDB)
+			cursor.execute(CREATE_INDEX % (source, ts, source, ts))
+			cursor.execute("SELECT MIN(%s) AS first, MAX(%s) AS last FROM %s" % (ts, ts, source))
+			row = cursor.fetchall()[0]
+		db.commit()
+		if row["first"] is None:
+			logging.info("OK | %s: %s is empty, nothing to migrate" % (self.table, source))
+			return 0
+		start = datetime.strptime(stamp(row["first"])[:13], "%Y-%m-%d %H")
+		last = datetime.strptime(stamp(row["last"]), "%Y-%m-%d %H:%M:%S")
+		copied = skipped = windows = 0
+		while start <= last:
+			end = start + timedelta(hours=hours)
+			with db.cursor() as cursor:
+				cursor.execute("SELECT %s AS sensor, %s AS value, %s AS ts FROM %s WHERE %s >= %%s AND %s < %%s"
+					% (sensor, value, ts, source, ts, ts), (stamp(start), stamp(end)))
+				rows = cursor.fetchall()
+				cursor.execute("SELECT sensor, ts FROM %s WHERE ts >= %%s AND ts < %%s" % self.table, (stamp(start), stamp(end)))
+				present = set((row["sensor"], stamp(row["ts"])) for row in cursor.fetchall())
+				readings = {}
+				for row in rows:
+					reading = (str(row["sensor"]), number(row["value"]), stamp(row["ts"]))
+					if reading[1] is None or reading[::2] in present:
+						skipped += 1
+					else:
+						readings[reading[::2]] = reading	# duplicates in the source: the last one wins
+				if readings:
+					readings = list(readings.values())
+					cursor.executemany(self.insert, [(sensor, ts, value) for sensor, value, ts in readings])
+					self.update(cursor, readings)
+					copied += len(readings)
+			db.commit()
+			windows += 1
+			if windows % 30 == 0:
+				logging.info("OK | %s: migrated up to %s, %s readings" % (self.table, stamp(end), copied))
+			start = end
+			time.sleep(pause)
+		logging.info("OK | %s: %s readings migrated from %s, %s skipped (not numeric or already present)" % (self.table, copied, source, skipped))
+		return copied
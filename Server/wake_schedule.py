@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+#######################################################
+### Wakeup interval advised by the server             #
+### Used by: cron_kindle-weather.py (SCHEDULE),       #
+###          sync_server.py (X-Suspend)               #
+###                                                   #
+### After each run the script writes schedule.json:   #
+### the next update times of each source (forecast    #
+### cache TTL, UBA check hours, Homematic cadence)    #
+### and how long after the start of a run each frame  #
+### is published. The sync service advises a Kindle   #
+### to wake up just after the last new frame within   #
+### the allowed age of its data (WAKE_WORKDAY/        #
+### WAKE_WEEKEND), never during QUIET_HOURS.          #
+#######################################################
+
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+from render_pipeline import publish
+
+HORIZON = 86400		# seconds of source updates written ahead
+DEFAULT = 900		# allowed age if the hour is not in the table (SUSPENDFOR of weatherscript.sh)
+
+
+def run_grid(now, interval, until):
+	# Start times of a cron job every "interval" seconds (e.g. */10 = 600), aligned to local midnight
+	midnight = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+	start = midnight + (int((now - midnight) // interval) + 1) * interval
+	times = []
+	while start <= until:
+		times.append(start)
+		start += interval
+	return times
+
+
+def repeat(first, interval, until):
+	# first, first + interval, ... up to until
+	times = []
+	while first <= until and interval > 0:
+		times.append(first)
+		first += interval
+	return times
+
+
+class WakeSchedule:
+	# Written by the render side after each run
+
+	def __init__(self, path):
+		self.path = path
+		self.data = {"sources": {}, "displays": {}}
+
+	def source(self, name, times):
+		# Expected update times (epoch seconds) of a source, e.g. the next cron runs that will fetch it
+		self.data["sources"][name] = [round(t) for t in sorted(times)]
+
+	def rendered(self, names, started, finished):
+		# Frames of these displays are published "offset" seconds after the start of a run
+		for name in names:
+			self.data["displays"][name] = {"rendered": round(finished), "offset": round(finished - started, 1)}
+
+	def save(self):
+		if not self.path:
+			return
+		self.data["written"] = round(time.time())
+		os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+		publish(self.path, json.dumps(self.data, sort_keys=True).encode("utf-8"))
+
+
+class WakeAdvisor:
+	# Read by the sync service: seconds until the next wakeup of a Kindle
+
+	def __init__(self, path, workday, weekend, quiet=None, minimum=120, margin=30):
+		# workday/weekend: [([hours], seconds), ...] allowed age of the data per hour, like F5INTWORKDAY in weatherscript.sh
+		# quiet: {"workday": (start hour, end hour), "weekend": ...}, no wakeup within (e.g. WLAN off in the router)
+		self.path = path
+		self.budgets = {"workday": self._hours(workday), "weekend": self._hours(weekend)}
+		self.quiet = quiet or {}
+		self.minimum = minimum	# never sooner (the Kindle needs some time for a wakeup)
+		self.margin = margin	# after the expected publish time
+		self.lock = threading.Lock()
+		self.key = None
+		self.data = None
+
+	@staticmethod
+	def _hours(table):
+		return dict((hour, seconds) for hours, seconds in table for hour in hours)
+
+	@staticmethod
+	def _day(when):
+		return "weekend" if when.isoweekday() >= 6 else "workday"
+
+	def _load(self):
+		try:
+			st = os.stat(self.path)
+			key = (st.st_mtime_ns, st.st_size)
+		except OSError:
+			return None
+		with self.lock:
+			if key != self.key:
+				try:
+					with open(self.path, "r") as f:
+						self.data = json.load(f)
+				except (OSError, ValueError):
+					self.data = None
+				self.key = key
+			return self.data
+
+	def budget(self, when):
+		return self.budgets[self._day(when)].get(when.hour, DEFAULT)
+
+	def limit(self, now):
+		# now + allowed age, earlier if a following hour allows less (e.g. 6:00 after the night), quiet hours excepted
+		limit = now + self.budget(datetime.fromtimestamp(now))
+		hour = datetime.fromtimestamp(now).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+		while hour.timestamp() < limit:
+			if self.quiet_end(hour) is None:
+				limit = min(limit, hour.timestamp() + self.budget(hour))
+			hour += timedelta(hours=1)
+		return limit
+
+	def quiet_end(self, when):
+		# End of the quiet hours containing when, None if when is outside
+		window = self.quiet.get(self._day(when))
+		if not window:
+			return None
+		start, end = window
+		day = when.replace(hour=0, minute=0, second=0, microsecond=0)
+		if start <= end:
+			inside = start <= when.hour < end
+		else:	# over midnight, e.g. (23, 6)
+			inside = when.hour >= start or when.hour < end
+			if when.hour >= start:
+				day += timedelta(days=1)
+		return day.replace(hour=end) if inside else None
+
+	def advise(self, display, now=None):
+		# Seconds to sleep, None if the script has not written a schedule for this display yet
+		data = self._load()
+		if not data or display not in data.get("displays", {}):
+			return None
+		now = now or time.time()
+		offset = data["displays"][display]["offset"] + self.margin
+		events = sorted(set(t + offset for times in data.get("sources", {}).values() for t in times))
+		events = [t for t in events if t >= now + self.minimum]
+		limit = self.limit(now)
+		within = [t for t in events if t <= limit]
+		if within:
+			wake = within[-1]	# newest frame the data may wait for
+		elif events:
+			wake = events[0]	# nothing new within the allowed age: the next new frame
+		else:
+			wake = limit		# schedule outdated (script not running?): as the table says
+		end = self.quiet_end(datetime.fromtimestamp(wake))
+		if end is not None:
+			end = end.timestamp()
+			wake = next((t for t in events if t >= end), end + self.margin)
+		return int(max(wake - now, self.minimum))
@@ -27,7 +27,7 @@
 NAME=weatherscript
 SCRIPTDIR="/mnt/us/scripts"				# Path to PNG files on Kindle (see Install above)
 LOG="${SCRIPTDIR}/${NAME}.log"
-SUSPENDFOR=900                          # Default, flexible by F5INTWORKDAY and F5INTWEEKEND, 
+SUSPENDFOR=900                          # Default, flexible by F5INTWORKDAY and F5INTWEEKEND, SYNCMODE "server": advised by the server
 NET="wlan0"
 
 # rtc wakeup depends on kindle version
@@ -40,6 +40,9 @@ LIMGERR="${SCRIPTDIR}/weathererror_image.png"
 LIMGERRWLAN="${SCRIPTDIR}/weathererror_wlan.png"
 LIMGERRNET="${SCRIPTDIR}/weathererror_network.png"
 LIMGERRHOST="${SCRIPTDIR}/weathererror_hostname.png"
+LHASH="${SCRIPTDIR}/weatherdata.hash"	# Hash of the shown weather image, see SYNCMODE
+LTILE="${SCRIPTDIR}/weathertile.png"	# Changed region of the weather image (partial update)
+LHEADERS="${SCRIPTDIR}/weathersync.headers"	# Response headers of the sync service, see SYNCMODE
 
 ###########
 # UserInput: IP and folder paths of application server to grab the data from
@@ -47,6 +50,13 @@ RSRV="192.168.178.X"				# IP of Synology NAS
 RFLD="kindleweatherdisplay"			# foldername with path for files on the server
 RSH="${RSRV}/${RFLD}/${NAME}.sh"	# path to server where to check for new weatherscript.sh file to download to Kindle
 RPATH="${RSRV}/${RFLD}/log" #"/var/www/html/kindle-weather"	# path to server where to upload log files from Kindle by SSH
+SYNCMODE="manifest"					# "manifest" = check weatherdata-<room>.manifest first, download and refresh only if the image has changed
+									# "full" = download and refresh the image at every wakeup
+									# "server" = one request to the sync service (SYNC_PORT of cron_kindle-weather.py): log upload,
+									# image only if changed, script version and pending actions, no ssh
+RSYNC="${RSRV}:8081"				# SYNCMODE "server": IP and port of the sync service
+FLASHAREA=1000						# Full refresh (flash) of the E-Ink, when the changed area since the last one sums up to
+									# this value (per mille of the screen, 1000 = once the whole screen)
 
 ROUTERIP="192.168.178.1"		 # Workaround, forget default gateway after STR
 
@@ -152,6 +162,75 @@ send_msg () {		# Send message via Synology NAS ChatBot
   done
 }
 
+sync_server () {	# SYNCMODE="server": log, image, script version and actions with one request (Server/sync_server.py)
+  LVERSION=`sha1sum "${SCRIPTDIR}/${NAME}.sh" | cut -c1-12`
+  LSHOWN=`cat ${LHASH} 2>/dev/null`
+  RSTATUS=`curl --silent --connect-timeout 2 --output "${LIMG}.new" --dump-header "${LHEADERS}" --write-out "%{http_code}" \
+    --header "If-None-Match: \"${LSHOWN}\"" --header "X-Script: ${LVERSION}" \
+    --data-binary "@${LOG}" "http://${RSYNC}/sync/${ROOM}?device=${HOSTNAME}"`
+  RACTIONS=`grep -i "^X-Actions:" "${LHEADERS}" 2>/dev/null | cut -d' ' -f2- | tr -d '\r'`
+  if [ "${RSTATUS}" == "200" ] || [ "${RSTATUS}" == "304" ]; then
+    rm ${LOG}	# received by the server
+    echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Log an Sync-Server übergeben und lokal gelöscht." >> ${LOG} 2>&1
+    RSUSPEND=`grep -i "^X-Suspend:" "${LHEADERS}" 2>/dev/null | cut -d' ' -f2 | tr -d '\r'`
+    if [ -n "${RSUSPEND}" ] && [ -z "`echo ${RSUSPEND} | tr -d '0-9'`" ]; then	# wakeup advised by the server (SCHEDULE), instead of F5INTWORKDAY/F5INTWEEKEND
+      SUSPENDFOR=${RSUSPEND}
+      WAKEUPTIMER=$(( `date +%s` + ${SUSPENDFOR} ))
+      echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Aufwachintervall vom Sync-Server: ${SUSPENDFOR}, Aufwachzeitpunkt `date -d @${WAKEUPTIMER} '+%Y-%m-%d_%H:%M:%S'`." >> ${LOG} 2>&1
+    fi
+  fi
+  if [ "${RSTATUS}" == "200" ]; then
+    RHASH=`grep -i "^ETag:" "${LHEADERS}" | cut -d'"' -f2`
+    RAREA=`grep -i "^X-Area:" "${LHEADERS}" | cut -d' ' -f2 | tr -d '\r'`
+    if [ -z "${RAREA}" ]; then
+      RAREA=200	# shown image unknown to the server: full refresh every 6th time as before
+    fi
+    let CHANGEDAREA=CHANGEDAREA+RAREA
+    mv "${LIMG}.new" "${LIMG}"
+    echo "${RHASH}" > "${LHASH}"
+    if [ ${CHANGEDAREA} -lt ${FLASHAREA} ]; then
+      eips -g "$LIMG"
+      echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild aktualisiert." >> ${LOG} 2>&1
+    else
+      eips -f -g "$LIMG"
+      echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild und E-Ink aktualisiert." >> ${LOG} 2>&1
+      CHANGEDAREA=0
+    fi
+  elif [ "${RSTATUS}" == "304" ]; then
+    rm -f "${LIMG}.new"
+    echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild unverändert, kein Download und keine Aktualisierung." >> ${LOG} 2>&1
+  elif [ "${RSTATUS}" == "000" ]; then
+    rm -f "${LHASH}" "${LIMG}.new"
+    eips -f -g "$LIMGERRNET"
+    echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Sync-Server reagiert nicht. Server läuft (SYNC_PORT)? Kindle mit dem WLAN verbunden?" >> ${LOG} 2>&1
+    debug_network
+  else
+    rm -f "${LHASH}" "${LIMG}.new"
+    eips -f -g "$LIMGERR"
+    echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild vom Sync-Server nicht erhalten (HTTP-Status ${RSTATUS})." >> ${LOG} 2>&1
+  fi
+  for ACTION in ${RACTIONS}; do
+    echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Aktion vom Sync-Server: ${ACTION}." >> ${LOG} 2>&1
+    if [ "${ACTION}" == "flash" ] && [ -f "${LIMG}" ]; then
+      eips -f -g "$LIMG"
+      CHANGEDAREA=0
+    elif [ "${ACTION}" == "debug" ]; then
+      debug_network
+    elif [ "${ACTION}" == "reboot" ]; then
+      reboot
+      exit
+    elif [ "${ACTION}" == "script" ]; then
+      if curl --silent --fail --connect-timeout 2 --output "${SCRIPTDIR}/${NAME}.sh.new" "http://${RSYNC}/script"; then
+        mv "${SCRIPTDIR}/${NAME}.sh.new" "${SCRIPTDIR}/${NAME}.sh"
+        chmod 777 "${SCRIPTDIR}/${NAME}.sh"
+        echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Skript aktualisiert, Neustart durchführen." >> ${LOG} 2>&1
+        reboot
+        exit
+      fi
+    fi
+  done
+}
+
 map_ip_hostname () {
 	IPOK=0
 	IP=`ifconfig ${NET} | grep "inet addr" | cut -d':' -f2 | awk '{print $1}'`
@@ -169,6 +248,7 @@ map_ip_hostname () {
 		else
 		  HOSTNAME="failed_map_ip_hostname"
 		  eips -f -g "${LIMGERRHOST}"
+		  rm -f "${LHASH}"	# weather image no longer shown
 		  echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Mappging der IP zum HOSTNAME fehlgeschlagen." >> ${LOG} 2>&1
 		  #echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | DEBUG WLAN cmState > `lipc-get-prop com.lab126.wifid cmState`" >> ${LOG} 2>&1
 		  #echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | DEBUG WLAN signalStrength > `lipc-get-prop com.lab126.wifid signalStrength`" >> ${LOG} 2>&1
@@ -185,7 +265,7 @@ map_ip_hostname () {
 
 ### Variables for IFs
 NOTIFYBATTERY=0
-REFRESHCOUNTER=0
+CHANGEDAREA=0
 
 ### IP > HOSTNAME
 map_ip_hostname
@@ -226,6 +306,7 @@ while true; do
   if [ ${CHECKBATTERY} -le 1 ]; then
     echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Batteriezustand 1%, statisches Batteriezustandsbild gesetzt, WLAN deaktivert, Ruhezustand!" >> ${LOG} 2>&1
     eips -f -g "${LIMGBATT}"
+    rm -f "${LHASH}"
     lipc-set-prop com.lab126.wifid enable 0
 	if [ $WAKEUPMODE == 0 ]; then
 		echo 0 > /sys/class/rtc/rtc0/wakealarm
@@ -297,6 +378,7 @@ while true; do
     fi
     if [ ${WLANCOUNTER} -eq 60 ]; then
 	  eips -f -g "${LIMGERRWLAN}"
+	  rm -f "${LHASH}"
       WLANNOTCONNECTED=1
 	  echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Leider keine erfolgreiche Verbindung mit einem WLAN hergestellt." >> ${LOG} 2>&1
       break
@@ -335,6 +417,16 @@ while true; do
       fi
     fi
 
+    ### Sync service: everything with one request
+    if [ "${SYNCMODE}" == "server" ]; then
+      if [ ${HOSTNAME} != "failed_map_ip_hostname" ]; then
+        sync_server
+      else
+        echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Hostname nicht bekannt, Wetterbild konnte nicht aktualisiert werden." >> ${LOG} 2>&1
+        debug_network
+      fi
+    else
+
     ### Check new Script
     # wget (-N) can't https
     RSTATUSSH=`curl --silent --head "http://${RSH}" --connect-timeout 2| head -n 1 | cut -d$' ' -f2`
@@ -355,34 +447,81 @@ while true; do
     ### Get new Weather data (wget can't https)
 	if [ ${HOSTNAME} != "failed_map_ip_hostname" ]; then
 	RIMG="${RSRV}/${RFLD}/weatherdata-${ROOM}.png"
-    let REFRESHCOUNTER=REFRESHCOUNTER+1
+	RMANIFEST="${RSRV}/${RFLD}/weatherdata-${ROOM}.manifest"
+	RHASH=""
+	if [ "${SYNCMODE}" == "manifest" ]; then	# few bytes instead of HEAD + full image
+	  MANIFEST=`curl --silent --fail "http://${RMANIFEST}" --connect-timeout 2`
+	  RHASH=`echo "${MANIFEST}" | grep "^hash=" | cut -d= -f2`
+	  RSIZE=`echo "${MANIFEST}" | grep "^size=" | cut -d= -f2`
+	fi
+	if [ -n "${RHASH}" ] && [ -f "${LIMG}" ] && [ "${RHASH}" == "`cat ${LHASH} 2>/dev/null`" ]; then
+      echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild unverändert, kein Download und keine Aktualisierung." >> ${LOG} 2>&1
+	else
+    ### Ghosting grows with the changed area, it decides about the full refresh (flash)
+    RAREA=`echo "${MANIFEST}" | grep "^area=" | cut -d= -f2`
+    if [ -z "${RAREA}" ]; then
+      RAREA=200	# unknown (no manifest): full refresh every 6th time as before
+    fi
+    let CHANGEDAREA=CHANGEDAREA+RAREA
+    ### Partial update: only the changed tiles, if the shown image is the one the tiles were computed against
+    TILESDONE=0
+    RBASE=`echo "${MANIFEST}" | grep "^base=" | cut -d= -f2`
+    if [ -n "${RBASE}" ] && [ "${RBASE}" == "`cat ${LHASH} 2>/dev/null`" ] && [ ${CHANGEDAREA} -lt ${FLASHAREA} ]; then
+      TILESDONE=1
+      for TILE in `echo "${MANIFEST}" | grep "^tile[0-9]*=" | cut -d= -f2`; do
+        TFILE=`echo ${TILE} | cut -d, -f1`
+        TX=`echo ${TILE} | cut -d, -f2`
+        TY=`echo ${TILE} | cut -d, -f3`
+        if curl --silent --fail --output "${LTILE}" "http://${RSRV}/${RFLD}/${TFILE}" --connect-timeout 2; then
+          eips -g "${LTILE}" -x ${TX} -y ${TY}
+        else
+          TILESDONE=0	# tile replaced by a newer image meanwhile, load the whole image
+          break
+        fi
+      done
+    fi
+    if [ ${TILESDONE} -eq 1 ]; then
+      echo "${RHASH}" > "${LHASH}"
+      echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild teilweise aktualisiert (${RAREA} Promille)." >> ${LOG} 2>&1
+    else
     RSTATUSIMG=`curl --silent --head "http://${RIMG}" --connect-timeout 2 | head -n 1 | cut -d$' ' -f2`
     if [ ${RSTATUSIMG} -eq 200 ]; then
       curl --silent --output "$LIMG" "http://${RIMG}" --connect-timeout 2
-      if [ ${REFRESHCOUNTER} -le 5 ]; then    #if [ ${REFRESHCOUNTER} -ne 2 ]; then
+      if [ -n "${RHASH}" ] && [ "`stat -c %s "$LIMG"`" == "${RSIZE}" ]; then
+        echo "${RHASH}" > "${LHASH}"	# image belongs to this manifest
+      else
+        rm -f "${LHASH}"	# no manifest or image changed meanwhile, check again next time
+      fi
+      if [ ${CHANGEDAREA} -lt ${FLASHAREA} ]; then
         eips -g "$LIMG"
         echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild aktualisiert." >> ${LOG} 2>&1
       else
         eips -f -g "$LIMG"
         echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild und E-Ink aktualisiert." >> ${LOG} 2>&1
-        REFRESHCOUNTER=0
+        CHANGEDAREA=0
       fi
     elif [ -z "${RSTATUSIMG}" ]; then
+        rm -f "${LHASH}"
         eips -f -g "$LIMGERRNET"
         echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Webserver reagiert nicht. Webserver läuft? Server erreichbar? Kindle mit dem WLAN verbunden?" >> ${LOG} 2>&1
 		debug_network
     else
+        rm -f "${LHASH}"
         eips -f -g "$LIMGERR"
         echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Wetterbild auf Webserver nicht gefunden (HTTP-Status ${RSTATUSSH})." >> ${LOG} 2>&1
 		debug_network
     fi
+    fi
+	fi
 	else
       echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Hostname nicht bekannt, Wetterbild konnte nicht aktualisiert werden." >> ${LOG} 2>&1
       debug_network
     fi
+    fi
   fi
 
-    ### Copy log by ssh
+    ### Copy log by ssh (SYNCMODE "server": already sent with the sync request)
+    if [ "${SYNCMODE}" != "server" ]; then
     cat ${LOG} | ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no  -o ConnectTimeout=1 -o ConnectionAttempts=1 -i /mnt/us/scripts/id_rsa_kindle -l kindle ${RSRV} "cat >> ${RPATH}/${NAME}_${HOSTNAME}.log" > /dev/null 2>&1
     if [ $? -eq 0 ]; then
       rm ${LOG}
@@ -390,6 +529,7 @@ while true; do
     else
       echo "`date '+%Y-%m-%d_%H:%M:%S'` | ${HOSTNAME} | Log konnte nicht an den Remote-Server übergeben werden." >> ${LOG} 2>&1
     fi
+    fi
 
 
   ### Disable WLAN